@@ -0,0 +1,366 @@
+import argparse
+import datetime
+import functools
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ops2fhir
+from medicationgenerator import generator_helpers, medication_generator, med_statement, mapping_index, options
+from proceduregenerator import procedure_generator
+
+EXAMPLE_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ops_mapping_example.csv')
+ENCODING = 'ISO-8859-1'
+
+# same columns as ops2fhir.py
+LOW_VAL_COL = 'Einheit_Wert_min'
+HIGH_VAL_COL = 'Einheit_Wert_max'
+NUMERICAL_COLS = [LOW_VAL_COL, HIGH_VAL_COL]
+STR_COLS = ['ASK_Substanz_allg']
+CODING_COL_NAMES = ['UNII_Substanz_allg', 'ASK_Substanz_allg', 'CAS_Substanz_allg']
+CODING_DISPLAY_COL = 'Substanz_allg_engl_INN_oder_sonst'
+ROUTE_CODE_COL = 'Routes and Methods of Administration - Concept Code'
+ROUTE_DISPLAY_COL = 'Routes and Methods of Administration - Term'
+OPS_TEXT_COL = 'opsText'
+UNIT_CODE_COL = 'UCUM-Code'
+UNIT_COL = 'UCUM-Description'
+OPS_CODE_COL = 'opsCode'
+CSV_COLS = [CODING_DISPLAY_COL, ROUTE_CODE_COL, ROUTE_DISPLAY_COL, OPS_TEXT_COL, UNIT_CODE_COL, UNIT_COL,
+            OPS_CODE_COL] + NUMERICAL_COLS + CODING_COL_NAMES
+SUBSET = [col for col in CSV_COLS if col != HIGH_VAL_COL]
+
+# columns made unique per row for resources_retained
+DISTINCT_COLS = [CODING_DISPLAY_COL, ROUTE_CODE_COL, ROUTE_DISPLAY_COL, OPS_TEXT_COL, UNIT_CODE_COL, UNIT_COL,
+                 OPS_CODE_COL] + CODING_COL_NAMES
+
+# upper bounds of the peak bytes per row, independent of a baseline. resources_retained holds the Medication,
+# Procedure and MedicationStatement of every row like a batched or pipelined run, on distinct rows and without
+# fragment cache, so that it measures the size of the resources and not the sharing of cached fragments
+MEMORY_LIMITS = {
+    'resources_retained': 2500
+}
+
+
+def scaled_csv(n_rows, directory):
+    # repeats the data lines of the example mapping until the file has n_rows rows
+    with open(EXAMPLE_CSV, 'r', encoding=ENCODING) as f:
+        header, *lines = f.read().splitlines()
+
+    path = os.path.join(directory, f'ops_mapping_{n_rows}.csv')
+    with open(path, 'w', encoding=ENCODING) as f:
+        f.write(header + '\n')
+        for i in range(n_rows):
+            f.write(lines[i % len(lines)] + '\n')
+
+    return path
+
+
+def distinct_rows(df):
+    # every row gets its own codes, texts and values, as in a real mapping table
+    df = df.copy()
+    suffix = '-' + pd.Series(range(len(df)), index=df.index).astype(str)
+    for col in DISTINCT_COLS:
+        df[col] = df[col] + suffix
+    for col in NUMERICAL_COLS:
+        df[col] = df[col] + pd.Series(range(len(df)), index=df.index)
+
+    return df
+
+
+def create_generators(df, fragment_cache_size=generator_helpers.FRAGMENT_CACHE_SIZE):
+    med_generator = medication_generator.MedicationGenerator(
+        coding_col_names=CODING_COL_NAMES,
+        coding_display_col=CODING_DISPLAY_COL,
+        extension_url='https://www.medizininformatik-initiative.de/fhir/core/modul-medikation/StructureDefinition/wirkstofftyp',
+        extension_system='https://www.medizininformatik-initiative.de/fhir/core/modul-medikation/CodeSystem/wirkstofftyp',
+        extension_code='IN',
+        extension_display='ingredient',
+        meta_profile='https://www.medizininformatik-initiative.de/fhir/core/modul-medikation/StructureDefinition/Medication',
+        ops_df=df,
+        fragment_cache_size=fragment_cache_size
+    )
+    proc_generator = procedure_generator.ProcedureGenerator(
+        profile_url='https://www.medizininformatik-initiative.de/fhir/core/modul-prozedur/StructureDefinition/Procedure',
+        status='completed',
+        category_system='http://snomed.info/sct',
+        category_code='182832007',
+        category_display='Procedure related to management of drug administration (procedure)',
+        ops_system='http://fhir.de/CodeSystem/dimdi/ops',
+        ops_code_col=OPS_CODE_COL,
+        ops_display_col=OPS_TEXT_COL,
+        ops_version='2020',
+        seed=0,
+        fragment_cache_size=fragment_cache_size
+    )
+    med_statement_generator = med_statement.MedStatementGenerator(
+        profile_url='https://www.medizininformatik-initiative.de/fhir/core/modul-medikation/StructureDefinition/MedicationStatement',
+        status='completed',
+        route_system='http://standardterms.edqm.eu',
+        route_code_col=ROUTE_CODE_COL,
+        route_display_col=ROUTE_DISPLAY_COL,
+        ops_text_col=OPS_TEXT_COL,
+        low_val_col=LOW_VAL_COL,
+        unit_code_col=UNIT_CODE_COL,
+        unit_col=UNIT_COL,
+        unit_system='http://unitsofmeasure.org',
+        high_val_col=HIGH_VAL_COL,
+        ops_df=df,
+        seed=0,
+        fragment_cache_size=fragment_cache_size
+    )
+
+    return med_generator, proc_generator, med_statement_generator
+
+
+def retain_resources(df, generators):
+    med_generator, proc_generator, med_statement_generator = generators
+    return [list(med_generator.generate_batch(df)),
+            list(proc_generator.generate_batch(df, 'pat-1')),
+            list(med_statement_generator.generate_batch(df, pat_id='pat-1'))]
+
+
+def read_csv(path):
+    ops_csv = generator_helpers.OpsCsvReader(file_path=path, encoding=ENCODING, usecols=CSV_COLS, subset=SUBSET)
+    ops_csv.comma_to_dot(col_names=NUMERICAL_COLS)
+    ops_csv.as_str(col_names=STR_COLS)
+    return ops_csv.data
+
+
+def read_csv_arrow(path):
+    ops_csv = generator_helpers.OpsArrowReader(file_path=path, encoding=ENCODING, usecols=CSV_COLS, subset=SUBSET)
+    ops_csv.comma_to_dot(col_names=NUMERICAL_COLS)
+    ops_csv.as_str(col_names=STR_COLS)
+    return ops_csv.data
+
+
+def read_csv_chunked(path):
+    ops_csv = generator_helpers.OpsCsvChunkReader(file_path=path, encoding=ENCODING, usecols=CSV_COLS, subset=SUBSET,
+                                                  chunksize=10000)
+    ops_csv.comma_to_dot(col_names=NUMERICAL_COLS)
+    ops_csv.as_str(col_names=STR_COLS)
+    for _ in ops_csv:
+        pass
+
+
+class Context:
+    # the index, the distinct rows and the generated resources are only created for the benchmarks that use them, so
+    # that e.g. the generate benchmarks can be run alone on a million rows
+    def __init__(self, n_rows, directory):
+        self.directory = directory
+        self.path = scaled_csv(n_rows, directory)
+        self.df = read_csv(self.path)
+        self.n_rows = len(self.df)
+
+        self.med_generator, self.proc_generator, self.med_statement_generator = create_generators(self.df)
+
+    @functools.cached_property
+    def index_path(self):
+        index_path = os.path.join(self.directory, 'ops_mapping.index')
+        mapping_index.MappingIndex.compile(self.path, ENCODING, CSV_COLS, SUBSET, OPS_CODE_COL, NUMERICAL_COLS,
+                                           STR_COLS, index_path=index_path,
+                                           config=options.GeneratorConfig(**ops2fhir.GENERATE_DEFAULTS))
+        return index_path
+
+    @functools.cached_property
+    def distinct_df(self):
+        return distinct_rows(self.df)
+
+    @functools.cached_property
+    def uncached_generators(self):
+        return create_generators(self.distinct_df, fragment_cache_size=0)
+
+    @functools.cached_property
+    def generated(self):
+        rows = [row for _, row in self.df.iterrows()]
+        return {
+            'medication': [self.med_generator.generate(row) for row in rows],
+            'procedure': [self.proc_generator.generate(row, 'pat-1') for row in rows],
+            'med_statement': [self.med_statement_generator.generate(row, 'med-1', 'pat-1', 'proc-1') for row in rows]
+        }
+
+
+def _raise(e):
+    raise e
+
+
+def benchmarks(ctx: Context, names=None):
+    # name -> function processing all rows of the context once
+    benches = {
+        'csv_load': lambda: read_csv(ctx.path),
+        'csv_load_chunked': lambda: read_csv_chunked(ctx.path),
+        # fails with ImportError without pyarrow
+        'csv_load_arrow': lambda: read_csv_arrow(ctx.path),
+        'mapping_index_open': lambda: mapping_index.MappingIndex.open(ctx.index_path),
+        # the per row benchmarks include iterrows, as the posting modes before generate_batch
+        'medication_generate': lambda: [ctx.med_generator.generate(row) for _, row in ctx.df.iterrows()],
+        'medication_generate_batch': lambda: list(ctx.med_generator.generate_batch(ctx.df)),
+        'procedure_generate': lambda: [ctx.proc_generator.generate(row, 'pat-1') for _, row in ctx.df.iterrows()],
+        'procedure_generate_batch': lambda: list(ctx.proc_generator.generate_batch(ctx.df, 'pat-1')),
+        'med_statement_generate': lambda: [ctx.med_statement_generator.generate(row, 'med-1', 'pat-1', 'proc-1')
+                                           for _, row in ctx.df.iterrows()],
+        'med_statement_generate_batch': lambda: list(ctx.med_statement_generator.generate_batch(ctx.df,
+                                                                                                pat_id='pat-1')),
+        # the three resources of every row, as generated by the posting modes
+        'rows_generate': lambda: generate_rows(ctx),
+        'rows_generate_batch': lambda: generate_rows_batch(ctx),
+        'resources_retained': lambda: retain_resources(ctx.distinct_df, ctx.uncached_generators),
+    }
+
+    for name in ('medication', 'procedure', 'med_statement'):
+        # the resources are generated up front, only for the serialization benchmarks that are run
+        if names and not any(bench.startswith(f'{name}_') and bench not in benches for bench in names):
+            continue
+        resources = ctx.generated[name]
+        benches[f'{name}_to_fhir'] = lambda resources=resources: [resource.to_fhir() for resource in resources]
+        benches[f'{name}_to_json'] = lambda resources=resources: [resource.to_json() for resource in resources]
+        # to_json() returns the same dicts as as_json()
+        resource_jsons = [resource.to_json() for resource in resources]
+        benches[f'{name}_json_dumps'] = lambda resource_jsons=resource_jsons: [json.dumps(resource_json)
+                                                                               for resource_json in resource_jsons]
+        try:
+            fhir_resources = [resource.to_fhir() for resource in resources]
+        except Exception as e:
+            benches[f'{name}_as_json'] = lambda e=e: _raise(e)
+            continue
+        benches[f'{name}_as_json'] = lambda fhir_resources=fhir_resources: [fhir_resource.as_json()
+                                                                            for fhir_resource in fhir_resources]
+
+    return benches
+
+
+def generate_rows(ctx: Context):
+    return [
+        (ctx.med_generator.generate(row), ctx.proc_generator.generate(row, 'pat-1'),
+         ctx.med_statement_generator.generate(row, 'med-1', 'pat-1', 'proc-1'))
+        for _, row in ctx.df.iterrows()
+    ]
+
+
+def generate_rows_batch(ctx: Context):
+    return list(zip(
+        ctx.med_generator.generate_batch(ctx.df),
+        ctx.proc_generator.generate_batch(ctx.df, 'pat-1'),
+        ctx.med_statement_generator.generate_batch(ctx.df, pat_id='pat-1')
+    ))
+
+
+def measure(func, n_rows, repeat):
+    # rows/sec is the best of repeat runs, the peak of the memory allocated during one traced run is reported per row
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'rows_per_sec': n_rows / min(timings),
+        'peak_bytes_per_row': peak / n_rows
+    }
+
+
+def run(n_rows, repeat, names=None):
+    with tempfile.TemporaryDirectory(prefix='ops2fhir-bench-') as directory:
+        ctx = Context(n_rows, directory)
+        results = {}
+        for name, func in benchmarks(ctx, names).items():
+            if names and name not in names:
+                continue
+            try:
+                results[name] = measure(func, ctx.n_rows, repeat)
+            except Exception as e:
+                # e.g. a fhirclient version that rejects the generated values
+                results[name] = {'error': str(e).strip().splitlines()[-1].strip()}
+            print(f'{name:32} {format_result(results[name])}')
+
+    return {
+        'meta': {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'rows': ctx.n_rows,
+            'repeat': repeat
+        },
+        'results': results
+    }
+
+
+def format_result(result):
+    if 'error' in result:
+        return f'error: {result["error"]}'
+
+    return f'{result["rows_per_sec"]:>12,.0f} rows/s {result["peak_bytes_per_row"]:>10,.0f} B/row'
+
+
+def check_memory_limits(current):
+    exceeded = []
+    for name, limit in MEMORY_LIMITS.items():
+        result = current['results'].get(name)
+        if result and 'error' not in result and result['peak_bytes_per_row'] > limit:
+            exceeded.append(name)
+            print(f'{name:32} {result["peak_bytes_per_row"]:,.0f} B/row exceeds the limit of {limit:,} B/row')
+
+    return exceeded
+
+
+def compare(baseline, current, threshold):
+    # a benchmark regressed if its throughput dropped or its memory per row grew by more than threshold
+    regressions = []
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if not base or 'error' in base or 'error' in result:
+            continue
+
+        speed = result['rows_per_sec'] / base['rows_per_sec'] - 1
+        memory = result['peak_bytes_per_row'] / base['peak_bytes_per_row'] - 1 if base['peak_bytes_per_row'] else 0
+        regressed = speed < -threshold or memory > threshold
+        if regressed:
+            regressions.append(name)
+        print(f'{name:32} speed {speed:+7.1%} memory {memory:+7.1%}{"  REGRESSION" if regressed else ""}')
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the generation and serialization hot paths')
+    parser.add_argument('--rows', type=int, default=20000, help='rows of the synthetic mapping table')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, the fastest one is reported')
+    parser.add_argument('--only', nargs='*', help='names of the benchmarks to run')
+    parser.add_argument('--output', help='write the results as JSON baseline to this file')
+    parser.add_argument('--compare', help='compare the results with this JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change that counts as regression (default: 0.1)')
+    args = parser.parse_args()
+
+    current = run(args.rows, args.repeat, args.only)
+    failed = check_memory_limits(current)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(current, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regressions: {", ".join(regressions)}')
+            failed += regressions
+
+    if failed:
+        sys.exit(1)
@@ -1,3 +1,32 @@
-from medicationgenerator.generate import generate_and_post_medications, generate_and_post, generate_and_post_procedure
-from medicationgenerator.generator_helpers import OpsCsvReader
-from medicationgenerator.client import FhirClient, ResourceEnum
\ No newline at end of file
+import importlib
+
+from medicationgenerator.generate import generate_and_post_medications, generate_and_post, generate_and_post_procedure, \
+    generate_and_post_async, generate_and_post_delta, generate_and_post_patients
+from medicationgenerator.generator_helpers import OpsCsvReader, OpsCsvChunkReader, OpsArrowReader, \
+    OpsArrowChunkReader
+from medicationgenerator.client import FhirClient, ResourceEnum
+from medicationgenerator.async_client import AsyncFhirClient
+from medicationgenerator.validation import ValidationPolicy, ValidationMode
+from medicationgenerator.ndjson_sink import NdjsonSink
+from medicationgenerator.journal import Journal
+from medicationgenerator.delta import DeltaState
+from medicationgenerator.options import RunOptions, GeneratorConfig
+
+# optional parts that are slow to import (pyarrow, http.server, process pools, ...) are imported on first use
+_LAZY_ATTRIBUTES = {
+    'ProfileValidator': 'profile_validator',
+    'generate_and_post_sharded': 'sharding',
+    'PopulationGenerator': 'population',
+    'generate_and_post_population': 'population',
+    'StubFhirServer': 'stub_server',
+    'Metrics': 'metrics',
+    'MappingIndex': 'mapping_index',
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+    module = importlib.import_module(f'{__name__}.{_LAZY_ATTRIBUTES[name]}')
+    return getattr(module, name)
\ No newline at end of file
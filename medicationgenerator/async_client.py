@@ -0,0 +1,68 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from fhirclient.models import patient
+
+from medicationgenerator import client
+
+
+class AsyncFhirClient:
+    # asyncio counterpart of FhirClient, the blocking requests of the wrapped client run in a thread pool and at most
+    # max_concurrency of them are in flight at the same time
+    def __init__(self, base_url, verification=False, max_concurrency=50, **client_kwargs):
+        if max_concurrency < 1:
+            raise ValueError(f'Invalid concurrency limit: {max_concurrency}')
+
+        self.client = client.FhirClient(base_url, verification, **client_kwargs)
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+
+        # one pooled connection per concurrent request
+        self.client.set_pool_maxsize(max_concurrency)
+
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def __run(self, func, *args, **kwargs):
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def post_resource(self, resource, resource_name: client.ResourceEnum, validate_flag: bool,
+                            if_none_exist=None):
+        return await self.__run(self.client.post_resource, resource, resource_name, validate_flag,
+                                if_none_exist=if_none_exist)
+
+    async def post_json(self, resource_json, resource_name: client.ResourceEnum, validate_flag: bool,
+                        if_none_exist=None):
+        return await self.__run(self.client.post_json, resource_json, resource_name, validate_flag,
+                                if_none_exist=if_none_exist)
+
+    async def put_json(self, resource_json, resource_name: client.ResourceEnum, resource_id, validate_flag: bool):
+        return await self.__run(self.client.put_json, resource_json, resource_name, resource_id, validate_flag)
+
+    async def delete(self, resource_name: client.ResourceEnum, resource_id):
+        return await self.__run(self.client.delete, resource_name, resource_id)
+
+    async def post_bundle(self, bundle, validate_flag: bool):
+        return await self.__run(self.client.post_bundle, bundle, validate_flag)
+
+    async def post_bundle_json(self, bundle_json, validate_flag: bool):
+        return await self.__run(self.client.post_bundle_json, bundle_json, validate_flag)
+
+    async def post_patient(self, pat: patient.Patient):
+        return await self.__run(self.client.post_patient, pat)
+
+    async def post_patient_validate(self, pat: patient.Patient):
+        return await self.__run(self.client.post_patient_validate, pat)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.client.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
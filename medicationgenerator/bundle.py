@@ -0,0 +1,82 @@
+import uuid
+from typing import List
+
+from fhirclient.models import bundle
+
+from medicationgenerator import client
+from medicationgenerator.generator_helpers import json_object
+
+BUNDLE_TRANSACTION = 'transaction'
+BUNDLE_BATCH = 'batch'
+
+
+def new_full_url():
+    return f'urn:uuid:{uuid.uuid4()}'
+
+
+class BundleEntryRequest:
+    def __init__(self, method, url, if_none_exist=None):
+        self.method = method
+        self.url = url
+        self.if_none_exist = if_none_exist
+
+    def to_fhir(self) -> bundle.BundleEntryRequest:
+        entry_request = bundle.BundleEntryRequest()
+        entry_request.method = self.method
+        entry_request.url = self.url
+        entry_request.ifNoneExist = self.if_none_exist
+
+        return entry_request
+
+    def to_json(self):
+        return json_object(ifNoneExist=self.if_none_exist, method=self.method, url=self.url)
+
+
+class BundleEntry:
+    def __init__(self, resource, resource_type: client.ResourceEnum, full_url=None, if_none_exist=None):
+        # resource is the JSON of the already converted resource
+        self.resource = resource
+        self.resource_type = resource_type
+        self.full_url = full_url if full_url else new_full_url()
+        self.request = BundleEntryRequest(method='POST', url=resource_type.value, if_none_exist=if_none_exist)
+
+    def to_fhir(self) -> bundle.BundleEntry:
+        return bundle.BundleEntry(self.to_json())
+
+    def to_json(self):
+        return json_object(fullUrl=self.full_url, request=self.request.to_json(), resource=self.resource)
+
+
+class Bundle:
+    def __init__(self, bundle_type, entries: List[BundleEntry]):
+        if bundle_type not in (BUNDLE_TRANSACTION, BUNDLE_BATCH):
+            raise ValueError(f'Invalid Bundle type: {bundle_type}')
+
+        self.bundle_type = bundle_type
+        self.entries = entries
+
+    def to_fhir(self) -> bundle.Bundle:
+        return bundle.Bundle(self.to_json())
+
+    def to_json(self):
+        return json_object(
+            entry=[entry.to_json() for entry in self.entries],
+            type=self.bundle_type,
+            resourceType='Bundle'
+        )
+
+
+def parse_response_ids(response_json) -> List[str]:
+    # the response Bundle has one entry per request entry in the same order, failed batch entries yield None
+    ids = []
+    for entry in response_json.get('entry', []):
+        entry_response = entry.get('response', {})
+        resource_id = None
+        if str(entry_response.get('status', '')).startswith('2'):
+            resource_id = client.id_from_location(entry_response.get('location'))
+            if not resource_id and 'resource' in entry:
+                resource_id = entry['resource'].get('id')
+
+        ids.append(resource_id)
+
+    return ids
@@ -1,17 +1,65 @@
+import gzip
 import json
+from contextlib import nullcontext
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from fhirclient.models import patient
 from enum import Enum
 
+from medicationgenerator import validation
+
 class ResourceEnum(Enum):
     PATIENT = 'Patient'
     MEDICATION = 'Medication'
     MEDSTATEMENT = 'MedicationStatement'
     PROCEDURE = 'Procedure'
 
+# answers that mean the request was not processed and can be sent again
+RETRY_STATUS = (429, 503)
+COMPACT_SEPARATORS = (',', ':')
+
+
+def id_from_location(location):
+    # e.g. 'Medication/123/_history/1' or an absolute url
+    if not location:
+        return None
+
+    location = location.split('/_history')[0]
+    return location.rstrip('/').split('/')[-1]
+
+
+def resource_id(response):
+    # servers may answer a conditional create with an empty body, the Location header is used as fallback
+    if response.text:
+        try:
+            return json.loads(response.text)['id']
+        except (ValueError, KeyError, TypeError):
+            pass
+
+    return id_from_location(response.headers.get('Location') or response.headers.get('Content-Location'))
+
+
 class FhirClient:
-    def __init__(self, base_url, verification=False, accept_fhir_format='json', send_fhir_format='json', fhir_version='4.0'):
+    def __init__(self, base_url, verification=False, accept_fhir_format='json', send_fhir_format='json', fhir_version='4.0',
+                 validation_policy:validation.ValidationPolicy=None, profile_validator=None, pool_connections=10,
+                 pool_maxsize=10, max_retries=0, backoff_factor=0.5, timeout=None, gzip_requests=False,
+                 gzip_level=6, compact_json=False, metrics=None):
         self.base_url = base_url
+        self.validation_policy = validation_policy if validation_policy else validation.ValidationPolicy()
+        # a profile_validator.ProfileValidator validates in-process instead of calling $validate on the server
+        self.profile_validator = profile_validator
+        # (connect, read) timeout in seconds or None to wait forever
+        self.timeout = timeout
+        self.gzip_requests = gzip_requests
+        self.gzip_level = gzip_level
+        self.separators = COMPACT_SEPARATORS if compact_json else None
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        # a metrics.Metrics records the serialize, validate and create times and counts per resource type
+        self.metrics = metrics
 
         headers = {
             'Accept': f'application/fhir+{accept_fhir_format}; fhirVersion={fhir_version}',
@@ -20,37 +68,144 @@ class FhirClient:
         self.session = requests.session()
         self.session.verify = verification
         self.session.headers = headers
+        self.__mount()
+
+    def __mount(self):
+        # POST is retried only if the server did not get or rejected the request (connection errors, RETRY_STATUS),
+        # never after a read error, which could create the resource twice
+        retries = Retry(total=self.max_retries, connect=self.max_retries, read=0, status=self.max_retries,
+                        status_forcelist=RETRY_STATUS, allowed_methods=None, backoff_factor=self.backoff_factor,
+                        respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize,
+                              max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
-    def post_resource(self, resource, resource_name:ResourceEnum, validate_flag:bool):
+    def set_pool_maxsize(self, pool_maxsize):
+        # threaded callers need one pooled connection per thread
+        if pool_maxsize > self.pool_maxsize:
+            self.pool_maxsize = pool_maxsize
+            self.__mount()
+
+    def __timer(self, stage, resource_type):
+        return self.metrics.timer(stage, resource_type) if self.metrics else nullcontext()
+
+    def __count_response(self, response, resource_type, expected_status, event='created'):
+        if not self.metrics:
+            return
+
+        retries = response.raw.retries if response.raw is not None else None
+        if retries and retries.history:
+            self.metrics.count('retry', resource_type, len(retries.history))
+        self.metrics.count(event if response.status_code in expected_status else 'error', resource_type)
+
+    def serialize(self, resource_json):
+        # the body is sent as UTF-8 bytes, so requests doesn't encode it again. Returns the body and the headers of
+        # the request that sends it, Content-Encoding is only set on the requests with a gzipped body.
+        data = json.dumps(resource_json, separators=self.separators, ensure_ascii=False).encode('utf-8')
+        if not self.gzip_requests:
+            return data, {}
+
+        return gzip.compress(data, compresslevel=self.gzip_level), {'Content-Encoding': 'gzip'}
+
+    def post_resource(self, resource, resource_name:ResourceEnum, validate_flag:bool, if_none_exist=None):
+        return self.post_json(resource.as_json(), resource_name, validate_flag, if_none_exist=if_none_exist)
+
+    def post_json(self, resource_json, resource_name:ResourceEnum, validate_flag:bool, if_none_exist=None):
+        # same as post_resource for resources that were already converted with as_json()
         url = f'{self.base_url}/{resource_name.value}'
-        data = json.dumps(resource.as_json())
+        with self.__timer('serialize', resource_name.value):
+            data, headers = self.serialize(resource_json)
+        if validate_flag:
+            with self.__timer('validate', resource_name.value):
+                self.__validate(f'{url}/$validate', resource_json, data, headers)
+
+        # post resource, a conditional create answers with 200 if a matching resource already exists
+        with self.__timer('create', resource_name.value):
+            if if_none_exist:
+                response = self.session.post(url, data, headers={**headers, 'If-None-Exist': if_none_exist},
+                                             timeout=self.timeout)
+                expected_status = (200, 201)
+            else:
+                response = self.session.post(url, data, headers=headers, timeout=self.timeout)
+                expected_status = (201,)
+        self.__count_response(response, resource_name.value, expected_status)
+
+        if response.status_code not in expected_status:
+            raise Exception(f'Resource could not be created:\n {json.dumps(response.text, indent=4, sort_keys=True)}')
+
+        return response
+
+    def put_json(self, resource_json, resource_name:ResourceEnum, resource_id, validate_flag:bool):
+        # creates or updates the resource with a client-assigned id, the server has to allow update as create
+        url = f'{self.base_url}/{resource_name.value}/{resource_id}'
+        with self.__timer('serialize', resource_name.value):
+            data, headers = self.serialize(resource_json)
         if validate_flag:
-            validate_url = f'{url}/$validate'
-            response_valid = self.session.post(validate_url, data)
-
-            # check connection
-            if response_valid.status_code != 200:
-                raise Exception(f'Connection to {validate_url} failed!')
-
-            response_text = json.loads(response_valid.text)
-            for issue in response_text['issue']:
-                if issue['severity'] == 'error':
-                    response_error = json.dumps(response_text['issue'], indent=4, sort_keys=True)
-                    raise Exception(f'Resource not valid:\n {response_error}')
-
-        # post resource
-        response = self.session.post(url, data)
-        if response.status_code != 201:
+            with self.__timer('validate', resource_name.value):
+                self.__validate(f'{self.base_url}/{resource_name.value}/$validate', resource_json, data, headers)
+
+        with self.__timer('create', resource_name.value):
+            response = self.session.put(url, data, headers=headers, timeout=self.timeout)
+        self.__count_response(response, resource_name.value, (200, 201))
+
+        if response.status_code not in (200, 201):
             raise Exception(f'Resource could not be created:\n {json.dumps(response.text, indent=4, sort_keys=True)}')
 
         return response
 
+    def delete(self, resource_name:ResourceEnum, resource_id):
+        # a resource that is already gone counts as deleted, servers answer that with 404 or 410
+        url = f'{self.base_url}/{resource_name.value}/{resource_id}'
+        with self.__timer('delete', resource_name.value):
+            response = self.session.delete(url, timeout=self.timeout)
+        self.__count_response(response, resource_name.value, (200, 202, 204, 404, 410), event='deleted')
+
+        if response.status_code not in (200, 202, 204, 404, 410):
+            raise Exception(f'Resource could not be deleted:\n {json.dumps(response.text, indent=4, sort_keys=True)}')
+
+        return response
+
+    def post_bundle(self, bundle, validate_flag:bool):
+        return self.post_bundle_json(bundle.as_json(), validate_flag)
+
+    def post_bundle_json(self, bundle_json, validate_flag:bool):
+        # transaction and batch Bundles are posted to the base url, the response is a Bundle of the same length
+        with self.__timer('serialize', 'Bundle'):
+            data, headers = self.serialize(bundle_json)
+        if validate_flag:
+            with self.__timer('validate', 'Bundle'):
+                self.__validate(f'{self.base_url}/Bundle/$validate', bundle_json, data, headers)
+
+        with self.__timer('create', 'Bundle'):
+            response = self.session.post(self.base_url, data, headers=headers, timeout=self.timeout)
+        self.__count_response(response, 'Bundle', (200,))
+        if response.status_code != 200:
+            raise Exception(f'Bundle could not be processed:\n {json.dumps(response.text, indent=4, sort_keys=True)}')
+
+        return response
+
+    def __validate(self, validate_url, resource_json, data, headers):
+        if self.profile_validator:
+            self.validation_policy.validate(resource_json, lambda: self.profile_validator.validate(resource_json))
+        else:
+            self.validation_policy.validate(resource_json, lambda: self.__post_validate(validate_url, data, headers))
+
+    def __post_validate(self, validate_url, data, headers):
+        response_valid = self.session.post(validate_url, data, headers=headers, timeout=self.timeout)
+
+        # check connection
+        if response_valid.status_code != 200:
+            raise Exception(f'Connection to {validate_url} failed!')
+
+        return json.loads(response_valid.text)
+
     def post_patient(self, pat:patient.Patient):
         url = f'{self.base_url}/Patient'
-        data = json.dumps(pat.as_json())
-        return self.session.post(url, data)
+        data, headers = self.serialize(pat.as_json())
+        return self.session.post(url, data, headers=headers, timeout=self.timeout)
 
     def post_patient_validate(self, pat:patient.Patient):
         url = f'{self.base_url}/Patient/$validate'
-        data = json.dumps(pat.as_json())
-        return self.session.post(url, data)
\ No newline at end of file
+        data, headers = self.serialize(pat.as_json())
+        return self.session.post(url, data, headers=headers, timeout=self.timeout)
\ No newline at end of file
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import logging
+
+from medicationgenerator import sqlite_store
+
+logger = logging.getLogger(__name__)
+
+# meta entry of the Patient the rows were loaded for
+META_PATIENT = 'patient'
+
+
+def settings_digest(settings):
+    # changing a generator argument (e.g. the OPS version or a profile url) changes the hash of every row
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def content_hash(digest, values):
+    # NaN and other non-JSON values are written as text, the hash only has to be the same for the same row
+    data = json.dumps([digest, *values], default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class RowKeys:
+    # the key of a row is the value of its key columns plus the number of previous rows with the same value, so
+    # that an OPS code mapped to several substances gives one key per row
+    def __init__(self):
+        self.occurrences = {}
+
+    def key(self, key_values):
+        base_key = '|'.join(str(value) for value in key_values)
+        n = self.occurrences.get(base_key, 0)
+        self.occurrences[base_key] = n + 1
+
+        return f'{base_key}#{n}'
+
+
+class DeltaRow:
+    __slots__ = ('content_hash', 'medication_id', 'procedure_id', 'med_statement_id')
+
+    def __init__(self, content_hash, medication_id, procedure_id, med_statement_id):
+        self.content_hash = content_hash
+        self.medication_id = medication_id
+        self.procedure_id = procedure_id
+        self.med_statement_id = med_statement_id
+
+
+class DeltaResult:
+    def __init__(self, med_stat_ids, added, changed, removed, unchanged, failed):
+        self.med_stat_ids = med_stat_ids
+        self.added = added
+        self.changed = changed
+        self.removed = removed
+        self.unchanged = unchanged
+        self.failed = failed
+
+
+class DeltaState(sqlite_store.SqliteStore):
+    # SQLite record of the rows loaded by the previous delta run: row key, content hash and the ids of the resources
+    # created for the row. Changes are written in batches of commit_interval, so after a crash at most that many
+    # rows are created again.
+    def __init__(self, path, commit_interval=100):
+        super().__init__(path, [
+            'CREATE TABLE IF NOT EXISTS rows (row_key TEXT PRIMARY KEY, content_hash TEXT NOT NULL, '
+            'medication_id TEXT NOT NULL, procedure_id TEXT NOT NULL, med_statement_id TEXT NOT NULL)',
+            'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)'
+        ], commit_interval)
+
+    def rows(self):
+        # returns the recorded rows by key
+        self.flush()
+        records = self.query('SELECT * FROM rows')
+
+        return {row_key: DeltaRow(*values) for row_key, *values in records}
+
+    def medication_ids(self):
+        # Medications referenced by at least one recorded row
+        self.flush()
+        records = self.query('SELECT DISTINCT medication_id FROM rows')
+
+        return {medication_id for medication_id, in records}
+
+    def get_meta(self, name):
+        records = self.query('SELECT value FROM meta WHERE name = ?', (name,))
+
+        return records[0][0] if records else None
+
+    def set_meta(self, name, value):
+        self.write('INSERT OR REPLACE INTO meta VALUES (?, ?)', (name, value))
+        self.flush()
+
+    def record(self, row_key, row: DeltaRow):
+        self.write('INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?, ?)',
+                   (row_key, row.content_hash, row.medication_id, row.procedure_id, row.med_statement_id))
+
+    def remove(self, row_key):
+        self.write('DELETE FROM rows WHERE row_key = ?', (row_key,))
@@ -1,107 +1,940 @@
+import asyncio
+import functools
+import itertools
 import json
 import logging
+import uuid
 
-from medicationgenerator import medication_generator, med_statement, client
+from medicationgenerator import medication_generator, med_statement, client, bundle, medication_cache, async_client, \
+    pipeline, generator_helpers
+from medicationgenerator import journal as journal_module
+from medicationgenerator import delta as delta_module
+from medicationgenerator import options as options_module
 from proceduregenerator import procedure_generator
 
 logger = logging.getLogger(__name__)
 
+# concurrent PUT requests with client_ids if post_workers is not set
+CLIENT_ID_POST_WORKERS = 10
 
-def generate_and_post(base_url, verification, ops_df, coding_col_names, coding_display_col, extension_url,
-                      extension_system, extension_code, extension_display, med_profile, med_statement_profile,
-                      med_statement_status, route_system, route_code_col, route_display_col, ops_text_col, low_val_col,
-                      unit_code_col, unit_col, unit_system, high_val_col, procedure_profile, procedure_status,
-                      procedure_category_system, procedure_category_code, procedure_category_display,
-                      procedure_ops_system, procedure_ops_code, fhir_pat, procedure_ops_version_col=None,
-                      procedure_ops_version=None, performed_start_col=None, performed_end_col=None):
+
+def _create_generators(config: options_module.GeneratorConfig, ops_df=None, seed=None, shard=0):
     med_generator = medication_generator.MedicationGenerator(
-        coding_col_names=coding_col_names,
-        coding_display_col=coding_display_col,
-        extension_url=extension_url,
-        extension_system=extension_system,
-        extension_code=extension_code,
-        extension_display=extension_display,
-        meta_profile=med_profile,
+        coding_col_names=config.coding_col_names,
+        coding_display_col=config.coding_display_col,
+        extension_url=config.extension_url,
+        extension_system=config.extension_system,
+        extension_code=config.extension_code,
+        extension_display=config.extension_display,
+        meta_profile=config.med_profile,
         ops_df=ops_df
     )
 
     proc_generator = procedure_generator.ProcedureGenerator(
-        profile_url=procedure_profile,
-        status=procedure_status,
-        category_system=procedure_category_system,
-        category_code=procedure_category_code,
-        category_display=procedure_category_display,
-        ops_system=procedure_ops_system,
-        ops_code_col=procedure_ops_code,
-        ops_display_col=ops_text_col,
-        ops_version=procedure_ops_version,
-        ops_version_col=procedure_ops_version_col,
-        performed_start_col=performed_start_col,
-        performed_end_col=performed_end_col
+        profile_url=config.procedure_profile,
+        status=config.procedure_status,
+        category_system=config.procedure_category_system,
+        category_code=config.procedure_category_code,
+        category_display=config.procedure_category_display,
+        ops_system=config.procedure_ops_system,
+        ops_code_col=config.procedure_ops_code,
+        ops_display_col=config.ops_text_col,
+        ops_version=config.procedure_ops_version,
+        ops_version_col=config.procedure_ops_version_col,
+        performed_start_col=config.performed_start_col,
+        performed_end_col=config.performed_end_col,
+        seed=seed,
+        shard=shard
     )
 
     med_statement_generator = med_statement.MedStatementGenerator(
-        profile_url=med_statement_profile,
-        status=med_statement_status,
-        route_system=route_system,
-        route_code_col=route_code_col,
-        route_display_col=route_display_col,
-        ops_text_col=ops_text_col,
-        low_val_col=low_val_col,
-        unit_code_col=unit_code_col,
-        unit_col=unit_col,
-        unit_system=unit_system,
-        high_val_col=high_val_col,
-        ops_df=ops_df
+        profile_url=config.med_statement_profile,
+        status=config.med_statement_status,
+        route_system=config.route_system,
+        route_code_col=config.route_code_col,
+        route_display_col=config.route_display_col,
+        ops_text_col=config.ops_text_col,
+        low_val_col=config.low_val_col,
+        unit_code_col=config.unit_code_col,
+        unit_col=config.unit_col,
+        unit_system=config.unit_system,
+        high_val_col=config.high_val_col,
+        ops_df=ops_df,
+        seed=seed,
+        shard=shard
     )
 
-    fhir_client = client.FhirClient(base_url, verification)
+    return med_generator, proc_generator, med_statement_generator
+
+
+def _run_generators(config, options):
+    # the date streams follow the seed and shard of options, a metrics.Metrics records the time of each stage, the
+    # resource counts and the memory use of the run
+    return _timed(options.metrics, *_create_generators(config, seed=options.seed, shard=options.shard))
+
+
+def generate_and_post(base_url, verification, ops_df, fhir_pat, config: options_module.GeneratorConfig,
+                      options: options_module.RunOptions = None):
+    # config holds the column names and profiles of the resources, options selects how they are sent (Bundles,
+    # thread pools, client ids, a sink, ...)
+    return generate_and_post_patients(base_url, verification, [(fhir_pat, ops_df)], config,
+                                      n_rows=generator_helpers.n_rows(ops_df), options=options)
+
+
+def generate_and_post_patients(base_url, verification, patients, config: options_module.GeneratorConfig, n_rows='?',
+                               options: options_module.RunOptions = None):
+    # patients yields (fhir_pat, ops_df) pairs, e.g. a population.PopulationGenerator. The rows of all Patients go
+    # through one FhirClient (or sink), one set of generators and one Medication cache, each Patient is created when
+    # its first row is read. n_rows is only used for the progress.
+    options = options or options_module.RunOptions()
+    med_generator, proc_generator, med_statement_generator = _run_generators(config, options)
+
+    # identical substances are only created once and reused by the following rows, a MedicationCache passed as
+    # cache_medications is shared with other runs
+    med_cache = _medication_cache(options.cache_medications)
+    fhir_client = options.fhir_client(base_url, verification) if not options.sink else None
+
+    def patient_chunks():
+        for fhir_pat, ops_data in patients:
+            if options.sink:
+                pat_id = _write_patient(options.sink, fhir_pat)
+            else:
+                pat_id = _patient_id(fhir_client, fhir_pat, options)
+            for chunk in generator_helpers.iter_chunks(_timed_chunks(options.metrics, ops_data)):
+                yield pat_id, chunk
+
+    rows = _generate_rows(patient_chunks(), med_generator, proc_generator, med_statement_generator)
 
+    # write the resources with client-side ids to a file sink instead of posting them
+    if options.sink:
+        return _write_to_sink(options.sink, rows, n_rows, med_cache, options.fast_json, options.client_ids,
+                              options.shard)
+
+    return _post_rows(fhir_client, rows, n_rows, med_cache, options)
+
+
+def _generate_rows(patient_chunks, med_generator, proc_generator, med_statement_generator):
+    # (row number, Patient id, Medication, Procedure, MedicationStatement) of all chunks, generated a chunk at a time
+    # with generate_batch. The rows are numbered from 0 over all Patients, resources that could not be generated are
+    # None and the references of the MedicationStatement are set once the ids are known.
+    n_row = 0
+    for pat_id, chunk in patient_chunks:
+        resources = zip(
+            med_generator.generate_batch(chunk),
+            proc_generator.generate_batch(chunk, pat_id),
+            med_statement_generator.generate_batch(chunk, pat_id=pat_id)
+        )
+        for med, proc, med_stat in resources:
+            yield n_row, pat_id, med, proc, med_stat
+            n_row += 1
+
+
+def _patient_id(fhir_client, fhir_pat, options):
+    pat_id = fhir_pat.id
+    if not pat_id and options.journal:
+        # a restarted run reuses the Patient of the journal
+        pat_id = options.journal.get(journal_module.PATIENT_ROW).get(client.ResourceEnum.PATIENT)
+    if not pat_id and options.client_ids:
+        # the id of the Patient comes from its content, so a repeated run puts the same Patient
+        pat_json = fhir_pat.as_json()
+        pat_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f'ops2fhir/{options.client_ids}/'
+                                                    f'{client.ResourceEnum.PATIENT.value}/'
+                                                    f'{json.dumps(pat_json, sort_keys=True)}'))
+        fhir_client.put_json(_with_id(pat_json, pat_id), client.ResourceEnum.PATIENT, pat_id, validate_flag=True)
+    if not pat_id:
+        response = fhir_client.post_resource(fhir_pat, client.ResourceEnum.PATIENT, validate_flag=True)
+        pat_id = client.resource_id(response)
+        if options.journal:
+            options.journal.record(journal_module.PATIENT_ROW, client.ResourceEnum.PATIENT, pat_id)
+            options.journal.flush()
+
+    return pat_id
+
+
+def _post_rows(fhir_client, rows, n_rows, med_cache, options):
+    # client_ids is a run id, the resources get ids derived from it and are created with PUT, so that no request has
+    # to wait for the id of another resource
+    if options.client_ids:
+        return _put_with_client_ids(fhir_client, rows, n_rows, med_cache, options.client_ids, options.shard,
+                                    options.generate_workers,
+                                    options.post_workers or CLIENT_ID_POST_WORKERS, options.queue_size,
+                                    options.fast_json)
+
+    # pack bundle_size rows into one transaction/batch Bundle instead of six requests per row
+    if options.bundle_size:
+        return _post_in_bundles(fhir_client, rows, n_rows, options.bundle_size, options.bundle_type, med_cache,
+                                options.fast_json, options.journal)
+
+    # generate and post in separate thread pools connected by bounded queues
+    if options.post_workers:
+        return _post_pipelined(fhir_client, rows, n_rows, med_cache, options.generate_workers, options.post_workers,
+                               options.queue_size, options.fast_json, options.journal)
+
+    return _post_sequential(fhir_client, rows, n_rows, med_cache, options.fast_json, options.journal)
+
+
+def _post_sequential(fhir_client, rows, n_rows, med_cache, fast_json, journal=None):
     med_stat_ids = []
-    n_rows = len(ops_df)
     n_row = 0
 
-    if not fhir_pat.id:
-        response = fhir_client.post_resource(fhir_pat, client.ResourceEnum.PATIENT, validate_flag=True)
-        pat_id = json.loads(response.text)['id']
+    for n_input, pat_id, med, proc, med_stat in rows:
+        # resources already created for this row by an earlier run
+        created = journal.get(n_input) if journal else {}
+        if client.ResourceEnum.MEDSTATEMENT in created:
+            med_stat_ids.append(created[client.ResourceEnum.MEDSTATEMENT])
+            n_row += 1
+            continue
+
+        generated = _row_json(med, proc, med_stat, fast_json)
+        if not generated:
+            continue
+        med_stat_id = _post_generated_row(fhir_client, *generated, med_cache, fast_json, journal, n_input, created)
+        if not med_stat_id:
+            continue
+
+        med_stat_ids.append(med_stat_id)
+        n_row += 1
+        if n_row % 100 == 0:
+            logger.info(f'Processed {n_row}/{n_rows}')
+
+    logger.info(f'Processed {n_row}/{n_rows}')
+
+    return med_stat_ids
+
+
+def _medication_cache(cache_medications):
+    if isinstance(cache_medications, medication_cache.MedicationCache):
+        return cache_medications
+
+    return medication_cache.MedicationCache() if cache_medications else None
+
+
+def _timed_chunks(metrics, ops_data):
+    # records the time to read the chunks of a streamed input
+    return metrics.timed_chunks(ops_data) if metrics else ops_data
+
+
+def _timed(metrics, med_generator, proc_generator, med_statement_generator):
+    # records the generate and to_fhir times, the requests are timed by FhirClient
+    if not metrics:
+        return med_generator, proc_generator, med_statement_generator
+
+    return (metrics.timed_generator(med_generator, client.ResourceEnum.MEDICATION),
+            metrics.timed_generator(proc_generator, client.ResourceEnum.PROCEDURE),
+            metrics.timed_generator(med_statement_generator, client.ResourceEnum.MEDSTATEMENT))
+
+
+def _resource_json(resource, fast_json):
+    # fast_json builds the dict directly from the wrapper classes instead of going through the fhirclient models
+    return resource.to_json() if fast_json else resource.to_fhir().as_json()
+
+
+def _generate_row_entries(med, proc, med_stat, med_cache, fast_json):
+    # the Medication entry is None if an identical Medication was already created or is part of the current Bundle
+    if not med or not proc or not med_stat:
+        return None
+
+    try:
+        med_ref = med_cache.get(med) if med_cache else None
+        if med_ref:
+            med_entry = None
+        else:
+            if_none_exist = med_cache.if_none_exist(med) if med_cache else None
+            med_entry = bundle.BundleEntry(_resource_json(med, fast_json), client.ResourceEnum.MEDICATION,
+                                           if_none_exist=if_none_exist)
+            med_ref = med_entry.full_url
+    except Exception as e:
+        logger.error(f'Could not create Medication resource: {e}')
+        return None
+
+    try:
+        proc_entry = bundle.BundleEntry(_resource_json(proc, fast_json), client.ResourceEnum.PROCEDURE)
+    except Exception as e:
+        logger.error(f'Could not create Procedure resource: {e}')
+        return None
+
+    # the MedicationStatement references the other entries by fullUrl, batch mode replaces them with server ids
+    med_stat.med_reference.id = med_ref
+    med_stat.proc_reference.id = proc_entry.full_url
+
+    if med_entry and med_cache:
+        med_cache.add(med, med_ref)
+
+    return med_entry, proc_entry, med_stat
+
+
+def _med_statement_entry(med_stat, fast_json):
+    try:
+        return bundle.BundleEntry(_resource_json(med_stat, fast_json), client.ResourceEnum.MEDSTATEMENT)
+    except Exception as e:
+        logger.error(f'Could not create MedicationStatement resource: {e}')
+        return None
+
+
+def _record_entries(journal, entry_rows, entries, ids):
+    # entry_rows maps the fullUrls of the Procedure and MedicationStatement entries to their input rows
+    if not journal:
+        return
+
+    for entry, entry_id in zip(entries, ids):
+        if entry_id and entry.full_url in entry_rows:
+            journal.record(entry_rows[entry.full_url], entry.resource_type, entry_id)
+
+
+def _post_transaction(fhir_client, row_entries, med_cache, fast_json, row_keys, journal=None):
+    entries = []
+    entry_rows = {}
+    for (med_entry, proc_entry, med_stat), n_input in zip(row_entries, row_keys):
+        # the Medication is kept even if the row fails, later rows may already reference its fullUrl
+        if med_entry:
+            entries.append(med_entry)
+        med_stat_entry = _med_statement_entry(med_stat, fast_json)
+        if med_stat_entry:
+            entries += [proc_entry, med_stat_entry]
+            entry_rows[proc_entry.full_url] = entry_rows[med_stat_entry.full_url] = n_input
+
+    if not entries:
+        return []
+
+    bundle_json = bundle.Bundle(bundle.BUNDLE_TRANSACTION, entries).to_json()
+    response = fhir_client.post_bundle_json(bundle_json, validate_flag=True)
+    ids = bundle.parse_response_ids(json.loads(response.text))
+
+    if med_cache:
+        med_cache.resolve({entry.full_url: entry_id for entry, entry_id in zip(entries, ids)})
+    _record_entries(journal, entry_rows, entries, ids)
+
+    return [entry_id for entry, entry_id in zip(entries, ids)
+            if entry.resource_type == client.ResourceEnum.MEDSTATEMENT]
+
+
+def _post_batch(fhir_client, row_entries, med_cache, fast_json, row_keys, journal=None):
+    # batch entries are processed independently and can't reference each other, so the MedicationStatements
+    # are sent in a second Bundle once the Medication and Procedure ids are known
+    entries = []
+    entry_rows = {}
+    for (med_entry, proc_entry, _), n_input in zip(row_entries, row_keys):
+        if med_entry:
+            entries.append(med_entry)
+        entries.append(proc_entry)
+        entry_rows[proc_entry.full_url] = n_input
+
+    if not entries:
+        return []
+
+    bundle_json = bundle.Bundle(bundle.BUNDLE_BATCH, entries).to_json()
+    response = fhir_client.post_bundle_json(bundle_json, validate_flag=True)
+    ids = bundle.parse_response_ids(json.loads(response.text))
+    full_url_ids = {entry.full_url: entry_id for entry, entry_id in zip(entries, ids)}
+
+    if med_cache:
+        med_cache.resolve(full_url_ids)
+    _record_entries(journal, entry_rows, entries, ids)
+
+    med_stat_entries = []
+    for (_, _, med_stat), n_input in zip(row_entries, row_keys):
+        # references to Medications of earlier Bundles already hold the server id
+        med_id = full_url_ids.get(med_stat.med_reference.id, med_stat.med_reference.id)
+        proc_id = full_url_ids.get(med_stat.proc_reference.id)
+        if not med_id or not proc_id:
+            logger.error('Medication or Procedure could not be created, skipping MedicationStatement')
+            continue
+
+        med_stat.med_reference.id = med_id
+        med_stat.proc_reference.id = proc_id
+        med_stat_entry = _med_statement_entry(med_stat, fast_json)
+        if med_stat_entry:
+            med_stat_entries.append(med_stat_entry)
+            entry_rows[med_stat_entry.full_url] = n_input
+
+    if not med_stat_entries:
+        return []
+
+    bundle_json = bundle.Bundle(bundle.BUNDLE_BATCH, med_stat_entries).to_json()
+    response = fhir_client.post_bundle_json(bundle_json, validate_flag=True)
+    med_stat_ids = bundle.parse_response_ids(json.loads(response.text))
+    _record_entries(journal, entry_rows, med_stat_entries, med_stat_ids)
+
+    return [med_stat_id for med_stat_id in med_stat_ids if med_stat_id]
+
+
+def _post_in_bundles(fhir_client, rows, n_rows, bundle_size, bundle_type, med_cache, fast_json, journal=None):
+    if bundle_type == bundle.BUNDLE_TRANSACTION:
+        post_chunk = _post_transaction
+    elif bundle_type == bundle.BUNDLE_BATCH:
+        post_chunk = _post_batch
     else:
-        pat_id = json.loads(fhir_pat)['id']
+        raise ValueError(f'Invalid Bundle type: {bundle_type}')
 
-    for row in ops_df.iterrows():
-        try:
-            med = med_generator.generate(row[1]).to_fhir()
-        except Exception as e:
-            logger.error(f'Could not create Medication resource: {e}')
+    med_stat_ids = []
+    n_row = 0
+    row_entries = []
+    row_keys = []
+
+    for n_input, pat_id, med, proc, med_stat in rows:
+        n_row += 1
+        # rows are resumed as a whole, only completed rows of an earlier run are skipped
+        created = journal.get(n_input) if journal else {}
+        if client.ResourceEnum.MEDSTATEMENT in created:
+            med_stat_ids.append(created[client.ResourceEnum.MEDSTATEMENT])
             continue
-        response = fhir_client.post_resource(med, client.ResourceEnum.MEDICATION, validate_flag=True)
 
-        med_id = json.loads(response.text)['id']
+        entries = _generate_row_entries(med, proc, med_stat, med_cache, fast_json)
+        if entries:
+            row_entries.append(entries)
+            row_keys.append(n_input)
+
+        if len(row_entries) >= bundle_size:
+            med_stat_ids += post_chunk(fhir_client, row_entries, med_cache, fast_json, row_keys, journal)
+            row_entries = []
+            row_keys = []
+            logger.info(f'Processed {n_row}/{n_rows}')
+
+    if row_entries:
+        med_stat_ids += post_chunk(fhir_client, row_entries, med_cache, fast_json, row_keys, journal)
+    logger.info(f'Processed {n_row}/{n_rows}')
+
+    return med_stat_ids
+
+
+def _row_json(med, proc, med_stat, fast_json):
+    # the MedicationStatement stays unconverted until the ids of the Medication and Procedure are known, rows with a
+    # resource that could not be generated (logged by generate_batch) are skipped
+    if not med or not proc or not med_stat:
+        return None
+
+    try:
+        med_json = _resource_json(med, fast_json)
+    except Exception as e:
+        logger.error(f'Could not create Medication resource: {e}')
+        return None
+
+    try:
+        proc_json = _resource_json(proc, fast_json)
+    except Exception as e:
+        logger.error(f'Could not create Procedure resource: {e}')
+        return None
+
+    return med, med_json, proc_json, med_stat
+
+
+def _create_medication(fhir_client, med_json, if_none_exist):
+    # if_none_exist is the search of a conditional create, None posts the Medication unconditionally
+    response = fhir_client.post_json(med_json, client.ResourceEnum.MEDICATION, validate_flag=True,
+                                     if_none_exist=if_none_exist)
+    return client.resource_id(response)
+
+
+def _post_generated_row(fhir_client, med, med_json, proc_json, med_stat, med_cache, fast_json, journal=None,
+                        n_input=None, created=None):
+    # created holds the ids of the resources an earlier run already created for this row
+    created = created or {}
+
+    med_id = created.get(client.ResourceEnum.MEDICATION)
+    if not med_id:
+        create_medication = functools.partial(_create_medication, fhir_client, med_json)
+        med_id = med_cache.get_or_create(med, create_medication) if med_cache else create_medication(None)
+        if not med_id:
+            logger.error('Medication could not be created, skipping row')
+            return None
+        if journal:
+            journal.record(n_input, client.ResourceEnum.MEDICATION, med_id)
+
+    proc_id = created.get(client.ResourceEnum.PROCEDURE)
+    if not proc_id:
+        response = fhir_client.post_json(proc_json, client.ResourceEnum.PROCEDURE, validate_flag=True)
+        proc_id = client.resource_id(response)
+        if journal:
+            journal.record(n_input, client.ResourceEnum.PROCEDURE, proc_id)
+
+    med_stat.med_reference.id = med_id
+    med_stat.proc_reference.id = proc_id
+    try:
+        med_stat_json = _resource_json(med_stat, fast_json)
+    except Exception as e:
+        logger.error(f'Could not create MedicationStatement resource: {e}')
+        return None
+
+    response = fhir_client.post_json(med_stat_json, client.ResourceEnum.MEDSTATEMENT, validate_flag=True)
+    med_stat_id = client.resource_id(response)
+    if journal:
+        journal.record(n_input, client.ResourceEnum.MEDSTATEMENT, med_stat_id)
+
+    return med_stat_id
+
+
+def _post_pipelined(fhir_client, rows, n_rows, med_cache, generate_workers, post_workers, queue_size, fast_json,
+                    journal=None):
+    # one pooled connection per posting thread
+    fhir_client.set_pool_maxsize(post_workers)
+
+    # the posting threads share the progress count
+    n_posted = itertools.count(1)
+
+    def generate_stage(item):
+        # the rows are generated in batches by the source, this stage converts them to JSON
+        n_row, pat_id, med, proc, med_stat = item
+        # rows completed by an earlier run are passed on without converting them again
+        created = journal.get(n_row) if journal else {}
+        if client.ResourceEnum.MEDSTATEMENT in created:
+            return n_row, created, None
+
+        generated = _row_json(med, proc, med_stat, fast_json)
+        return (n_row, created, generated) if generated else None
+
+    def post_stage(item):
+        n_row, created, generated = item
+        if generated:
+            med_stat_id = _post_generated_row(fhir_client, *generated, med_cache, fast_json, journal, n_row, created)
+        else:
+            med_stat_id = created[client.ResourceEnum.MEDSTATEMENT]
+        if not med_stat_id:
+            return None
+
+        n = next(n_posted)
+        if n % 100 == 0:
+            logger.info(f'Processed {n}/{n_rows}')
+        return n_row, med_stat_id
+
+    rows_pipeline = pipeline.Pipeline(
+        source=rows,
+        stages=[
+            pipeline.Stage('generate', generate_stage, n_workers=generate_workers),
+            pipeline.Stage('post', post_stage, n_workers=post_workers)
+        ],
+        queue_size=queue_size
+    )
+    results = rows_pipeline.run()
+    logger.info(f'Processed {len(results)}/{n_rows}')
+
+    return [med_stat_id for _, med_stat_id in sorted(results)]
+
+
+def _client_id_namespace(run_id, pat_id, shard):
+    # namespace of the Procedure and MedicationStatement ids. The Patient and shard are part of it, so the Patients of
+    # a population or the shards of a run, whose rows are all numbered from 0, don't share ids
+    return uuid.uuid5(uuid.NAMESPACE_URL, f'ops2fhir/{run_id}/{pat_id}/{shard}')
+
+
+def _medication_client_id(run_id, med):
+    # identical substances get the same id in all shards and for all Patients of a run
+    key = medication_cache.MedicationCache.key(med)
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f'ops2fhir/{run_id}/{client.ResourceEnum.MEDICATION.value}/{key}'))
+
+
+def _row_client_id(namespace, resource_type: client.ResourceEnum, n_row):
+    # rows can repeat, so the id of the Procedure and MedicationStatement comes from the row number
+    return str(uuid.uuid5(namespace, f'{resource_type.value}/{n_row}'))
+
+
+def _put_with_client_ids(fhir_client, rows, n_rows, med_cache, run_id, shard, generate_workers, post_workers,
+                         queue_size, fast_json):
+    # the generate stage builds all resources of a row with their final references and passes on one request per
+    # resource, the put stage sends them in any order. The server has to accept references to resources that are
+    # not created yet.
+    fhir_client.set_pool_maxsize(post_workers)
 
+    n_put = itertools.count(1)
+
+    def generate_stage(item):
+        n_row, pat_id, med, proc, med_stat = item
+        namespace = _client_id_namespace(run_id, pat_id, shard)
+        generated = _row_json(med, proc, med_stat, fast_json)
+        if not generated:
+            return None
+        med, med_json, proc_json, med_stat = generated
+
+        med_id = med_cache.get(med) if med_cache else None
+        put_med = not med_id
+        if put_med:
+            med_id = _medication_client_id(run_id, med)
+        proc_id = _row_client_id(namespace, client.ResourceEnum.PROCEDURE, n_row)
+        med_stat_id = _row_client_id(namespace, client.ResourceEnum.MEDSTATEMENT, n_row)
+
+        med_stat.med_reference.id = med_id
+        med_stat.proc_reference.id = proc_id
         try:
-            proc = proc_generator.generate(row[1], pat_id=pat_id).to_fhir()
+            med_stat_json = _resource_json(med_stat, fast_json)
         except Exception as e:
-            logger.error(f'Could not create Procedure resource: {e}')
-            continue
-        response = fhir_client.post_resource(proc, client.ResourceEnum.PROCEDURE, validate_flag=True)
+            logger.error(f'Could not create MedicationStatement resource: {e}')
+            return None
+
+        requests = [
+            (n_row, client.ResourceEnum.PROCEDURE, proc_id, proc_json),
+            (n_row, client.ResourceEnum.MEDSTATEMENT, med_stat_id, med_stat_json)
+        ]
+        if put_med:
+            # concurrent rows of the same substance may put it twice, which only updates it
+            requests.append((n_row, client.ResourceEnum.MEDICATION, med_id, med_json))
+            if med_cache:
+                med_cache.add(med, med_id)
+
+        return requests
+
+    def put_stage(item):
+        n_row, resource_type, resource_id, resource_json = item
+        fhir_client.put_json(_with_id(resource_json, resource_id), resource_type, resource_id, validate_flag=True)
+
+        if resource_type == client.ResourceEnum.MEDSTATEMENT:
+            n = next(n_put)
+            if n % 100 == 0:
+                logger.info(f'Processed {n}/{n_rows}')
+        return n_row, resource_type, resource_id
+
+    rows_pipeline = pipeline.Pipeline(
+        source=rows,
+        stages=[
+            pipeline.Stage('generate', generate_stage, n_workers=generate_workers, expand=True),
+            pipeline.Stage('put', put_stage, n_workers=post_workers)
+        ],
+        queue_size=queue_size
+    )
+    results = rows_pipeline.run()
 
-        proc_id = json.loads(response.text)['id']
+    med_stat_ids = sorted((n_row, resource_id) for n_row, resource_type, resource_id in results
+                          if resource_type == client.ResourceEnum.MEDSTATEMENT)
+    logger.info(f'Processed {len(med_stat_ids)}/{n_rows}')
+
+    return [med_stat_id for _, med_stat_id in med_stat_ids]
 
+
+def _with_id(resource_json, resource_id):
+    # the id is the first element of a resource, as in as_json()
+    return {'id': resource_id, **resource_json}
+
+
+def _write_patient(sink, fhir_pat):
+    pat_id = fhir_pat.id if fhir_pat.id else str(uuid.uuid4())
+    sink.write(_with_id(fhir_pat.as_json(), pat_id), client.ResourceEnum.PATIENT)
+
+    return pat_id
+
+
+def _write_to_sink(sink, rows, n_rows, med_cache, fast_json, run_id=None, shard=0):
+    med_stat_ids = []
+    n_row = 0
+
+    for n_input, pat_id, med, proc, med_stat in rows:
+        n_row += 1
+        if not med or not proc or not med_stat:
+            continue
+
+        # with a run id the ids are the same as for a server run with client_ids
+        namespace = _client_id_namespace(run_id, pat_id, shard) if run_id else None
         try:
-            med_stat = med_statement_generator.generate(row[1], med_id, pat_id, proc_id).to_fhir()
+            med_id = med_cache.get(med) if med_cache else None
+            if not med_id:
+                med_id = _medication_client_id(run_id, med) if run_id else str(uuid.uuid4())
+                sink.write(_with_id(_resource_json(med, fast_json), med_id), client.ResourceEnum.MEDICATION)
+                if med_cache:
+                    med_cache.add(med, med_id)
+
+            proc_id = _row_client_id(namespace, client.ResourceEnum.PROCEDURE, n_input) if namespace \
+                else str(uuid.uuid4())
+            sink.write(_with_id(_resource_json(proc, fast_json), proc_id), client.ResourceEnum.PROCEDURE)
+
+            med_stat.med_reference.id = med_id
+            med_stat.proc_reference.id = proc_id
+            med_stat_id = _row_client_id(namespace, client.ResourceEnum.MEDSTATEMENT, n_input) if namespace \
+                else str(uuid.uuid4())
+            sink.write(_with_id(_resource_json(med_stat, fast_json), med_stat_id), client.ResourceEnum.MEDSTATEMENT)
         except Exception as e:
-            logger.error(f'Could not create MedicationStatement resource: {e}')
+            logger.error(f'Could not write resources of row {n_row}: {e}')
             continue
-        response = fhir_client.post_resource(med_stat, client.ResourceEnum.MEDSTATEMENT, validate_flag=True)
 
-        med_stat_id = json.loads(response.text)['id']
         med_stat_ids.append(med_stat_id)
+        if n_row % 10000 == 0:
+            logger.info(f'Processed {n_row}/{n_rows}')
 
-        n_row += 1
-        print(f'Processed {n_row}/{n_rows}')
+    logger.info(f'Processed {n_row}/{n_rows}')
 
     return med_stat_ids
 
 
+def generate_and_post_delta(base_url, verification, ops_df, fhir_pat, delta_state: delta_module.DeltaState,
+                            config: options_module.GeneratorConfig, key_cols=None, dry_run=False,
+                            options: options_module.RunOptions = None):
+    # compares the rows with the content hashes of the previous run in delta_state: added rows are created, the
+    # Procedure and MedicationStatement of changed rows are updated with PUT, those of removed rows are deleted, as
+    # are the Medications no row refers to any more. Rows are identified by key_cols (default: the OPS code).
+    # dry_run only counts the rows.
+    options = options or options_module.RunOptions()
+    options.check_unsupported('Delta loading', 'bundle_size', 'post_workers', 'client_ids', 'sink', 'journal')
+    fast_json = options.fast_json
+    med_generator, proc_generator, med_statement_generator = _run_generators(config, options)
+    ops_df = _timed_chunks(options.metrics, ops_df)
+    med_cache = _medication_cache(options.cache_medications)
+    fhir_client = options.fhir_client(base_url, verification)
+
+    # the rows of the previous run reference its Patient, so it is reused
+    pat_id = fhir_pat.id or delta_state.get_meta(delta_module.META_PATIENT)
+    if not pat_id and not dry_run:
+        response = fhir_client.post_resource(fhir_pat, client.ResourceEnum.PATIENT, validate_flag=True)
+        pat_id = client.resource_id(response)
+    if pat_id and not dry_run:
+        delta_state.set_meta(delta_module.META_PATIENT, pat_id)
+
+    # the Patient and the generator arguments are part of every hash, so that e.g. a new OPS version updates all rows
+    digest = delta_module.settings_digest([pat_id, *config.values()])
+    key_cols = key_cols or [config.procedure_ops_code]
+    previous = delta_state.rows()
+    row_keys = delta_module.RowKeys()
+    seen = set()
+    counts = {'added': 0, 'changed': 0, 'unchanged': 0, 'failed': 0}
+
+    med_stat_ids = []
+    n_rows = generator_helpers.n_rows(ops_df)
+    n_row = 0
+
+    for chunk in generator_helpers.iter_chunks(ops_df):
+        # only the added and changed rows of a chunk are generated, in one generate_batch call
+        key_positions = [chunk.columns.get_loc(col) for col in key_cols]
+        row_states = []
+        for values in chunk.itertuples(index=False, name=None):
+            row_key = row_keys.key(values[position] for position in key_positions)
+            seen.add(row_key)
+            row_states.append((row_key, delta_module.content_hash(digest, list(values)), previous.get(row_key)))
+        positions = [
+            position for position, (_, row_hash, old) in enumerate(row_states)
+            if not old or old.content_hash != row_hash
+        ]
+        generated_rows = {}
+        if positions and not dry_run:
+            changed = chunk.iloc[positions]
+            generated_rows = dict(zip(positions, zip(
+                med_generator.generate_batch(changed),
+                proc_generator.generate_batch(changed, pat_id),
+                med_statement_generator.generate_batch(changed, pat_id=pat_id)
+            )))
+
+        for position, (row_key, row_hash, old) in enumerate(row_states):
+            n_row += 1
+            med_stat_id = _post_delta_row(fhir_client, row_key, row_hash, old, generated_rows.get(position), med_cache,
+                                          fast_json, delta_state, counts, dry_run)
+            if med_stat_id:
+                med_stat_ids.append(med_stat_id)
+            if n_row % 100 == 0:
+                logger.info(f'Processed {n_row}/{n_rows}')
+
+    removed = [row_key for row_key in previous if row_key not in seen]
+    if not dry_run:
+        for row_key in removed:
+            # the MedicationStatement references the Procedure, so it is deleted first
+            fhir_client.delete(client.ResourceEnum.MEDSTATEMENT, previous[row_key].med_statement_id)
+            fhir_client.delete(client.ResourceEnum.PROCEDURE, previous[row_key].procedure_id)
+            delta_state.remove(row_key)
+
+        # e.g. the Medication of a corrected UNII code, it is kept if resources of other runs still refer to it
+        unused = {row.medication_id for row in previous.values()} - delta_state.medication_ids()
+        for med_id in sorted(unused):
+            try:
+                fhir_client.delete(client.ResourceEnum.MEDICATION, med_id)
+            except Exception as e:
+                logger.warning(f'Medication {med_id} could not be deleted: {e}')
+        delta_state.flush()
+
+    logger.info(f'Processed {n_row}/{n_rows}')
+    logger.info(f'Delta: {counts["added"]} added, {counts["changed"]} changed, {len(removed)} removed, '
+                f'{counts["unchanged"]} unchanged, {counts["failed"]} failed')
+
+    return delta_module.DeltaResult(med_stat_ids, counts['added'], counts['changed'], len(removed),
+                                    counts['unchanged'], counts['failed'])
+
+
+def _post_delta_row(fhir_client, row_key, row_hash, old, generated, med_cache, fast_json, delta_state, counts,
+                    dry_run):
+    # returns the MedicationStatement id of the row, generated holds its resources if it was added or changed
+    if old and old.content_hash == row_hash:
+        counts['unchanged'] += 1
+        return old.med_statement_id
+    if dry_run:
+        counts['changed' if old else 'added'] += 1
+        return None
+
+    generated = _row_json(*generated, fast_json)
+    if not generated:
+        counts['failed'] += 1
+        return None
+    med, med_json, proc_json, med_stat = generated
+
+    # an unchanged substance is found by the conditional create and keeps its Medication
+    create_medication = functools.partial(_create_medication, fhir_client, med_json)
+    med_id = med_cache.get_or_create(med, create_medication) if med_cache else create_medication(None)
+    if not med_id:
+        logger.error('Medication could not be created, skipping row')
+        counts['failed'] += 1
+        return None
+
+    if old:
+        proc_id = old.procedure_id
+        fhir_client.put_json(_with_id(proc_json, proc_id), client.ResourceEnum.PROCEDURE, proc_id, validate_flag=True)
+    else:
+        response = fhir_client.post_json(proc_json, client.ResourceEnum.PROCEDURE, validate_flag=True)
+        proc_id = client.resource_id(response)
+
+    med_stat.med_reference.id = med_id
+    med_stat.proc_reference.id = proc_id
+    try:
+        med_stat_json = _resource_json(med_stat, fast_json)
+    except Exception as e:
+        logger.error(f'Could not create MedicationStatement resource: {e}')
+        counts['failed'] += 1
+        return None
+
+    if old:
+        med_stat_id = old.med_statement_id
+        fhir_client.put_json(_with_id(med_stat_json, med_stat_id), client.ResourceEnum.MEDSTATEMENT, med_stat_id,
+                             validate_flag=True)
+    else:
+        response = fhir_client.post_json(med_stat_json, client.ResourceEnum.MEDSTATEMENT, validate_flag=True)
+        med_stat_id = client.resource_id(response)
+
+    delta_state.record(row_key, delta_module.DeltaRow(row_hash, med_id, proc_id, med_stat_id))
+    counts['changed' if old else 'added'] += 1
+    return med_stat_id
+
+
+async def generate_and_post_async(base_url, verification, ops_df, fhir_pat, config: options_module.GeneratorConfig,
+                                  max_concurrency=50, options: options_module.RunOptions = None):
+    # many rows are in flight at once, the Medication -> Procedure -> MedicationStatement chain of a row stays in order
+    options = options or options_module.RunOptions()
+    options.check_unsupported('generate_and_post_async', 'bundle_size', 'post_workers', 'client_ids', 'sink')
+    fast_json = options.fast_json
+    journal = options.journal
+    generators = _run_generators(config, options)
+    ops_df = _timed_chunks(options.metrics, ops_df)
+
+    med_cache = _medication_cache(options.cache_medications)
+    n_rows = generator_helpers.n_rows(ops_df)
+    med_stat_ids = {}
+
+    async with async_client.AsyncFhirClient(base_url, verification, max_concurrency=max_concurrency,
+                                            validation_policy=options.validation_policy,
+                                            profile_validator=options.profile_validator, metrics=options.metrics,
+                                            **(options.client_options or {})) as fhir_client:
+        pat_id = fhir_pat.id
+        if not pat_id and journal:
+            # a restarted run reuses the Patient of the journal
+            pat_id = journal.get(journal_module.PATIENT_ROW).get(client.ResourceEnum.PATIENT)
+        if not pat_id:
+            response = await fhir_client.post_resource(fhir_pat, client.ResourceEnum.PATIENT, validate_flag=True)
+            pat_id = json.loads(response.text)['id']
+            if journal:
+                journal.record(journal_module.PATIENT_ROW, client.ResourceEnum.PATIENT, pat_id)
+                journal.flush()
+
+        rows = _generate_rows(((pat_id, chunk) for chunk in generator_helpers.iter_chunks(ops_df)), *generators)
+
+        async def worker():
+            # the rows iterator is shared, each worker processes one row at a time
+            for n_row, _, med, proc, med_stat in rows:
+                created = journal.get(n_row) if journal else {}
+                if client.ResourceEnum.MEDSTATEMENT in created:
+                    med_stat_ids[n_row] = created[client.ResourceEnum.MEDSTATEMENT]
+                    continue
+
+                med_stat_id = await _post_row_async(fhir_client, med, proc, med_stat, med_cache, fast_json, journal,
+                                                    n_row, created)
+                if med_stat_id:
+                    med_stat_ids[n_row] = med_stat_id
+                    if len(med_stat_ids) % 100 == 0:
+                        logger.info(f'Processed {len(med_stat_ids)}/{n_rows}')
+
+        # the first failed request stops the run, the rows in flight are cancelled
+        workers = [asyncio.ensure_future(worker()) for _ in range(max_concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        except Exception:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            raise
+
+    logger.info(f'Processed {len(med_stat_ids)}/{n_rows}')
+
+    return [med_stat_ids[n_row] for n_row in sorted(med_stat_ids)]
+
+
+async def _medication_id_async(fhir_client, med, fhir_med, med_cache):
+    # concurrent rows with the same Medication wait for the pending creation instead of posting it again
+    if not med_cache:
+        response = await fhir_client.post_json(fhir_med, client.ResourceEnum.MEDICATION, validate_flag=True)
+        return client.resource_id(response)
+
+    med_id = med_cache.get(med)
+    if isinstance(med_id, asyncio.Future):
+        return await med_id
+    elif med_id:
+        return med_id
+
+    pending = asyncio.get_running_loop().create_future()
+    med_cache.add(med, pending)
+    med_id = None
+    try:
+        response = await fhir_client.post_json(fhir_med, client.ResourceEnum.MEDICATION, validate_flag=True,
+                                               if_none_exist=med_cache.if_none_exist(med))
+        med_id = client.resource_id(response)
+        med_cache.add(med, med_id)
+    finally:
+        if not med_id:
+            med_cache.invalidate(med_cache.key(med))
+        pending.set_result(med_id)
+
+    return med_id
+
+
+async def _post_row_async(fhir_client, med, proc, med_stat, med_cache, fast_json, journal=None, n_input=None,
+                          created=None):
+    # created holds the ids of the resources an earlier run already created for this row
+    created = created or {}
+    if not med or not proc or not med_stat:
+        return None
+
+    med_id = created.get(client.ResourceEnum.MEDICATION)
+    if not med_id:
+        try:
+            fhir_med = _resource_json(med, fast_json)
+        except Exception as e:
+            logger.error(f'Could not create Medication resource: {e}')
+            return None
+
+        # failed requests raise like in the other modes
+        med_id = await _medication_id_async(fhir_client, med, fhir_med, med_cache)
+        if not med_id:
+            logger.error('Medication could not be created, skipping row')
+            return None
+        if journal:
+            journal.record(n_input, client.ResourceEnum.MEDICATION, med_id)
+
+    proc_id = created.get(client.ResourceEnum.PROCEDURE)
+    if not proc_id:
+        try:
+            proc_json = _resource_json(proc, fast_json)
+        except Exception as e:
+            logger.error(f'Could not create Procedure resource: {e}')
+            return None
+
+        response = await fhir_client.post_json(proc_json, client.ResourceEnum.PROCEDURE, validate_flag=True)
+        proc_id = json.loads(response.text)['id']
+        if journal:
+            journal.record(n_input, client.ResourceEnum.PROCEDURE, proc_id)
+
+    med_stat.med_reference.id = med_id
+    med_stat.proc_reference.id = proc_id
+    try:
+        med_stat_json = _resource_json(med_stat, fast_json)
+    except Exception as e:
+        logger.error(f'Could not create MedicationStatement resource: {e}')
+        return None
+
+    response = await fhir_client.post_json(med_stat_json, client.ResourceEnum.MEDSTATEMENT, validate_flag=True)
+    med_stat_id = json.loads(response.text)['id']
+    if journal:
+        journal.record(n_input, client.ResourceEnum.MEDSTATEMENT, med_stat_id)
+
+    return med_stat_id
+
+
 def generate_and_post_medications(base_url, verification, coding_col_names, coding_display_col, extension_url,
                                   extension_system, extension_code, extension_display, meta_profile, ops_df):
     generator = medication_generator.MedicationGenerator(
@@ -159,11 +992,11 @@ def generate_and_post_procedure(base_url, verification, profile_url, status, cat
 
     vonk_client = client.FhirClient(base_url, verification)
     procedure_ids = []
-    n_rows = len(ops_df)
+    n_rows = generator_helpers.n_rows(ops_df)
     n_row = 0
     pat_id = json.loads(fhir_pat)['id']
 
-    for row in ops_df.iterrows():
+    for row in generator_helpers.iter_rows(ops_df):
 
         try:
             generated_procedure = proc_generator.generate(row[1], pat_id).to_fhir()
@@ -1,7 +1,27 @@
 import pandas as pd
-import random
+import numpy as np
 import datetime
+import os
+import threading
+from collections import OrderedDict
 from typing import List
+from fhirclient.models import fhirreference, fhirdate
+
+try:
+    from fhirclient.models import fhirdatetime
+except ImportError:
+    # fhirclient before 4.0 has no FHIRDateTime, its dateTime elements take a FHIRDate
+    fhirdatetime = None
+
+from medicationgenerator import client
+
+ARROW_FORMATS = {
+    '.parquet': 'parquet',
+    '.pq': 'parquet',
+    '.arrow': 'ipc',
+    '.feather': 'ipc',
+    '.ipc': 'ipc'
+}
 
 class OpsCsvReader:
     def __init__(self, file_path:str, encoding:str, usecols, subset):
@@ -22,25 +42,322 @@ class OpsCsvReader:
             self.data[col] = [str(x) for x in self.data[col]]
 
 
-class RandomDates:
-    def __init__(self):
-        pass
+class OpsCsvChunkReader:
+    # streaming variant of OpsCsvReader, the csv is read chunksize rows at a time and every chunk is preprocessed on
+    # its own, so memory stays constant for large files. comma_to_dot and as_str only register the columns, they are
+    # applied to each chunk while iterating
+    def __init__(self, file_path:str, encoding:str, usecols, subset, chunksize=100000):
+        if chunksize < 1:
+            raise ValueError(f'Invalid chunk size: {chunksize}')
+
+        self.path = file_path
+        self.encoding = encoding
+        self.usecols = usecols
+        self.subset = subset
+        self.chunksize = chunksize
+        self.comma_to_dot_cols = []
+        self.as_str_cols = []
+
+    def comma_to_dot(self, col_names:List[str]):
+        self.comma_to_dot_cols += col_names
+
+    def as_str(self, col_names:List[str]):
+        self.as_str_cols += col_names
+
+    def __iter__(self):
+        with pd.read_csv(self.path, encoding=self.encoding, usecols=self.usecols, dtype=str,
+                         chunksize=self.chunksize) as chunks:
+            for chunk in chunks:
+                chunk = chunk.dropna(subset=self.subset)
+                for col in self.comma_to_dot_cols:
+                    chunk[col] = chunk[col].str.replace(',', '.').astype(float)
+                for col in self.as_str_cols:
+                    chunk[col] = [str(x) for x in chunk[col]]
+                yield chunk
+
+
+def _pyarrow():
+    # pyarrow is optional and slow to import, so it is only imported by the Arrow readers
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.csv
+        import pyarrow.dataset
+    except ImportError:
+        raise ImportError('Reading with pyarrow needs the pyarrow package: pip install pyarrow')
+
+    return pyarrow
+
+
+def _arrow_dataset(file_path, encoding, usecols, file_format=None):
+    # csv is read by pyarrow's multithreaded reader, all columns as strings like OpsCsvReader. Empty fields are null,
+    # as they are NaN for pandas
+    pyarrow = _pyarrow()
+    file_format = file_format or ARROW_FORMATS.get(os.path.splitext(file_path)[1].lower(), 'csv')
+    if file_format == 'csv':
+        read_options = pyarrow.csv.ReadOptions(encoding=encoding)
+        if usecols is None:
+            # all columns, their names are read from the header
+            usecols = pyarrow.dataset.dataset(file_path, format=pyarrow.dataset.CsvFileFormat(
+                read_options=read_options)).schema.names
+        file_format = pyarrow.dataset.CsvFileFormat(
+            read_options=read_options,
+            convert_options=pyarrow.csv.ConvertOptions(column_types={col: pyarrow.string() for col in usecols},
+                                                       strings_can_be_null=True)
+        )
+
+    return pyarrow.dataset.dataset(file_path, format=file_format)
+
+
+def _arrow_columns(dataset, usecols):
+    # usecols=None reads all columns, as for pd.read_csv
+    return dataset.schema.names if usecols is None else list(usecols)
+
+
+def _arrow_not_null(subset, columns):
+    # same rows as dropna(subset=subset), evaluated by the reader. subset=None checks all columns
+    pyarrow = _pyarrow()
+    not_null = None
+    for col in columns if subset is None else subset:
+        col_valid = pyarrow.dataset.field(col).is_valid()
+        not_null = col_valid if not_null is None else not_null & col_valid
+
+    return not_null
+
+
+def _arrow_comma_to_dot(table, col):
+    # string columns with decimal commas are converted in Arrow, numeric columns of Parquet/Arrow files are kept
+    pyarrow = _pyarrow()
+    column = table[col]
+    if not pyarrow.types.is_floating(column.type) and not pyarrow.types.is_integer(column.type):
+        column = pyarrow.compute.replace_substring(column.cast(pyarrow.string()), ',', '.')
+    column = column.cast(pyarrow.float64())
+
+    return table.set_column(table.schema.get_field_index(col), col, column)
+
+
+def _arrow_as_str(table, col):
+    # missing values become 'nan', as str(x) of a NaN does in OpsCsvReader
+    pyarrow = _pyarrow()
+    column = pyarrow.compute.fill_null(table[col].cast(pyarrow.string()), 'nan')
+    return table.set_column(table.schema.get_field_index(col), col, column)
+
+
+class OpsArrowReader:
+    # OpsCsvReader for csv (pyarrow's multithreaded reader), Parquet and Arrow IPC files, the format is taken from the
+    # file extension. Only usecols are read and the rows with nulls in subset are dropped by the reader,
+    # comma_to_dot and as_str are applied to the Arrow table and data is converted to a DataFrame when it is read
+    def __init__(self, file_path:str, encoding:str, usecols, subset, file_format=None):
+        dataset = _arrow_dataset(file_path, encoding, usecols, file_format)
+        # pandas metadata of a file written from a DataFrame would restore the original dtypes in to_pandas()
+        columns = _arrow_columns(dataset, usecols)
+        self.table = dataset.to_table(columns=columns, filter=_arrow_not_null(subset, columns)).replace_schema_metadata()
+        self.path = file_path
+        self.encoding = encoding
+        self.__data = None
+
+    @property
+    def data(self) -> pd.DataFrame:
+        if self.__data is None:
+            self.__data = self.table.to_pandas()
+        return self.__data
+
+    def comma_to_dot(self, col_names:List[str]):
+        for col in col_names:
+            self.table = _arrow_comma_to_dot(self.table, col)
+        self.__data = None
+
+    def as_str(self, col_names:List[str]):
+        for col in col_names:
+            self.table = _arrow_as_str(self.table, col)
+        self.__data = None
+
+
+class OpsArrowChunkReader:
+    # streaming variant of OpsArrowReader like OpsCsvChunkReader, the record batches of the file are converted to
+    # DataFrames of at most chunksize rows
+    def __init__(self, file_path:str, encoding:str, usecols, subset, chunksize=100000, file_format=None):
+        if chunksize < 1:
+            raise ValueError(f'Invalid chunk size: {chunksize}')
+
+        self.path = file_path
+        self.encoding = encoding
+        self.usecols = usecols
+        self.subset = subset
+        self.chunksize = chunksize
+        self.file_format = file_format
+        self.comma_to_dot_cols = []
+        self.as_str_cols = []
+
+    def comma_to_dot(self, col_names:List[str]):
+        self.comma_to_dot_cols += col_names
+
+    def as_str(self, col_names:List[str]):
+        self.as_str_cols += col_names
+
+    def __iter__(self):
+        pyarrow = _pyarrow()
+        dataset = _arrow_dataset(self.path, self.encoding, self.usecols, self.file_format)
+        columns = _arrow_columns(dataset, self.usecols)
+        batches = dataset.to_batches(columns=columns, filter=_arrow_not_null(self.subset, columns),
+                                     batch_size=self.chunksize)
+        for batch in batches:
+            if not batch.num_rows:
+                continue
+            table = pyarrow.Table.from_batches([batch]).replace_schema_metadata()
+            for col in self.comma_to_dot_cols:
+                table = _arrow_comma_to_dot(table, col)
+            for col in self.as_str_cols:
+                table = _arrow_as_str(table, col)
+            yield table.to_pandas()
+
+
+def iter_chunks(ops_data):
+    # the generate functions take either a DataFrame or an OpsCsvChunkReader, a DataFrame is a single chunk
+    if isinstance(ops_data, pd.DataFrame):
+        yield ops_data
+    else:
+        yield from ops_data
+
+
+def iter_rows(ops_data):
+    for chunk in iter_chunks(ops_data):
+        yield from chunk.iterrows()
+
+
+def n_rows(ops_data):
+    # the number of rows of a streamed csv is unknown until it was read completely, a MappingIndex knows it
+    if isinstance(ops_data, pd.DataFrame):
+        return len(ops_data)
+
+    return getattr(ops_data, 'n_rows', '?')
+
+
+def json_object(**items):
+    # builds the dict fhirclient's as_json() would create, keyword order is kept, None values and empty lists are skipped
+    return {key: value for key, value in items.items() if value is not None and value != []}
+
+
+def fhir_datetime(value):
+    # the value of a dateTime element, recent fhirclient versions reject a FHIRDate in as_json()
+    fhir_date = fhirdatetime.FHIRDateTime() if fhirdatetime else fhirdate.FHIRDate()
+    fhir_date.date = value
+
+    return fhir_date
+
+
+def date_json(value):
+    if hasattr(value, 'as_json'):
+        return value.as_json()
+
+    return value.isoformat()
+
+
+class Reference:
+    # reference of a MedicationStatement/Procedure to another resource, the id may be set later when the
+    # referenced resource was created
+    __slots__ = ('id', 'resource_type')
+
+    def __init__(self, id, resource_type: client.ResourceEnum):
+        self.id = id
+        self.resource_type = resource_type
+
+    def to_fhir(self):
+        fhir_reference = fhirreference.FHIRReference()
+        # resources inside the same Bundle are referenced by their fullUrl
+        if str(self.id).startswith('urn:uuid:'):
+            fhir_reference.reference = self.id
+        else:
+            fhir_reference.reference = f'{self.resource_type.value}/{self.id}'
+
+        return fhir_reference
+
+    def to_json(self):
+        if str(self.id).startswith('urn:uuid:'):
+            return json_object(reference=self.id)
+
+        return json_object(reference=f'{self.resource_type.value}/{self.id}')
+
+
+# fragments kept per generator, e.g. one per OPS code
+FRAGMENT_CACHE_SIZE = 10000
+
+
+class SharedFragment:
+    # fragment of a resource that is shared by many resources and never changed, its JSON is built once. Attributes
+    # are read from the wrapped fragment
+    __slots__ = ('fragment', 'json')
+
+    def __init__(self, fragment):
+        self.fragment = fragment
+        self.json = fragment.to_json()
+
+    def __getattr__(self, name):
+        return getattr(self.fragment, name)
+
+    def to_fhir(self):
+        return self.fragment.to_fhir()
+
+    def to_json(self):
+        return self.json
+
+
+class FragmentCache:
+    # bounded LRU cache of the fragments that repeat across rows, keyed by the row values they are built from.
+    # maxsize 0 disables the cache
+    def __init__(self, maxsize=FRAGMENT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.fragments = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, factory):
+        # factory builds the fragment if the key is not cached, its exceptions are passed on and nothing is cached
+        if not self.maxsize:
+            return factory()
+
+        with self.lock:
+            fragment = self.fragments.get(key)
+            if fragment is not None:
+                self.fragments.move_to_end(key)
+                self.hits += 1
+                return fragment
+
+        fragment = SharedFragment(factory())
+        with self.lock:
+            self.misses += 1
+            self.fragments[key] = fragment
+            if len(self.fragments) > self.maxsize:
+                self.fragments.popitem(last=False)
+
+        return fragment
+
 
-    def next(self):
-        day = self.random_day()
-        month = self.random_month()
-        year = random.randint(1915, 2019)
-        return datetime.date(year, month, day)
+class DateGenerator:
+    # draws uniformly distributed dates between start and end (all days of a month are possible) in whole arrays.
+    # The stream is reproducible from seed, shard and stream select independent streams of the same seed, e.g. one per
+    # worker process and one per generator
+    def __init__(self, seed=None, shard=0, stream=0, start=datetime.date(1915, 1, 1), end=datetime.date(2019, 12, 31),
+                 buffer_size=1024):
+        if end < start:
+            raise ValueError(f'Invalid date range: {start} - {end}')
 
-    def random_month(self):
-        self.rand_month = random.randint(1, 12)
-        return self.rand_month
+        self.rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(shard, stream)))
+        self.start = np.datetime64(start, 'D')
+        self.n_days = (end - start).days + 1
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.lock = threading.Lock()
 
-    def random_day(self):
-        self.rand_day = random.randint(1, 27)
-        return self.rand_day
+    def dates(self, n) -> List[datetime.date]:
+        offsets = self.rng.integers(0, self.n_days, size=n)
+        return (self.start + offsets).tolist()
 
-    def add_leading_zero(self, digit):
-        if (len(digit) <= 1):
-            digit = "0" + digit
-        return digit
\ No newline at end of file
+    def next(self) -> datetime.date:
+        # single dates are taken from a buffered batch
+        with self.lock:
+            if not self.buffer:
+                self.buffer = self.dates(self.buffer_size)
+                self.buffer.reverse()
+            return self.buffer.pop()
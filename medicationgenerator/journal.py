@@ -0,0 +1,38 @@
+import logging
+
+from medicationgenerator import client, sqlite_store
+
+logger = logging.getLogger(__name__)
+
+# the Patient of a run is recorded under this row number
+PATIENT_ROW = -1
+
+
+class Journal(sqlite_store.SqliteStore):
+    # append-only SQLite record of the resources created for each input row (numbered from 0 over all chunks).
+    # A restarted run skips the rows whose MedicationStatement exists and reuses the Medication/Procedure ids of
+    # partially completed rows. Records are written in batches of commit_interval, so after a crash at most that
+    # many resources are created again.
+    def __init__(self, path, commit_interval=100):
+        super().__init__(path, [
+            'CREATE TABLE IF NOT EXISTS resources '
+            '(n_row INTEGER NOT NULL, resource_type TEXT NOT NULL, resource_id TEXT NOT NULL)',
+            'CREATE INDEX IF NOT EXISTS resources_row ON resources (n_row)'
+        ], commit_interval)
+
+        # rows after the last recorded one don't need a lookup
+        self.last_row = self.query('SELECT MAX(n_row) FROM resources')[0][0]
+        if self.last_row is not None:
+            logger.info(f'Resuming from journal {path}, last recorded row: {self.last_row}')
+
+    def get(self, n_row):
+        # returns the ids of the resources created for the row by resource type
+        if self.last_row is None or n_row > self.last_row:
+            return {}
+
+        records = self.query('SELECT resource_type, resource_id FROM resources WHERE n_row = ?', (n_row,))
+
+        return {client.ResourceEnum(resource_type): resource_id for resource_type, resource_id in records}
+
+    def record(self, n_row, resource_type: client.ResourceEnum, resource_id):
+        self.write('INSERT INTO resources VALUES (?, ?, ?)', (n_row, resource_type.value, resource_id))
@@ -0,0 +1,259 @@
+import json
+import logging
+import os
+
+import pandas as pd
+
+from medicationgenerator import generator_helpers
+from medicationgenerator import options as options_module
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+# version 2 holds the records of every OPS code, version 1 indexes (and their pickle fallback) are compiled again
+FORMAT_VERSION = 2
+ARROW_MAGIC = b'ARROW1'
+META_KEY = b'ops2fhir'
+CHUNKSIZE = 100000
+
+
+def _source_stat(file_path):
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _value(value):
+    # missing values are None in the records, numpy scalars become Python values so the records are JSON
+    if pd.isna(value):
+        return None
+
+    return value.item() if hasattr(value, 'item') else value
+
+
+def _record_cols(config: options_module.GeneratorConfig):
+    return {
+        'coding_cols': list(config.coding_col_names),
+        'display_col': config.coding_display_col,
+        'route_code_col': config.route_code_col,
+        'route_display_col': config.route_display_col,
+        'ops_text_col': config.ops_text_col,
+        'low_val_col': config.low_val_col,
+        'high_val_col': config.high_val_col,
+        'unit_code_col': config.unit_code_col,
+        'unit_col': config.unit_col
+    }
+
+
+class MappingRecord:
+    # the values of one mapped row of an OPS code that the resources are generated from: the ingredient codings by
+    # column name, the route, the dose range and its unit
+    __slots__ = ('codings', 'display', 'route_code', 'route_display', 'ops_text', 'low', 'high', 'unit_code', 'unit')
+
+    def __init__(self, codings, display, route_code, route_display, ops_text, low, high, unit_code, unit):
+        self.codings = codings
+        self.display = display
+        self.route_code = route_code
+        self.route_display = route_display
+        self.ops_text = ops_text
+        self.low = low
+        self.high = high
+        self.unit_code = unit_code
+        self.unit = unit
+
+    def to_json(self):
+        return [self.codings, self.display, self.route_code, self.route_display, self.ops_text, self.low, self.high,
+                self.unit_code, self.unit]
+
+    @staticmethod
+    def from_json(values):
+        return MappingRecord(*values)
+
+
+class MappingIndex:
+    # the preprocessed mapping table (dropna, comma_to_dot and as_str already applied) with the records and row
+    # positions of every OPS code. It is saved as Arrow IPC file, which stays memory-mapped when opened: the records
+    # are read from the file's metadata, the rows are only converted to DataFrames chunk by chunk when the index is
+    # iterated like an OpsCsvChunkReader or by rows(). Saving and opening an index needs pyarrow.
+    def __init__(self, data, ops_code_col, positions=None, records=None, settings=None, chunksize=CHUNKSIZE):
+        # data is the memory-mapped pyarrow Table of an opened index or the DataFrame of a compiled one
+        self.table = data if pyarrow is not None and isinstance(data, pyarrow.Table) else None
+        self.frame = None if self.table is not None else data
+        self.ops_code_col = ops_code_col
+        self.chunksize = chunksize
+        # the csv and reader settings the index was compiled from, a changed csv makes the index stale
+        self.settings = settings or {}
+        if positions is None:
+            positions = {code: rows.tolist() for code, rows in data.groupby(ops_code_col, sort=False).indices.items()}
+        self.positions = positions
+        self.records = records or {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, ops_code):
+        return ops_code in self.positions
+
+    @property
+    def n_rows(self):
+        return self.table.num_rows if self.table is not None else len(self.frame)
+
+    def lookup(self, ops_code):
+        # records of the OPS code, empty if the code is not mapped or the index was compiled without config
+        return self.records.get(ops_code, [])
+
+    def rows(self, ops_code) -> pd.DataFrame:
+        # rows of the OPS code, empty if the code is not mapped
+        positions = self.positions.get(ops_code, [])
+        if self.table is not None:
+            return self.table.take(positions).to_pandas()
+
+        return self.frame.iloc[positions]
+
+    def __iter__(self):
+        # DataFrames of at most chunksize rows, so the generate functions take the index like OpsCsvChunkReader
+        for start in range(0, self.n_rows, self.chunksize):
+            if self.table is not None:
+                yield self.table.slice(start, self.chunksize).to_pandas()
+            else:
+                yield self.frame.iloc[start:start + self.chunksize]
+
+    @property
+    def data(self) -> pd.DataFrame:
+        # the whole table as one DataFrame, e.g. for a PopulationGenerator, which samples from all rows
+        if self.frame is None:
+            self.frame = self.table.to_pandas()
+
+        return self.frame
+
+    @staticmethod
+    def compile(file_path, encoding, usecols, subset, ops_code_col, numerical_cols=(), str_cols=(), index_path=None,
+                config: options_module.GeneratorConfig = None):
+        # reads the csv like OpsCsvReader and saves the index to index_path, the records are compiled from the
+        # columns of config
+        ops_csv = generator_helpers.OpsCsvReader(file_path=file_path, encoding=encoding, usecols=usecols,
+                                                 subset=subset)
+        ops_csv.comma_to_dot(col_names=list(numerical_cols))
+        ops_csv.as_str(col_names=list(str_cols))
+
+        record_cols = _record_cols(config) if config else None
+        settings = {
+            'version': FORMAT_VERSION,
+            'file_path': os.path.abspath(file_path),
+            'encoding': encoding,
+            'usecols': list(usecols),
+            'subset': list(subset),
+            'ops_code_col': ops_code_col,
+            'numerical_cols': list(numerical_cols),
+            'str_cols': list(str_cols),
+            'record_cols': record_cols,
+            'source': _source_stat(file_path)
+        }
+        records = MappingIndex.__compile_records(ops_csv.data, ops_code_col, record_cols) if record_cols else None
+        mapping_index = MappingIndex(ops_csv.data, ops_code_col, records=records, settings=settings)
+        if index_path:
+            mapping_index.save(index_path)
+
+        return mapping_index
+
+    @staticmethod
+    def __compile_records(data, ops_code_col, record_cols):
+        cols = [ops_code_col, *record_cols['coding_cols']] + [record_cols[name] for name in (
+            'display_col', 'route_code_col', 'route_display_col', 'ops_text_col', 'low_val_col', 'high_val_col',
+            'unit_code_col', 'unit_col')]
+        n_codings = len(record_cols['coding_cols'])
+
+        records = {}
+        for values in data[cols].itertuples(index=False, name=None):
+            values = [_value(value) for value in values]
+            codings = dict(zip(record_cols['coding_cols'], values[1:1 + n_codings]))
+            record = MappingRecord(codings, *values[1 + n_codings:])
+            records.setdefault(values[0], []).append(record)
+
+        return records
+
+    def save(self, index_path):
+        if pyarrow is None:
+            raise Exception('pyarrow is required to save a mapping index')
+
+        meta = {
+            'version': FORMAT_VERSION,
+            'ops_code_col': self.ops_code_col,
+            'positions': self.positions,
+            'records': {code: [record.to_json() for record in records] for code, records in self.records.items()},
+            'settings': self.settings
+        }
+
+        # written to a temporary file first, so that workers never open half an index
+        temp_path = f'{index_path}.tmp'
+        table = self.table if self.table is not None else pyarrow.Table.from_pandas(self.frame, preserve_index=True)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), META_KEY: json.dumps(meta)})
+        with pyarrow.OSFile(temp_path, 'wb') as sink:
+            with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(temp_path, index_path)
+
+        logger.info(f'Saved mapping index with {len(self)} OPS codes and {self.n_rows} rows to {index_path}')
+
+    @staticmethod
+    def open(index_path, chunksize=CHUNKSIZE):
+        # only Arrow files written by save() are opened, the file is never unpickled or evaluated
+        with open(index_path, 'rb') as f:
+            if f.read(len(ARROW_MAGIC)) != ARROW_MAGIC:
+                raise ValueError(f'{index_path} is not a mapping index')
+        if pyarrow is None:
+            raise Exception(f'{index_path} is an Arrow file, pyarrow is required to open it')
+
+        with pyarrow.memory_map(index_path, 'r') as source:
+            table = pyarrow.ipc.open_file(source).read_all()
+        metadata = table.schema.metadata or {}
+        if META_KEY not in metadata:
+            raise ValueError(f'{index_path} is not a mapping index')
+        meta = json.loads(metadata[META_KEY])
+        if meta.get('version') != FORMAT_VERSION:
+            raise ValueError(f'{index_path} has format version {meta.get("version")}, expected {FORMAT_VERSION}')
+
+        records = {code: [MappingRecord.from_json(record) for record in code_records]
+                   for code, code_records in meta['records'].items()}
+        return MappingIndex(table, meta['ops_code_col'], positions=meta['positions'], records=records,
+                            settings=meta['settings'], chunksize=chunksize)
+
+    def is_current(self, file_path, encoding, usecols, subset, ops_code_col, numerical_cols=(), str_cols=(),
+                   config: options_module.GeneratorConfig = None):
+        settings = self.settings
+        try:
+            source = _source_stat(file_path)
+        except OSError:
+            return False
+
+        return (settings.get('version') == FORMAT_VERSION
+                and settings.get('file_path') == os.path.abspath(file_path)
+                and settings.get('encoding') == encoding
+                and settings.get('usecols') == list(usecols)
+                and settings.get('subset') == list(subset)
+                and settings.get('ops_code_col') == ops_code_col
+                and settings.get('numerical_cols') == list(numerical_cols)
+                and settings.get('str_cols') == list(str_cols)
+                and settings.get('record_cols') == (_record_cols(config) if config else None)
+                and settings.get('source') == source)
+
+    @staticmethod
+    def open_or_compile(index_path, file_path, encoding, usecols, subset, ops_code_col, numerical_cols=(),
+                        str_cols=(), config: options_module.GeneratorConfig = None):
+        # opens the index at index_path, it is compiled again if it is missing or the csv or the settings changed
+        if os.path.exists(index_path):
+            try:
+                mapping_index = MappingIndex.open(index_path)
+                if mapping_index.is_current(file_path, encoding, usecols, subset, ops_code_col, numerical_cols,
+                                            str_cols, config):
+                    return mapping_index
+                logger.info(f'Mapping index {index_path} is out of date')
+            except Exception as e:
+                logger.warning(f'Could not open mapping index {index_path}: {e}')
+
+        return MappingIndex.compile(file_path, encoding, usecols, subset, ops_code_col, numerical_cols, str_cols,
+                                    index_path=index_path, config=config)
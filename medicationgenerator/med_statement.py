@@ -5,22 +5,27 @@ import pandas as pd
 from fhirclient.models import (
     medicationstatement,
     meta,
-    fhirreference,
     dosage,
     codeableconcept,
     coding,
     range,
     quantity,
-    period,
-    fhirdate
+    period
 )
 
 from medicationgenerator import generator_helpers, client
+from medicationgenerator.generator_helpers import json_object, date_json, fhir_datetime, Reference, FragmentCache, \
+    FRAGMENT_CACHE_SIZE
 
 logger = logging.getLogger(__name__)
 
+# stream of the seed used for the MedicationStatement dates, the Procedure dates use another one
+DATE_STREAM = 1
+
 
 class RouteCoding:
+    __slots__ = ('system', 'code', 'display')
+
     def __init__(self, system, code, display):
         self.system = system
         self.code = code
@@ -34,8 +39,13 @@ class RouteCoding:
 
         return route_coding
 
+    def to_json(self):
+        return json_object(code=self.code, display=self.display, system=self.system)
+
 
 class RouteCodeableConcept:
+    __slots__ = ('coding',)
+
     def __init__(self, coding):
         self.coding = coding
 
@@ -45,8 +55,13 @@ class RouteCodeableConcept:
 
         return route_code
 
+    def to_json(self):
+        return json_object(coding=[route_coding.to_json() for route_coding in self.coding])
+
 
 class MedQuantity:
+    __slots__ = ('value', 'unit', 'system', 'code')
+
     def __init__(self, value, unit, system, code):
         self.value = value
         self.unit = unit
@@ -62,8 +77,13 @@ class MedQuantity:
 
         return med_quantity
 
+    def to_json(self):
+        return json_object(code=self.code, system=self.system, unit=self.unit, value=self.value)
+
 
 class MedDoseRange:
+    __slots__ = ('low', 'high')
+
     def __init__(self, low, high):
         self.low = low
         self.high = high
@@ -75,8 +95,13 @@ class MedDoseRange:
 
         return dose_range
 
+    def to_json(self):
+        return json_object(high=self.high.to_json(), low=self.low.to_json())
+
 
 class MedDoseAndRate:
+    __slots__ = ('quantity',)
+
     def __init__(self, quantity):
         self.quantity = quantity
 
@@ -91,8 +116,18 @@ class MedDoseAndRate:
 
         return dose_and_rate
 
+    def to_json(self):
+        if type(self.quantity) == MedQuantity:
+            return json_object(doseQuantity=self.quantity.to_json())
+        elif type(self.quantity) == MedDoseRange:
+            return json_object(doseRange=self.quantity.to_json())
+        else:
+            raise Exception('Wrong datatype for dose quantity')
+
 
 class MedDosage:
+    __slots__ = ('text', 'route', 'dose_and_rate')
+
     def __init__(self, ops_text, route_code, dose_and_rate):
         self.text = ops_text
         self.route = route_code
@@ -106,19 +141,30 @@ class MedDosage:
 
         return fhir_dosage
 
+    def to_json(self):
+        return json_object(
+            doseAndRate=[self.dose_and_rate.to_json()],
+            route=self.route.to_json(),
+            text=self.text
+        )
+
 
 class FhirDateTime:
+    __slots__ = ('random_date',)
+
     def __init__(self, random_date):
         self.random_date = random_date
 
     def to_fhir(self):
-        fhir_date = fhirdate.FHIRDate()
-        fhir_date.date = self.random_date
+        return fhir_datetime(self.random_date)
 
-        return fhir_date
+    def to_json(self):
+        return date_json(self.random_date)
 
 
 class EffectivePeriod:
+    __slots__ = ('start', 'end')
+
     def __init__(self, start, end):
         self.start = start
         self.end = end
@@ -130,22 +176,17 @@ class EffectivePeriod:
 
         return effective_period
 
-
-class Reference:
-    def __init__(self, id, resource_type: client.ResourceEnum):
-        self.id = id
-        self.resource_type = resource_type
-
-    def to_fhir(self):
-        fhir_reference = fhirreference.FHIRReference()
-        fhir_reference.reference = f'{self.resource_type.value}/{self.id}'
-
-        return fhir_reference
+    def to_json(self):
+        return json_object(
+            end=date_json(self.end) if self.end is not None else None,
+            start=date_json(self.start) if self.start is not None else None
+        )
 
 
 class MedStatementGenerator:
     def __init__(self, profile_url, status, route_system, route_code_col, route_display_col, ops_text_col,
-                 low_val_col, unit_code_col, unit_col, unit_system, high_val_col, ops_df: pd.DataFrame):
+                 low_val_col, unit_code_col, unit_col, unit_system, high_val_col, ops_df: pd.DataFrame, seed=None,
+                 shard=0, fragment_cache_size=FRAGMENT_CACHE_SIZE):
         self.profile_url = profile_url
         self.status = status
         self.route_system = route_system
@@ -160,19 +201,19 @@ class MedStatementGenerator:
 
         self.ops_df = ops_df
 
-        self.date_generator = generator_helpers.RandomDates()
+        self.date_generator = generator_helpers.DateGenerator(seed, shard=shard, stream=DATE_STREAM)
+        # the dosage only depends on the row values, so it is the same for every row of an OPS code
+        self.fragment_cache = FragmentCache(fragment_cache_size)
 
     def __iter__(self):
         self.n = 0
-        self.ops_df_iter = self.ops_df.iterrows()
+        self.ops_df_iter = generator_helpers.iter_rows(self.ops_df)
         return self
 
     def __next__(self):
-        if self.n >= len(self.ops_df):
-            raise StopIteration
-
+        row = next(self.ops_df_iter)[1]
         try:
-            result = self.generate(next(self.ops_df_iter)[1])
+            result = self.generate(row)
         except Exception as e:
             logger.warning(f'Failed to generate MedicationStatement: {e}')
             result = None
@@ -181,32 +222,47 @@ class MedStatementGenerator:
             return result
 
     def generate(self, row, med_id, pat_id, proc_id):
-        route_coding = self.__generate_route_coding(
-            row=row,
-            system=self.route_system,
-            code_col=self.route_code_col,
-            display_col=self.route_display_col
-        )
-        route_code = RouteCodeableConcept(route_coding)
-
-        dose_quantity = self.__generate_quantity(
-            row=row,
-            low_val_col=self.low_val_col,
-            unit_col=self.unit_col,
-            unit_system=self.unit_system,
-            unit_code_col=self.unit_code_col,
-            high_val_col=self.high_val_col
-        )
-        dose_and_rate = MedDoseAndRate(
-            quantity=dose_quantity
-        )
-
-        med_dosage = MedDosage(
+        return self.__generate(
+            route_code=row[self.route_code_col],
+            route_display=row[self.route_display_col],
             ops_text=row[self.ops_text_col],
-            route_code=route_code,
-            dose_and_rate=dose_and_rate
+            low_val=row[self.low_val_col],
+            unit=row[self.unit_col],
+            unit_code=row[self.unit_code_col],
+            high_val=row[self.high_val_col],
+            med_id=med_id,
+            pat_id=pat_id,
+            proc_id=proc_id
         )
 
+    def generate_batch(self, df: pd.DataFrame, med_ids=None, pat_id=None, proc_ids=None):
+        # column positions are resolved once and the rows are iterated as plain tuples instead of Series,
+        # med_ids and proc_ids are aligned with the rows and may be omitted to set the references later
+        cols = [self.route_code_col, self.route_display_col, self.ops_text_col, self.low_val_col, self.unit_col,
+                self.unit_code_col, self.high_val_col]
+        positions = [df.columns.get_loc(col) for col in cols]
+        n_rows = len(df)
+        med_ids = med_ids if med_ids is not None else [None] * n_rows
+        proc_ids = proc_ids if proc_ids is not None else [None] * n_rows
+        random_dates = self.date_generator.dates(n_rows)
+
+        for values, med_id, proc_id, random_date in zip(df.itertuples(index=False, name=None), med_ids, proc_ids,
+                                                        random_dates):
+            route_code, route_display, ops_text, low_val, unit, unit_code, high_val = [values[pos] for pos in positions]
+            try:
+                yield self.__generate(route_code, route_display, ops_text, low_val, unit, unit_code, high_val, med_id,
+                                      pat_id, proc_id, random_date)
+            except Exception as e:
+                logger.warning(f'Failed to generate MedicationStatement: {e}')
+                yield None
+
+    def __generate(self, route_code, route_display, ops_text, low_val, unit, unit_code, high_val, med_id, pat_id,
+                   proc_id, random_date=None):
+        # a missing high value is NaN, which never equals itself as key
+        key = (route_code, route_display, ops_text, low_val, unit, unit_code, None if pd.isnull(high_val) else high_val)
+        med_dosage = self.fragment_cache.get(key, lambda: self.__generate_dosage(
+            route_code, route_display, ops_text, low_val, unit, unit_code, high_val))
+
         med_reference = Reference(
             id=med_id,
             resource_type=client.ResourceEnum.MEDICATION
@@ -222,8 +278,8 @@ class MedStatementGenerator:
             resource_type=client.ResourceEnum.PATIENT
         )
 
-        # TODO: generate effective period, tmp datetime instead of period!!
-        random_date = self.date_generator.next()
+        if not random_date:
+            random_date = self.date_generator.next()
         fhir_date = FhirDateTime(random_date)
 
         med_statement = MedicationStatement(
@@ -238,45 +294,70 @@ class MedStatementGenerator:
 
         return med_statement
 
-    def __generate_route_coding(self, row, system, code_col, display_col) -> List[RouteCoding]:
+    def __generate_dosage(self, route_code, route_display, ops_text, low_val, unit, unit_code, high_val) -> MedDosage:
+        route_coding = self.__generate_route_coding(
+            system=self.route_system,
+            code=route_code,
+            display=route_display
+        )
+        route_code = RouteCodeableConcept(route_coding)
+
+        dose_quantity = self.__generate_quantity(
+            low_val=low_val,
+            unit=unit,
+            unit_system=self.unit_system,
+            unit_code=unit_code,
+            high_val=high_val
+        )
+        dose_and_rate = MedDoseAndRate(
+            quantity=dose_quantity
+        )
+
+        return MedDosage(
+            ops_text=ops_text,
+            route_code=route_code,
+            dose_and_rate=dose_and_rate
+        )
+
+    def __generate_route_coding(self, system, code, display) -> List[RouteCoding]:
 
         route_coding = RouteCoding(
             system=system,
-            code=str(row[code_col]),
-            display=str(row[display_col])
+            code=str(code),
+            display=str(display)
         )
 
         return [route_coding]
 
-    def __generate_quantity(self, row, low_val_col, unit_col, unit_system, unit_code_col, high_val_col):
+    def __generate_quantity(self, low_val, unit, unit_system, unit_code, high_val):
 
-        if not row[low_val_col]:
+        if not low_val:
             raise Exception(f'Missing value for dose quantity')
-        elif not row[unit_code_col]:
+        elif not unit_code:
             raise Exception(f'Missing code for dose quantity')
-        elif not row[unit_col]:
+        elif not unit:
             raise Exception(f'Missing unit for dose quantity')
 
         dose_quantity = MedQuantity(
-            value=row[low_val_col],
-            unit=row[unit_col],
+            value=low_val,
+            unit=unit,
             system=unit_system,
-            code=row[unit_code_col]
+            code=unit_code
         )
 
-        if not (pd.isnull(row[high_val_col])):
+        if not (pd.isnull(high_val)):
             low = dose_quantity
-            if not isinstance(row[unit_col], str):
+            if not isinstance(unit, str):
                 raise Exception('Unit has wrong data type')
 
-            if not isinstance(row[unit_code_col], str):
+            if not isinstance(unit_code, str):
                 raise Exception('Unit code has wrong data type')
 
             high = MedQuantity(
-                value=row[high_val_col],
-                unit=row[unit_col],
+                value=high_val,
+                unit=unit,
                 system=unit_system,
-                code=row[unit_code_col]
+                code=unit_code
             )
             dose_quantity = MedDoseRange(
                 low=low,
@@ -303,6 +384,8 @@ class MedStatementGenerator:
 
 
 class MedicationStatement:
+    __slots__ = ('profile_url', 'status', 'med_reference', 'proc_reference', 'pat_reference', 'timestamp', 'dosage')
+
     def __init__(self, profile_url, status, med_reference, proc_reference, pat_reference, timestamp, dosage):
         self.profile_url = profile_url
         self.status = status
@@ -322,7 +405,6 @@ class MedicationStatement:
         fhir_med_statement.status = self.status
 
         # References
-        # TODO: some of the references may be optional!!
         fhir_med_statement.medicationReference = self.med_reference.to_fhir()
         fhir_med_statement.subject = self.pat_reference.to_fhir()
         fhir_med_statement.partOf = [self.proc_reference.to_fhir()]
@@ -335,3 +417,20 @@ class MedicationStatement:
         fhir_med_statement.dosage = [self.dosage.to_fhir()]
 
         return fhir_med_statement
+
+    def to_json(self):
+        # same dict as to_fhir().as_json() without building the fhirclient models
+        effective_date_time = self.timestamp.to_json() if type(self.timestamp) == FhirDateTime else None
+        effective_period = self.timestamp.to_json() if type(self.timestamp) == EffectivePeriod else None
+
+        return json_object(
+            meta=json_object(profile=[self.profile_url]),
+            dosage=[self.dosage.to_json()],
+            effectiveDateTime=effective_date_time,
+            effectivePeriod=effective_period,
+            medicationReference=self.med_reference.to_json(),
+            partOf=[self.proc_reference.to_json()],
+            status=self.status,
+            subject=self.pat_reference.to_json(),
+            resourceType='MedicationStatement'
+        )
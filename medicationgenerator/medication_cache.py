@@ -0,0 +1,86 @@
+import logging
+import threading
+from concurrent.futures import Future
+
+from medicationgenerator import medication_generator
+
+logger = logging.getLogger(__name__)
+
+SEARCH_PARAM_INGREDIENT_CODE = 'ingredient-code'
+
+
+class MedicationCache:
+    # maps the ingredient codings of a Medication to its id, which is either the server id or the fullUrl of a
+    # pending Bundle entry until the Bundle response has been read
+    def __init__(self):
+        self.ids = {}
+        self.hits = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(med: medication_generator.Medication):
+        codings = med.ingredient.codeable_concept.coding
+        return tuple((ingredient_coding.system, ingredient_coding.code) for ingredient_coding in codings)
+
+    @staticmethod
+    def if_none_exist(med: medication_generator.Medication):
+        # repeated search parameters are combined with AND, so all ingredient codes have to match
+        codings = med.ingredient.codeable_concept.coding
+        return '&'.join(f'{SEARCH_PARAM_INGREDIENT_CODE}={ingredient_coding.system}|{ingredient_coding.code}'
+                        for ingredient_coding in codings)
+
+    def get(self, med: medication_generator.Medication):
+        med_id = self.ids.get(self.key(med))
+        if med_id:
+            self.hits += 1
+
+        return med_id
+
+    def add(self, med: medication_generator.Medication, med_id):
+        self.ids[self.key(med)] = med_id
+
+    def invalidate(self, key):
+        # drops the id of a Medication that could not be created, the next row with it posts it again
+        with self.lock:
+            self.ids.pop(key, None)
+
+    def resolve(self, full_url_ids):
+        # replace pending fullUrls with the ids from the Bundle response, entries that failed are dropped
+        for key, med_id in list(self.ids.items()):
+            if med_id not in full_url_ids:
+                continue
+
+            if full_url_ids[med_id]:
+                self.ids[key] = full_url_ids[med_id]
+            else:
+                logger.warning(f'Medication {key} could not be created, removing it from the cache')
+                del self.ids[key]
+
+    def get_or_create(self, med: medication_generator.Medication, create_func):
+        # thread-safe lookup, concurrent callers for the same Medication wait for the first creation
+        key = self.key(med)
+        with self.lock:
+            med_id = self.ids.get(key)
+            if med_id is None:
+                pending = Future()
+                self.ids[key] = pending
+            else:
+                self.hits += 1
+
+        if isinstance(med_id, Future):
+            return med_id.result()
+        elif med_id is not None:
+            return med_id
+
+        med_id = None
+        try:
+            med_id = create_func(self.if_none_exist(med))
+        finally:
+            with self.lock:
+                if med_id:
+                    self.ids[key] = med_id
+                else:
+                    del self.ids[key]
+            pending.set_result(med_id)
+
+        return med_id
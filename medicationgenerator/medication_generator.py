@@ -10,6 +10,9 @@ from fhirclient.models import (
     codeableconcept
 )
 
+from medicationgenerator.generator_helpers import json_object, iter_chunks, FragmentCache, SharedFragment, \
+    FRAGMENT_CACHE_SIZE
+
 SYSTEM_UNII = 'http://fdasis.nlm.nih.gov'
 SYSTEM_ASK = 'http://fhir.de/CodeSystem/ask'
 SYSTEM_CAS = 'urn:oid:2.16.840.1.113883.6.61'
@@ -17,6 +20,8 @@ SYSTEM_CAS = 'urn:oid:2.16.840.1.113883.6.61'
 logger = logging.getLogger(__name__)
 
 class MedIngredient:
+    __slots__ = ('codeable_concept', 'extension')
+
     def __init__(self, codeable_concept, ext):
         self.codeable_concept = codeable_concept
         self.extension = ext
@@ -29,8 +34,16 @@ class MedIngredient:
 
         return fhir_med_ingredient
 
+    def to_json(self):
+        return json_object(
+            extension=[self.extension.to_json()],
+            itemCodeableConcept=self.codeable_concept.to_json()
+        )
+
 
 class IngredientCodeableConcept:
+    __slots__ = ('coding',)
+
     def __init__(self, coding):
         self.coding = coding
 
@@ -40,8 +53,13 @@ class IngredientCodeableConcept:
 
         return ingredient_codeable_concept
 
+    def to_json(self):
+        return json_object(coding=[code.to_json() for code in self.coding])
+
 
 class IngredientExtension:
+    __slots__ = ('url', 'coding_system', 'coding_code', 'coding_display')
+
     def __init__(self, url, coding_system, coding_code, coding_display):
         self.url = url
         self.coding_system = coding_system
@@ -61,8 +79,16 @@ class IngredientExtension:
 
         return ingredient_extension
 
+    def to_json(self):
+        return json_object(
+            url=self.url,
+            valueCoding=json_object(code=self.coding_code, display=self.coding_display, system=self.coding_system)
+        )
+
 
 class IngredientCoding:
+    __slots__ = ('system', 'code', 'display')
+
     def __init__(self, system, code, display):
         self.system = system
         self.code = code
@@ -76,8 +102,13 @@ class IngredientCoding:
 
         return ingredient_coding
 
+    def to_json(self):
+        return json_object(code=self.code, display=self.display, system=self.system)
+
 
 class Medication:
+    __slots__ = ('meta_profile', 'ingredient')
+
     def __init__(self, meta_profile, ingredient):
         self.meta_profile = meta_profile
         self.ingredient = ingredient
@@ -93,10 +124,19 @@ class Medication:
 
         return fhir_medication
 
+    def to_json(self):
+        # same dict as to_fhir().as_json() without building the fhirclient models
+        return json_object(
+            meta=json_object(profile=[self.meta_profile]),
+            ingredient=[self.ingredient.to_json()],
+            resourceType='Medication'
+        )
+
 
 class MedicationGenerator:
     def __init__(self, coding_col_names: List[str], coding_display_col, extension_url, extension_system,
-                 extension_code, extension_display, meta_profile, ops_df: pd.DataFrame):
+                 extension_code, extension_display, meta_profile, ops_df: pd.DataFrame,
+                 fragment_cache_size=FRAGMENT_CACHE_SIZE):
         self.coding_col_names = coding_col_names
         self.coding_display_col = coding_display_col
         self.extension_url = extension_url
@@ -106,32 +146,53 @@ class MedicationGenerator:
         self.meta_profile = meta_profile
         self.ops_df = ops_df
 
+        self.coding_systems = [coding_system(col_name) for col_name in coding_col_names]
+
+        # the extension is the same for all Medications, the ingredient is cached per substance
+        self.ingredient_extension = SharedFragment(IngredientExtension(
+            url=extension_url,
+            coding_system=extension_system,
+            coding_code=extension_code,
+            coding_display=extension_display
+        ))
+        self.fragment_cache = FragmentCache(fragment_cache_size)
+
     def __iter__(self):
         self.n = 0
-        self.ops_df_iter = self.ops_df.iterrows()
+        self.ops_df_iter = (med for chunk in iter_chunks(self.ops_df) for med in self.generate_batch(chunk))
         return self
 
     def __next__(self):
-        if self.n >= len(self.ops_df):
-            raise StopIteration
-
-        try:
-            result = self.generate(next(self.ops_df_iter)[1])
-        except Exception as e:
-            logger.warning(f'Failed to generate Medication: {e}')
-            result = None
-        finally:
-            self.n += 1
-            return result
+        med = next(self.ops_df_iter)
+        self.n += 1
+        return med
 
     def generate(self, row):
+        return self.__generate(
+            display=row[self.coding_display_col],
+            codes=[row[col_name] for col_name in self.coding_col_names]
+        )
 
-        ingredient_ext = self.__generate_ingredient_extension()
-        ingredient_codings = self.__generate_ingredient_codings(row)
-
-        concept = IngredientCodeableConcept(coding=ingredient_codings)
-
-        med_ingredient = MedIngredient(codeable_concept=concept, ext=ingredient_ext)
+    def generate_batch(self, df: pd.DataFrame):
+        # column positions are resolved once and the rows are iterated as plain tuples instead of Series,
+        # yields one Medication per row or None if it could not be generated
+        display_pos = df.columns.get_loc(self.coding_display_col)
+        code_pos = [df.columns.get_loc(col_name) for col_name in self.coding_col_names]
+
+        for values in df.itertuples(index=False, name=None):
+            try:
+                yield self.__generate(
+                    display=values[display_pos],
+                    codes=[values[pos] for pos in code_pos]
+                )
+            except Exception as e:
+                logger.warning(f'Failed to generate Medication: {e}')
+                yield None
+
+    def __generate(self, display, codes):
+        # codes that are not strings are skipped, so they are all the same for the cache
+        key = (display, tuple(code if type(code) == str else None for code in codes))
+        med_ingredient = self.fragment_cache.get(key, lambda: self.__generate_ingredient(display, codes))
 
         med = Medication(
             meta_profile=self.meta_profile,
@@ -140,36 +201,24 @@ class MedicationGenerator:
 
         return med
 
-    def __generate_ingredient_extension(self) -> IngredientExtension:
-        ingredient_extension = IngredientExtension(
-            url=self.extension_url,
-            coding_system=self.extension_system,
-            coding_code=self.extension_code,
-            coding_display=self.extension_display
-        )
+    def __generate_ingredient(self, display, codes) -> MedIngredient:
+        ingredient_codings = self.__generate_ingredient_codings(display, codes)
 
-        return ingredient_extension
+        concept = IngredientCodeableConcept(coding=ingredient_codings)
+
+        return MedIngredient(codeable_concept=concept, ext=self.ingredient_extension)
 
-    def __generate_ingredient_codings(self, row) -> List[IngredientCoding]:
+    def __generate_ingredient_codings(self, display, codes) -> List[IngredientCoding]:
         ingredient_codings = []
 
-        display = row[self.coding_display_col]
         if display is None or type(display) != str:
             raise Exception('Display value not valid')
 
-        for col_name in self.coding_col_names:
-            code = row[col_name]
+        for system, code in zip(self.coding_systems, codes):
             if code is None or type(code) != str:
                 continue
 
-            col_name = col_name.lower()
-            if 'unii' in col_name:
-                system = SYSTEM_UNII
-            elif 'ask' in col_name:
-                system = SYSTEM_ASK
-            elif 'cas' in col_name:
-                system = SYSTEM_CAS
-            else:
+            if system is None:
                 raise ValueError('invalid system')
 
             ingredient_coding = IngredientCoding(
@@ -184,3 +233,16 @@ class MedicationGenerator:
             raise Exception('There are no values for ingredient codings')
 
         return ingredient_codings
+
+
+def coding_system(col_name):
+    # the code system of an ingredient coding is derived from the name of its column
+    col_name = col_name.lower()
+    if 'unii' in col_name:
+        return SYSTEM_UNII
+    elif 'ask' in col_name:
+        return SYSTEM_ASK
+    elif 'cas' in col_name:
+        return SYSTEM_CAS
+
+    return None
@@ -0,0 +1,326 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds, growing by factor 1.5 from 10us to ~110s
+BUCKETS = [1e-5 * 1.5 ** i for i in range(41)]
+PERCENTILES = (50, 90, 99)
+PROMETHEUS_PREFIX = 'ops2fhir'
+FORMAT_JSON = 'json'
+FORMAT_PROMETHEUS = 'prometheus'
+
+STAGE_READ = 'read'
+STAGE_GENERATE = 'generate'
+STAGE_TO_FHIR = 'to_fhir'
+STAGE_AS_JSON = 'as_json'
+STAGE_TO_JSON = 'to_json'
+STAGE_SERIALIZE = 'serialize'
+STAGE_VALIDATE = 'validate'
+STAGE_CREATE = 'create'
+STAGE_DELETE = 'delete'
+
+
+def _rss_bytes():
+    # current resident set size, /proc is only available on Linux, elsewhere the peak is used
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return None
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def percentile(self, percent):
+        # linear interpolation inside the bucket that holds the percentile
+        if not self.count:
+            return None
+
+        rank = self.count * percent / 100
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+                value = lower + (upper - lower) * (rank - seen) / bucket_count
+                return min(max(value, self.min), self.max)
+            seen += bucket_count
+
+        return self.max
+
+    def to_json(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            **{f'p{percent}': self.percentile(percent) for percent in PERCENTILES}
+        }
+
+
+class Metrics:
+    # stage timings (histograms per stage and resource type), event counters per resource type and periodic
+    # memory samples of a run. As context manager it samples every sample_interval seconds and exports to
+    # export_path (JSON or, for a .prom file, Prometheus text) on every sample and at the end.
+    def __init__(self, sample_interval=10.0, trace_memory=False, export_path=None):
+        self.sample_interval = sample_interval
+        self.trace_memory = trace_memory
+        self.export_path = export_path
+        self.histograms = {}
+        self.counters = {}
+        self.memory = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    def observe(self, stage, seconds, resource_type=None):
+        key = (stage, resource_type)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage, resource_type=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, resource_type)
+
+    def count(self, event, resource_type=None, n=1):
+        key = (event, resource_type)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def sample_memory(self):
+        sample = {'rss_bytes': _rss_bytes()}
+        if self.trace_memory and tracemalloc.is_tracing():
+            sample['traced_bytes'], sample['traced_peak_bytes'] = tracemalloc.get_traced_memory()
+
+        with self.lock:
+            self.memory = sample
+        return sample
+
+    def timed_chunks(self, ops_data):
+        # a DataFrame was read completely before the run
+        if isinstance(ops_data, pd.DataFrame):
+            return ops_data
+        return TimedChunks(ops_data, self)
+
+    def timed_generator(self, generator, resource_type):
+        return TimedGenerator(generator, self, resource_type)
+
+    def to_json(self):
+        self.sample_memory()
+        with self.lock:
+            return {
+                'elapsed_seconds': time.time() - self.started,
+                'stages': [
+                    {'stage': stage, 'resource_type': resource_type, **histogram.to_json()}
+                    for (stage, resource_type), histogram in sorted(self.histograms.items(), key=str)
+                ],
+                'counters': [
+                    {'event': event, 'resource_type': resource_type, 'count': count}
+                    for (event, resource_type), count in sorted(self.counters.items(), key=str)
+                ],
+                'memory': dict(self.memory)
+            }
+
+    def to_prometheus(self):
+        self.sample_memory()
+
+        def labels(**items):
+            return ','.join(f'{name}="{value}"' for name, value in items.items() if value is not None)
+
+        lines = [f'# TYPE {PROMETHEUS_PREFIX}_stage_seconds histogram']
+        with self.lock:
+            for (stage, resource_type), histogram in sorted(self.histograms.items(), key=str):
+                cumulative = 0
+                for bound, bucket_count in zip(BUCKETS + [float('inf')], histogram.counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else f'{bound:.6g}'
+                    lines.append(f'{PROMETHEUS_PREFIX}_stage_seconds_bucket'
+                                 f'{{{labels(stage=stage, resource_type=resource_type, le=le)}}} {cumulative}')
+                stage_labels = labels(stage=stage, resource_type=resource_type)
+                lines.append(f'{PROMETHEUS_PREFIX}_stage_seconds_sum{{{stage_labels}}} {histogram.sum}')
+                lines.append(f'{PROMETHEUS_PREFIX}_stage_seconds_count{{{stage_labels}}} {histogram.count}')
+
+            lines.append(f'# TYPE {PROMETHEUS_PREFIX}_events_total counter')
+            for (event, resource_type), count in sorted(self.counters.items(), key=str):
+                lines.append(f'{PROMETHEUS_PREFIX}_events_total'
+                             f'{{{labels(event=event, resource_type=resource_type)}}} {count}')
+
+            for name, value in self.memory.items():
+                if value is not None:
+                    lines.append(f'# TYPE {PROMETHEUS_PREFIX}_{name} gauge')
+                    lines.append(f'{PROMETHEUS_PREFIX}_{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path, export_format=None):
+        export_format = export_format or (FORMAT_PROMETHEUS if path.endswith('.prom') else FORMAT_JSON)
+        data = self.to_prometheus() if export_format == FORMAT_PROMETHEUS else json.dumps(self.to_json(), indent=2)
+
+        # written to a temporary file first, so that a scraper never reads half a file
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def __sample(self):
+        while not self.__stopped.wait(self.sample_interval):
+            self.sample_memory()
+            if self.export_path:
+                try:
+                    self.export(self.export_path)
+                except OSError as e:
+                    logger.warning(f'Could not export metrics to {self.export_path}: {e}')
+
+    def start(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.sample_interval:
+            self.__thread = threading.Thread(target=self.__sample, name='metrics-sampler', daemon=True)
+            self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__thread:
+            self.__thread.join()
+        if self.export_path:
+            self.export(self.export_path)
+        if self.trace_memory:
+            tracemalloc.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+class TimedChunks:
+    # records the time to read each chunk of a streamed input
+    def __init__(self, ops_data, metrics: Metrics):
+        self.ops_data = ops_data
+        self.metrics = metrics
+
+    def __iter__(self):
+        chunks = iter(self.ops_data)
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            self.metrics.observe(STAGE_READ, time.perf_counter() - start)
+            yield chunk
+
+
+class TimedGenerator:
+    # proxy of a Medication/Procedure/MedicationStatement generator that records the time of every generated
+    # resource and wraps the resources, so that their conversion to JSON is recorded as well
+    def __init__(self, generator, metrics: Metrics, resource_type):
+        self.generator = generator
+        self.metrics = metrics
+        self.resource_type = resource_type
+
+    def generate(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            resource = self.generator.generate(*args, **kwargs)
+        except Exception:
+            self.metrics.count('generate_error', self.resource_type.value)
+            raise
+        self.metrics.observe(STAGE_GENERATE, time.perf_counter() - start, self.resource_type.value)
+
+        return TimedResource(resource, self.metrics, self.resource_type)
+
+    def generate_batch(self, *args, **kwargs):
+        resources = self.generator.generate_batch(*args, **kwargs)
+        while True:
+            start = time.perf_counter()
+            try:
+                resource = next(resources)
+            except StopIteration:
+                return
+            if resource is None:
+                self.metrics.count('generate_error', self.resource_type.value)
+                yield None
+                continue
+            self.metrics.observe(STAGE_GENERATE, time.perf_counter() - start, self.resource_type.value)
+            yield TimedResource(resource, self.metrics, self.resource_type)
+
+    def __getattr__(self, name):
+        return getattr(self.generator, name)
+
+
+class TimedResource:
+    # attribute access is passed on to the generated resource, to_fhir, as_json and to_json are timed
+    def __init__(self, resource, metrics: Metrics, resource_type):
+        object.__setattr__(self, 'resource', resource)
+        object.__setattr__(self, 'metrics', metrics)
+        object.__setattr__(self, 'resource_type', resource_type)
+
+    def to_fhir(self):
+        with self.metrics.timer(STAGE_TO_FHIR, self.resource_type.value):
+            return TimedFhirResource(self.resource.to_fhir(), self.metrics, self.resource_type)
+
+    def to_json(self):
+        # fast_json builds the JSON directly, the time corresponds to to_fhir plus as_json
+        with self.metrics.timer(STAGE_TO_JSON, self.resource_type.value):
+            return self.resource.to_json()
+
+    def __getattr__(self, name):
+        return getattr(self.resource, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.resource, name, value)
+
+
+class TimedFhirResource:
+    def __init__(self, fhir_resource, metrics: Metrics, resource_type):
+        self.fhir_resource = fhir_resource
+        self.metrics = metrics
+        self.resource_type = resource_type
+
+    def as_json(self):
+        with self.metrics.timer(STAGE_AS_JSON, self.resource_type.value):
+            return self.fhir_resource.as_json()
+
+    def __getattr__(self, name):
+        return getattr(self.fhir_resource, name)
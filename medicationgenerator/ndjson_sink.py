@@ -0,0 +1,101 @@
+import datetime
+import gzip
+import json
+import logging
+import os
+
+from medicationgenerator import client
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZSTD = 'zstd'
+MANIFEST_FILE = 'manifest.json'
+
+FILE_EXTENSIONS = {
+    None: '.ndjson',
+    COMPRESSION_GZIP: '.ndjson.gz',
+    COMPRESSION_ZSTD: '.ndjson.zst'
+}
+
+
+class NdjsonSink:
+    # streams resources into one NDJSON file per resource type and writes a FHIR Bulk Data manifest on close,
+    # the files can be loaded with $import or into a data lake without a server in between
+    def __init__(self, output_dir, compression=None, base_url=None):
+        if compression not in FILE_EXTENSIONS:
+            raise ValueError(f'Invalid compression: {compression}')
+        if compression == COMPRESSION_ZSTD and zstandard is None:
+            raise ImportError('zstd compression needs the zstandard package: pip install zstandard')
+
+        self.output_dir = output_dir
+        self.compression = compression
+        # base url under which the files will be served, used for the urls in the manifest
+        self.base_url = base_url
+        self.files = {}
+        self.counts = {}
+
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def __file_name(self, resource_type: client.ResourceEnum):
+        return f'{resource_type.value}{FILE_EXTENSIONS[self.compression]}'
+
+    def __open(self, resource_type: client.ResourceEnum):
+        path = os.path.join(self.output_dir, self.__file_name(resource_type))
+        if self.compression == COMPRESSION_GZIP:
+            return gzip.open(path, 'wt', encoding='utf-8', compresslevel=6)
+        elif self.compression == COMPRESSION_ZSTD:
+            return zstandard.open(path, 'wt', encoding='utf-8')
+
+        return open(path, 'w', encoding='utf-8')
+
+    def write(self, resource_json, resource_type: client.ResourceEnum):
+        if resource_type not in self.files:
+            self.files[resource_type] = self.__open(resource_type)
+            self.counts[resource_type] = 0
+
+        self.files[resource_type].write(json.dumps(resource_json, separators=(',', ':'), ensure_ascii=False) + '\n')
+        self.counts[resource_type] += 1
+
+    def __url(self, resource_type: client.ResourceEnum):
+        file_name = self.__file_name(resource_type)
+        if self.base_url:
+            return f'{self.base_url.rstrip("/")}/{file_name}'
+
+        return 'file://' + os.path.abspath(os.path.join(self.output_dir, file_name))
+
+    def close(self):
+        for resource_file in self.files.values():
+            resource_file.close()
+
+        manifest = {
+            'transactionTime': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'request': self.base_url if self.base_url else self.output_dir,
+            'requiresAccessToken': False,
+            'output': [
+                {
+                    'type': resource_type.value,
+                    'url': self.__url(resource_type),
+                    'count': self.counts[resource_type]
+                }
+                for resource_type in self.files
+            ],
+            'error': []
+        }
+
+        with open(os.path.join(self.output_dir, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+
+        logger.info(f'Wrote {sum(self.counts.values())} resources to {self.output_dir}')
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
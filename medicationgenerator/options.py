@@ -0,0 +1,108 @@
+import copy
+
+from medicationgenerator import bundle, client
+
+
+class RunOptions:
+    # how the generate functions send the resources, the defaults post the resources of one row after the other.
+    #   transport: validation_policy, profile_validator, client_options (passed on to FhirClient, e.g. pool_maxsize,
+    #     max_retries, timeout or gzip_requests), metrics
+    #   mode: bundle_size/bundle_type (transaction or batch Bundles), post_workers/generate_workers/queue_size
+    #     (thread pools connected by bounded queues), client_ids (run id of client-assigned ids created with PUT),
+    #     sink (write NDJSON files instead of posting)
+    #   content: cache_medications (True, False or a shared MedicationCache), fast_json, seed and shard of the dates
+    #   resuming: journal
+    def __init__(self, bundle_size=None, bundle_type=bundle.BUNDLE_TRANSACTION, post_workers=None, generate_workers=1,
+                 queue_size=1000, client_ids=None, sink=None, journal=None, cache_medications=True, fast_json=False,
+                 seed=None, shard=0, validation_policy=None, profile_validator=None, client_options=None,
+                 metrics=None):
+        if bundle_type not in (bundle.BUNDLE_TRANSACTION, bundle.BUNDLE_BATCH):
+            raise ValueError(f'Invalid Bundle type: {bundle_type}')
+        if sink and journal:
+            raise ValueError('A journal can only be used when posting to a server')
+        if client_ids and (bundle_size or journal):
+            # repeating a run with the same client_ids updates the same resources, so it doesn't need a journal
+            raise ValueError('Client-assigned ids can not be combined with bundle_size or a journal')
+
+        self.bundle_size = bundle_size
+        self.bundle_type = bundle_type
+        self.post_workers = post_workers
+        self.generate_workers = generate_workers
+        self.queue_size = queue_size
+        self.client_ids = client_ids
+        self.sink = sink
+        self.journal = journal
+        self.cache_medications = cache_medications
+        self.fast_json = fast_json
+        self.seed = seed
+        self.shard = shard
+        self.validation_policy = validation_policy
+        self.profile_validator = profile_validator
+        self.client_options = client_options
+        self.metrics = metrics
+
+    def replace(self, **changes):
+        # copy with some options changed, e.g. the shard and sink of a worker process
+        options = copy.copy(self)
+        for name, value in changes.items():
+            if not hasattr(options, name):
+                raise ValueError(f'Unknown option: {name}')
+            setattr(options, name, value)
+
+        return options
+
+    def check_unsupported(self, mode, *names):
+        # for the modes that only post row by row
+        used = [name for name in names if getattr(self, name)]
+        if used:
+            raise ValueError(f'{mode} does not support {", ".join(used)}')
+
+    def fhir_client(self, base_url, verification) -> client.FhirClient:
+        return client.FhirClient(base_url, verification, validation_policy=self.validation_policy,
+                                 profile_validator=self.profile_validator, metrics=self.metrics,
+                                 **(self.client_options or {}))
+
+
+class GeneratorConfig:
+    # column names of the mapping table and the fixed values (profiles, systems, status, ...) of the generated
+    # Medication, Procedure and MedicationStatement resources, shared by all generate_and_post entry points
+    def __init__(self, coding_col_names, coding_display_col, extension_url, extension_system, extension_code,
+                 extension_display, med_profile, med_statement_profile, med_statement_status, route_system,
+                 route_code_col, route_display_col, ops_text_col, low_val_col, unit_code_col, unit_col, unit_system,
+                 high_val_col, procedure_profile, procedure_status, procedure_category_system,
+                 procedure_category_code, procedure_category_display, procedure_ops_system, procedure_ops_code,
+                 procedure_ops_version_col=None, procedure_ops_version=None, performed_start_col=None,
+                 performed_end_col=None):
+        self.coding_col_names = coding_col_names
+        self.coding_display_col = coding_display_col
+        self.extension_url = extension_url
+        self.extension_system = extension_system
+        self.extension_code = extension_code
+        self.extension_display = extension_display
+        self.med_profile = med_profile
+        self.med_statement_profile = med_statement_profile
+        self.med_statement_status = med_statement_status
+        self.route_system = route_system
+        self.route_code_col = route_code_col
+        self.route_display_col = route_display_col
+        self.ops_text_col = ops_text_col
+        self.low_val_col = low_val_col
+        self.unit_code_col = unit_code_col
+        self.unit_col = unit_col
+        self.unit_system = unit_system
+        self.high_val_col = high_val_col
+        self.procedure_profile = procedure_profile
+        self.procedure_status = procedure_status
+        self.procedure_category_system = procedure_category_system
+        self.procedure_category_code = procedure_category_code
+        self.procedure_category_display = procedure_category_display
+        self.procedure_ops_system = procedure_ops_system
+        self.procedure_ops_code = procedure_ops_code
+        self.procedure_ops_version_col = procedure_ops_version_col
+        self.procedure_ops_version = procedure_ops_version
+        self.performed_start_col = performed_start_col
+        self.performed_end_col = performed_end_col
+
+    def values(self):
+        # in the order of the arguments, e.g. for the settings hash of delta loading
+        return list(vars(self).values())
@@ -0,0 +1,131 @@
+import logging
+import queue
+import threading
+from typing import Callable, Iterable, List
+
+logger = logging.getLogger(__name__)
+
+# marks the end of the input of a stage
+_DONE = object()
+# timeout for blocking queue operations, so that workers notice when the pipeline was stopped
+_POLL_INTERVAL = 0.1
+
+
+class Stage:
+    # an expanding stage returns a list of items, which are passed on one by one
+    def __init__(self, name, func: Callable, n_workers=1, expand=False):
+        if n_workers < 1:
+            raise ValueError(f'Stage {name} needs at least one worker')
+
+        self.name = name
+        self.func = func
+        self.n_workers = n_workers
+        self.expand = expand
+
+
+class Pipeline:
+    # runs the items of a source through a chain of stages, each stage has its own worker threads and is connected to
+    # the next one by a bounded queue, so a slow stage blocks the previous ones instead of buffering everything.
+    # A stage function returns the item for the next stage or None to drop it.
+    def __init__(self, source: Iterable, stages: List[Stage], queue_size=1000):
+        if not stages:
+            raise ValueError('Pipeline needs at least one stage')
+
+        self.source = source
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.results = []
+        self.results_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.error = None
+
+        self.__remaining_workers = [stage.n_workers for stage in stages]
+        self.__remaining_lock = threading.Lock()
+
+    def __put(self, target_queue, item):
+        while not self.stopped.is_set():
+            try:
+                target_queue.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def __get(self, source_queue):
+        while not self.stopped.is_set():
+            try:
+                return source_queue.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+
+        return _DONE
+
+    def __fail(self, e):
+        if self.error is None:
+            self.error = e
+        self.stopped.set()
+
+    def __read(self):
+        try:
+            for item in self.source:
+                if not self.__put(self.queues[0], item):
+                    return
+        except Exception as e:
+            logger.error(f'Reading the pipeline input failed: {e}')
+            self.__fail(e)
+            return
+
+        for _ in range(self.stages[0].n_workers):
+            self.__put(self.queues[0], _DONE)
+
+    def __work(self, n_stage):
+        stage = self.stages[n_stage]
+        is_last = n_stage == len(self.stages) - 1
+
+        while True:
+            item = self.__get(self.queues[n_stage])
+            if item is _DONE:
+                break
+
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                logger.error(f'Stage {stage.name} failed: {e}')
+                self.__fail(e)
+                break
+
+            if result is None:
+                continue
+            results = result if stage.expand else [result]
+            if is_last:
+                with self.results_lock:
+                    self.results += results
+            elif not all(self.__put(self.queues[n_stage + 1], item) for item in results):
+                break
+
+        # the last worker of a stage signals the end of the input to all workers of the next stage
+        with self.__remaining_lock:
+            self.__remaining_workers[n_stage] -= 1
+            last_worker = self.__remaining_workers[n_stage] == 0
+
+        if last_worker and not is_last:
+            for _ in range(self.stages[n_stage + 1].n_workers):
+                self.__put(self.queues[n_stage + 1], _DONE)
+
+    def run(self):
+        threads = [threading.Thread(target=self.__read, name='pipeline-reader', daemon=True)]
+        for n_stage, stage in enumerate(self.stages):
+            threads += [threading.Thread(target=self.__work, args=(n_stage,), name=f'pipeline-{stage.name}-{i}',
+                                         daemon=True)
+                        for i in range(stage.n_workers)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+        return self.results
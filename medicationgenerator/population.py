@@ -0,0 +1,90 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from medicationgenerator import generate
+from medicationgenerator import options as options_module
+from patientgenerator import patient_generator
+
+logger = logging.getLogger(__name__)
+
+DISTRIBUTION_FIXED = 'fixed'
+DISTRIBUTION_POISSON = 'poisson'
+DISTRIBUTION_UNIFORM = 'uniform'
+
+
+class PopulationGenerator:
+    # yields n_patients synthetic Patients, each with a sample of rows of the mapping table. The number of rows per
+    # patient is drawn from distribution with mean rows_per_patient (uniform draws from 1..2*rows_per_patient-1),
+    # rows are sampled with replacement, weighted by weights_col if given. Patients and samples are reproducible
+    # from seed.
+    def __init__(self, ops_df: pd.DataFrame, patient_template, n_patients, rows_per_patient=5,
+                 distribution=DISTRIBUTION_POISSON, weights_col=None, seed=None):
+        if not isinstance(ops_df, pd.DataFrame):
+            raise ValueError('The population is sampled from a DataFrame, read the mapping table with OpsCsvReader')
+        if distribution not in (DISTRIBUTION_FIXED, DISTRIBUTION_POISSON, DISTRIBUTION_UNIFORM):
+            raise ValueError(f'Invalid distribution: {distribution}')
+        if rows_per_patient < 1:
+            raise ValueError(f'Invalid number of rows per patient: {rows_per_patient}')
+
+        self.ops_df = ops_df
+        self.n_patients = n_patients
+        self.rows_per_patient = rows_per_patient
+        self.distribution = distribution
+        self.seed = seed
+
+        self.weights = None
+        if weights_col:
+            weights = ops_df[weights_col].astype(float).to_numpy()
+            self.weights = weights / weights.sum()
+
+        self.patient_generator = patient_generator.PatientGenerator(patient_template, seed=seed)
+        self.rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return self.n_patients
+
+    def __n_rows(self):
+        if self.distribution == DISTRIBUTION_FIXED:
+            return int(self.rows_per_patient)
+        elif self.distribution == DISTRIBUTION_POISSON:
+            return int(self.rng.poisson(self.rows_per_patient))
+
+        return int(self.rng.integers(1, 2 * self.rows_per_patient))
+
+    def __iter__(self):
+        for _ in range(self.n_patients):
+            fhir_pat = self.patient_generator.generate()
+            positions = self.rng.choice(len(self.ops_df), size=self.__n_rows(), p=self.weights)
+            yield fhir_pat, self.ops_df.iloc[positions]
+
+
+def generate_and_post_population(base_url, verification, population: PopulationGenerator,
+                                 config: options_module.GeneratorConfig, options: options_module.RunOptions = None):
+    # posts the rows of all patients of the population through one client (or the sink of options), with one set of
+    # generators and one Medication cache, so every substance is only created once for all patients
+    options = options or options_module.RunOptions()
+    if options.journal:
+        # the journal resumes the rows of one Patient
+        raise ValueError('A population can not be loaded with a journal')
+    if options.seed is not None and population.seed is not None and options.seed != population.seed:
+        raise ValueError(f'The seed of the options ({options.seed}) differs from the seed of the population '
+                         f'({population.seed})')
+
+    def patients():
+        n_patient = 0
+        for fhir_pat, rows in population:
+            yield fhir_pat, rows
+
+            n_patient += 1
+            if n_patient % 1000 == 0:
+                logger.info(f'Generated {n_patient}/{len(population)} patients')
+
+    # the dates are reproducible from the seed of the population unless the options set one
+    if options.seed is None:
+        options = options.replace(seed=population.seed)
+    med_stat_ids = generate.generate_and_post_patients(base_url, verification, patients(), config, options=options)
+    logger.info(f'Generated {len(population)} patients with {len(med_stat_ids)} MedicationStatements')
+
+    return med_stat_ids
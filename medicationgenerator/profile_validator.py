@@ -0,0 +1,319 @@
+import json
+import logging
+import os
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+EXTENSION_KEYS = ('extension', 'modifierExtension')
+BINDING_REQUIRED = 'required'
+BINDING_EXTENSIBLE = 'extensible'
+
+
+def _issue(severity, code, diagnostics, expression):
+    return {
+        'severity': severity,
+        'code': code,
+        'diagnostics': diagnostics,
+        'expression': [expression]
+    }
+
+
+def _matches_pattern(value, pattern):
+    # pattern[x] requires every element of the pattern to be present, fixed[x] requires exact equality
+    if isinstance(pattern, dict):
+        if not isinstance(value, dict):
+            return False
+        return all(key in value and _matches_pattern(value[key], item) for key, item in pattern.items())
+    elif isinstance(pattern, list):
+        if not isinstance(value, list):
+            return False
+        return all(any(_matches_pattern(value_item, item) for value_item in value) for item in pattern)
+
+    return value == pattern
+
+
+class ValueSetIndex:
+    def __init__(self):
+        self.codes = {}
+        self.systems = {}
+        self.code_systems = {}
+
+    def add_code_system(self, code_system):
+        def concepts(concept_list):
+            for concept in concept_list:
+                yield concept['code']
+                yield from concepts(concept.get('concept', []))
+
+        if code_system.get('concept'):
+            self.code_systems[code_system['url']] = set(concepts(code_system['concept']))
+
+    def add_value_set(self, value_set):
+        def contains(contains_list):
+            for item in contains_list:
+                if 'code' in item:
+                    yield item.get('system'), item['code']
+                yield from contains(item.get('contains', []))
+
+        codes = set()
+        systems = set()
+        if 'expansion' in value_set:
+            codes.update(contains(value_set['expansion'].get('contains', [])))
+        for include in value_set.get('compose', {}).get('include', []):
+            system = include.get('system')
+            if include.get('concept'):
+                codes.update((system, concept['code']) for concept in include['concept'])
+            elif system:
+                systems.add(system)
+
+        self.codes[value_set['url']] = codes
+        self.systems[value_set['url']] = systems
+
+    def resolve(self):
+        # whole CodeSystem includes are expanded if the CodeSystem was loaded as well
+        for url, systems in self.systems.items():
+            for system in list(systems):
+                if system in self.code_systems:
+                    self.codes[url].update((system, code) for code in self.code_systems[system])
+                    systems.remove(system)
+
+    def __contains__(self, url):
+        return url in self.codes
+
+    def contains(self, url, system, code):
+        if system in self.systems[url]:
+            return True
+        if system is None:
+            return any(code == vs_code for _, vs_code in self.codes[url])
+
+        return (system, code) in self.codes[url]
+
+
+class ElementRule:
+    def __init__(self, path, parent_parts, part, min_card, max_card, fixed, pattern, binding_url, binding_strength):
+        self.path = path
+        self.parent_parts = parent_parts
+        self.part = part
+        self.min_card = min_card
+        self.max_card = max_card
+        self.fixed = fixed
+        self.pattern = pattern
+        self.binding_url = binding_url
+        self.binding_strength = binding_strength
+
+
+class ProfileValidator:
+    # in-process replacement for $validate, checks cardinality, fixed/pattern values and bindings of the loaded
+    # StructureDefinitions against the JSON of a resource
+    def __init__(self, definitions_dir):
+        self.definitions = {}
+        self.value_sets = ValueSetIndex()
+        self.rules = {}
+        self.__warned_value_sets = set()
+
+        self.__load(definitions_dir)
+        self.value_sets.resolve()
+
+    def __load(self, definitions_dir):
+        for root, _, files in os.walk(definitions_dir):
+            for file_name in sorted(files):
+                if not file_name.endswith('.json'):
+                    continue
+                with open(os.path.join(root, file_name), 'r', encoding='utf-8') as f:
+                    try:
+                        definition = json.load(f)
+                    except ValueError:
+                        logger.warning(f'Skipping invalid JSON file {file_name}')
+                        continue
+
+                if not isinstance(definition, dict):
+                    continue
+                resource_type = definition.get('resourceType')
+                if resource_type == 'StructureDefinition':
+                    self.definitions[definition['url']] = definition
+                elif resource_type == 'ValueSet':
+                    self.value_sets.add_value_set(definition)
+                elif resource_type == 'CodeSystem':
+                    self.value_sets.add_code_system(definition)
+
+        logger.info(f'Loaded {len(self.definitions)} StructureDefinitions and {len(self.value_sets.codes)} ValueSets '
+                    f'from {definitions_dir}')
+
+    def __elements(self, url):
+        # snapshots are self-contained, a differential is combined with the elements of its loaded base definitions
+        definition = self.definitions[url]
+        if 'snapshot' in definition:
+            return definition['snapshot']['element']
+
+        elements = list(definition.get('differential', {}).get('element', []))
+        base_url = definition.get('baseDefinition')
+        if base_url in self.definitions:
+            elements = self.__elements(base_url) + elements
+
+        return elements
+
+    def __compile(self, url) -> List[ElementRule]:
+        rules = []
+        extension_urls = {}
+
+        for element in self.__elements(url):
+            segments = element.get('id', element['path']).split('.')
+            if len(segments) < 2:
+                continue
+
+            parts = []
+            element_id = segments[0]
+            for segment in segments[1:]:
+                element_id = f'{element_id}.{segment}'
+                name, _, slice_name = segment.partition(':')
+                if slice_name and name.endswith('[x]'):
+                    parts.append(('key', slice_name))
+                elif slice_name and name in EXTENSION_KEYS:
+                    if element_id == element.get('id') and element.get('type'):
+                        profiles = element['type'][0].get('profile', [])
+                        if profiles:
+                            extension_urls[element_id] = profiles[0]
+                    if element_id not in extension_urls:
+                        parts = None
+                        break
+                    parts.append(('extension', name, extension_urls[element_id]))
+                elif slice_name:
+                    # other slicing discriminators are not supported
+                    parts = None
+                    break
+                elif name.endswith('[x]'):
+                    parts.append(('choice', name[:-3]))
+                else:
+                    parts.append(('key', name))
+
+            if not parts:
+                continue
+
+            fixed = pattern = None
+            for key, value in element.items():
+                if key.startswith('fixed'):
+                    fixed = value
+                elif key.startswith('pattern'):
+                    pattern = value
+
+            binding = element.get('binding', {})
+            binding_url = binding.get('valueSet', '').split('|')[0] or None
+
+            max_card = element.get('max', '*')
+            rules.append(ElementRule(
+                path=element.get('id', element['path']),
+                parent_parts=parts[:-1],
+                part=parts[-1],
+                min_card=element.get('min', 0),
+                max_card=None if max_card == '*' else int(max_card),
+                fixed=fixed,
+                pattern=pattern,
+                binding_url=binding_url,
+                binding_strength=binding.get('strength')
+            ))
+
+        return rules
+
+    def __rules(self, url):
+        if url not in self.rules:
+            self.rules[url] = self.__compile(url)
+
+        return self.rules[url]
+
+    @staticmethod
+    def __children(node, part):
+        if not isinstance(node, dict):
+            return []
+
+        if part[0] == 'key':
+            values = node.get(part[1])
+        elif part[0] == 'choice':
+            prefix = part[1]
+            values = [value for key, value in node.items()
+                      if key.startswith(prefix) and key[len(prefix):len(prefix) + 1].isupper()]
+            values = [item for value in values for item in (value if isinstance(value, list) else [value])]
+        else:
+            values = [ext for ext in node.get(part[1], []) if ext.get('url') == part[2]]
+
+        if values is None:
+            return []
+
+        return values if isinstance(values, list) else [values]
+
+    def __collect(self, resource_json, parts):
+        nodes = [resource_json]
+        for part in parts:
+            nodes = [child for node in nodes for child in self.__children(node, part)]
+
+        return nodes
+
+    def __check_binding(self, rule, value):
+        if rule.binding_url not in self.value_sets:
+            if rule.binding_url not in self.__warned_value_sets:
+                logger.warning(f'ValueSet {rule.binding_url} not loaded, skipping binding check')
+                self.__warned_value_sets.add(rule.binding_url)
+            return True
+
+        if isinstance(value, str):
+            return self.value_sets.contains(rule.binding_url, None, value)
+        elif isinstance(value, dict) and 'coding' in value:
+            return any(self.value_sets.contains(rule.binding_url, coding.get('system'), coding.get('code'))
+                       for coding in value['coding'])
+        elif isinstance(value, dict) and 'code' in value:
+            return self.value_sets.contains(rule.binding_url, value.get('system'), value['code'])
+
+        return True
+
+    def __validate_resource(self, resource_json, expression_prefix):
+        issues = []
+        profiles = resource_json.get('meta', {}).get('profile', [])
+        loaded_profiles = [profile for profile in profiles if profile in self.definitions]
+        if not loaded_profiles:
+            issues.append(_issue('warning', 'not-supported', f'No StructureDefinition loaded for {profiles}',
+                                 expression_prefix or resource_json.get('resourceType')))
+
+        for profile in loaded_profiles:
+            for rule in self.__rules(profile):
+                for parent in self.__collect(resource_json, rule.parent_parts):
+                    values = self.__children(parent, rule.part)
+                    expression = f'{expression_prefix}{rule.path}'
+
+                    if len(values) < rule.min_card or (rule.max_card is not None and len(values) > rule.max_card):
+                        issues.append(_issue('error', 'structure',
+                                             f'{rule.path}: found {len(values)} values, expected '
+                                             f'{rule.min_card}..{"*" if rule.max_card is None else rule.max_card}',
+                                             expression))
+
+                    for value in values:
+                        if rule.fixed is not None and value != rule.fixed:
+                            issues.append(_issue('error', 'value', f'{rule.path}: value does not match fixed value '
+                                                                   f'{json.dumps(rule.fixed)}', expression))
+                        if rule.pattern is not None and not _matches_pattern(value, rule.pattern):
+                            issues.append(_issue('error', 'value', f'{rule.path}: value does not match pattern '
+                                                                   f'{json.dumps(rule.pattern)}', expression))
+                        if rule.binding_strength in (BINDING_REQUIRED, BINDING_EXTENSIBLE) \
+                                and not self.__check_binding(rule, value):
+                            severity = 'error' if rule.binding_strength == BINDING_REQUIRED else 'warning'
+                            issues.append(_issue(severity, 'code-invalid',
+                                                 f'{rule.path}: code is not in ValueSet {rule.binding_url}',
+                                                 expression))
+
+        return issues
+
+    def validate(self, resource_json):
+        # returns an OperationOutcome like the $validate operation, Bundle entries are validated one by one
+        if resource_json.get('resourceType') == 'Bundle':
+            issues = []
+            for i, entry in enumerate(resource_json.get('entry', [])):
+                if 'resource' in entry:
+                    issues += self.__validate_resource(entry['resource'], f'Bundle.entry[{i}].resource.')
+        else:
+            issues = self.__validate_resource(resource_json, '')
+
+        if not issues:
+            issues.append(_issue('information', 'informational', 'No issues detected during validation', ''))
+
+        return {
+            'resourceType': 'OperationOutcome',
+            'issue': issues
+        }
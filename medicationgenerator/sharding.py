@@ -0,0 +1,251 @@
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+from fhirclient.models import patient
+
+from medicationgenerator import generate, generator_helpers, client, medication_cache
+from medicationgenerator import options as options_module
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+ARROW_FILE = 'ops.arrow'
+SPOOL_FILE = 'shard-{}.pickle'
+
+
+class ArrowShard:
+    # rows start:stop of an Arrow IPC file, the file is memory-mapped so the workers share the driver's copy
+    # and only the rows of the shard are converted to a DataFrame, chunksize rows at a time if it is set
+    def __init__(self, path, start, stop, chunksize=None):
+        self.path = path
+        self.start = start
+        self.stop = stop
+        self.chunksize = chunksize
+
+    def load(self):
+        if self.chunksize:
+            return self.__iter_chunks()
+
+        with pyarrow.memory_map(self.path, 'r') as source:
+            table = pyarrow.ipc.open_file(source).read_all()
+            return table.slice(self.start, self.stop - self.start).to_pandas()
+
+    def __iter_chunks(self):
+        with pyarrow.memory_map(self.path, 'r') as source:
+            table = pyarrow.ipc.open_file(source).read_all()
+            for start in range(self.start, self.stop, self.chunksize):
+                yield table.slice(start, min(self.chunksize, self.stop - start)).to_pandas()
+
+
+class FrameShard:
+    # fallback without pyarrow, the rows of the shard are pickled to the worker
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+
+    def load(self):
+        return self.df
+
+
+class SpooledShard:
+    # fallback without pyarrow for streamed input, the driver reads the csv once and pickles every n_shards-th
+    # chunk to the file of the shard
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+
+def _write_arrow(chunks, arrow_path):
+    # writes the chunks to one Arrow IPC file as they are read, returns the number of rows
+    n_rows = 0
+    writer = None
+    schema = None
+    with pyarrow.OSFile(arrow_path, 'wb') as sink_file:
+        try:
+            for chunk in chunks:
+                # the schema of the first chunk is kept, e.g. for a column that is empty in a later chunk
+                table = pyarrow.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+                if not writer:
+                    schema = table.schema
+                    writer = pyarrow.ipc.new_file(sink_file, schema)
+                writer.write_table(table)
+                n_rows += len(chunk)
+        finally:
+            if writer:
+                writer.close()
+
+    return n_rows
+
+
+def _write_spool(chunks, paths):
+    files = [open(path, 'wb') for path in paths]
+    try:
+        for n_chunk, chunk in enumerate(chunks):
+            pickle.dump(chunk, files[n_chunk % len(files)], protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        for f in files:
+            f.close()
+
+
+class CountingChunks:
+    def __init__(self, ops_data):
+        self.ops_data = ops_data
+        self.n_rows = 0
+
+    def __iter__(self):
+        for chunk in generator_helpers.iter_chunks(self.ops_data):
+            self.n_rows += len(chunk)
+            yield chunk
+
+
+class ShardedResult:
+    def __init__(self, med_stat_ids, n_rows, n_errors):
+        self.med_stat_ids = med_stat_ids
+        self.n_rows = n_rows
+        self.n_errors = n_errors
+
+
+class ShardSink:
+    # sink of the shards after the first one, the Patient is shared by all shards and only written by shard 0
+    def __init__(self, sink):
+        self.sink = sink
+
+    def write(self, resource_json, resource_type: client.ResourceEnum):
+        if resource_type != client.ResourceEnum.PATIENT:
+            self.sink.write(resource_json, resource_type)
+
+    def __getattr__(self, name):
+        return getattr(self.sink, name)
+
+
+def _run_shard(n_shard, shard, pat_json, sink_factory, base_url, verification, config, options):
+    ops_data = CountingChunks(shard.load())
+    sink = sink_factory(n_shard) if sink_factory else None
+    if sink and n_shard > 0:
+        sink = ShardSink(sink)
+    try:
+        # the shard number selects an independent date stream of the seed
+        med_stat_ids = generate.generate_and_post(base_url, verification, ops_data, patient.Patient(pat_json), config,
+                                                  options=options.replace(sink=sink, shard=n_shard))
+    finally:
+        if sink:
+            sink.close()
+
+    return n_shard, med_stat_ids, ops_data.n_rows
+
+
+def _shard_bounds(n_rows, n_shards):
+    bounds = [n_rows * i // n_shards for i in range(n_shards + 1)]
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def generate_and_post_sharded(base_url, verification, ops_df, fhir_pat, config: options_module.GeneratorConfig,
+                              n_shards=None, sink_factory=None, options: options_module.RunOptions = None):
+    # runs generate_and_post in a process pool, one shard of ops_df per process. ops_df is either a DataFrame or an
+    # OpsCsvChunkReader, which the driver reads once into a memory-mapped Arrow file that is split into contiguous
+    # row ranges (without pyarrow its chunks are spooled round-robin to one pickle file per shard).
+    # sink_factory is called with the shard number in each worker and returns the sink of that shard, it has to be
+    # picklable (e.g. functools.partial). config and options are passed on to generate_and_post.
+    options = options or options_module.RunOptions()
+    n_shards = n_shards or os.cpu_count()
+    if n_shards < 1:
+        raise ValueError(f'Invalid number of shards: {n_shards}')
+    if options.metrics:
+        # the metrics of a process can't be shared with the workers
+        raise ValueError('Metrics are recorded per process and can not be used with sharding')
+    if options.journal:
+        # a SQLite connection can't be pickled to the workers
+        raise ValueError('A journal can not be used with sharding')
+    if isinstance(options.cache_medications, medication_cache.MedicationCache):
+        # its lock can't be pickled and a copy per process would not be shared anyway, True gives each shard a cache
+        raise ValueError('A MedicationCache can not be shared by the shards, use cache_medications=True')
+    try:
+        pickle.dumps((config, options, sink_factory))
+    except Exception as e:
+        # fail before the Patient is created instead of in every worker
+        raise ValueError(f'The config, options and sink_factory have to be picklable for sharding: {e}')
+
+    # the Patient is created once by the driver (or written by shard 0 of a sink), so that all shards reference the
+    # same one
+    pat_json = fhir_pat.as_json()
+    if not fhir_pat.id:
+        if sink_factory:
+            pat_json['id'] = str(uuid.uuid4())
+        else:
+            fhir_client = options.fhir_client(base_url, verification)
+            response = fhir_client.post_resource(fhir_pat, client.ResourceEnum.PATIENT, validate_flag=True)
+            pat_json['id'] = client.resource_id(response)
+
+    temp_dir = tempfile.mkdtemp(prefix='ops2fhir-')
+    try:
+        if isinstance(ops_df, pd.DataFrame):
+            bounds = _shard_bounds(len(ops_df), n_shards)
+            if pyarrow is not None:
+                arrow_path = os.path.join(temp_dir, ARROW_FILE)
+                table = pyarrow.Table.from_pandas(ops_df, preserve_index=False)
+                with pyarrow.OSFile(arrow_path, 'wb') as sink_file:
+                    with pyarrow.ipc.new_file(sink_file, table.schema) as writer:
+                        writer.write_table(table)
+                shards = [ArrowShard(arrow_path, start, stop) for start, stop in bounds]
+            else:
+                logger.info('pyarrow is not installed, the shards are pickled to the worker processes')
+                shards = [FrameShard(ops_df.iloc[start:stop]) for start, stop in bounds]
+        elif pyarrow is not None:
+            arrow_path = os.path.join(temp_dir, ARROW_FILE)
+            n_input = _write_arrow(ops_df, arrow_path)
+            shards = [ArrowShard(arrow_path, start, stop, ops_df.chunksize)
+                      for start, stop in _shard_bounds(n_input, n_shards)]
+        else:
+            logger.info('pyarrow is not installed, the chunks are spooled to one pickle file per shard')
+            paths = [os.path.join(temp_dir, SPOOL_FILE.format(n_shard)) for n_shard in range(n_shards)]
+            _write_spool(ops_df, paths)
+            shards = [SpooledShard(path) for path in paths]
+
+        shard_results = {}
+        errors = []
+        with ProcessPoolExecutor(max_workers=len(shards)) as executor:
+            futures = [executor.submit(_run_shard, n_shard, shard, pat_json, sink_factory, base_url, verification,
+                                       config, options)
+                       for n_shard, shard in enumerate(shards)]
+            for future in as_completed(futures):
+                try:
+                    n_shard, med_stat_ids, n_rows = future.result()
+                except Exception as e:
+                    logger.error(f'Shard failed: {e}')
+                    errors.append(e)
+                    continue
+                shard_results[n_shard] = (med_stat_ids, n_rows)
+                logger.info(f'Shard {n_shard} finished: {len(med_stat_ids)}/{n_rows} rows')
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    if errors:
+        raise Exception(f'{len(errors)} of {len(shards)} shards failed, first error: {errors[0]}')
+
+    med_stat_ids = []
+    n_rows = 0
+    for n_shard in sorted(shard_results):
+        med_stat_ids += shard_results[n_shard][0]
+        n_rows += shard_results[n_shard][1]
+
+    n_errors = n_rows - len(med_stat_ids)
+    logger.info(f'Processed {len(med_stat_ids)}/{n_rows} rows in {len(shards)} shards, {n_errors} rows failed')
+
+    return ShardedResult(med_stat_ids, n_rows, n_errors)
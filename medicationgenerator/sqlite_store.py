@@ -0,0 +1,55 @@
+import sqlite3
+import threading
+
+
+class SqliteStore:
+    # SQLite file shared by the threads of a run (Journal, DeltaState). Writes are queued and committed in batches of
+    # commit_interval, so after a crash at most that many are lost.
+    def __init__(self, path, schema, commit_interval=100):
+        if commit_interval < 1:
+            raise ValueError(f'Invalid commit interval: {commit_interval}')
+
+        self.path = path
+        self.commit_interval = commit_interval
+        self.pending = []
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in schema:
+            self.connection.execute(statement)
+        self.connection.commit()
+
+    def query(self, statement, values=()):
+        with self.lock:
+            return self.connection.execute(statement, values).fetchall()
+
+    def write(self, statement, values):
+        with self.lock:
+            self.pending.append((statement, values))
+            if len(self.pending) >= self.commit_interval:
+                self._commit_pending()
+
+    def _commit_pending(self):
+        if not self.pending:
+            return
+
+        for statement, values in self.pending:
+            self.connection.execute(statement, values)
+        self.connection.commit()
+        self.pending = []
+
+    def flush(self):
+        with self.lock:
+            self._commit_pending()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,417 @@
+import argparse
+import gzip
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+logger = logging.getLogger(__name__)
+
+BASE_PATH = '/fhir'
+LATENCY_FIXED = 'fixed'
+LATENCY_UNIFORM = 'uniform'
+LATENCY_EXPONENTIAL = 'exponential'
+LATENCY_LOGNORMAL = 'lognormal'
+URN_UUID_PREFIX = 'urn:uuid:'
+
+
+def _outcome(severity, code, diagnostics):
+    return {
+        'resourceType': 'OperationOutcome',
+        'issue': [{'severity': severity, 'code': code, 'diagnostics': diagnostics}]
+    }
+
+
+def _replace_references(value, full_url_refs):
+    # replaces the urn:uuid references of a transaction with the assigned Type/id references
+    if isinstance(value, dict):
+        return {key: full_url_refs.get(item, item) if key == 'reference' and isinstance(item, str)
+                else _replace_references(item, full_url_refs)
+                for key, item in value.items()}
+    elif isinstance(value, list):
+        return [_replace_references(item, full_url_refs) for item in value]
+
+    return value
+
+
+class RequestError(Exception):
+    def __init__(self, status, outcome):
+        super().__init__(outcome['issue'][0]['diagnostics'])
+        self.status = status
+        self.outcome = outcome
+
+
+class ResourceStore:
+    # in-memory resources by type and id, the ids are assigned from one counter like a real server would
+    def __init__(self):
+        self.resources = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def search(self, resource_type, query):
+        # only the searches used by the conditional creates of this project are supported
+        params = parse_qsl(query)
+        with self.lock:
+            candidates = list(self.resources.get(resource_type, {}).values())
+
+        for resource in candidates:
+            if all(self.__matches(resource, name, value) for name, value in params):
+                return resource
+
+        return None
+
+    @staticmethod
+    def __matches(resource, name, value):
+        if name == '_id':
+            return resource.get('id') == value
+        if name == 'ingredient-code':
+            system, _, code = value.rpartition('|')
+            codings = [coding for ingredient in resource.get('ingredient', [])
+                       for coding in ingredient.get('itemCodeableConcept', {}).get('coding', [])]
+            return any(coding.get('code') == code and (not system or coding.get('system') == system)
+                       for coding in codings)
+
+        raise RequestError(400, _outcome('error', 'not-supported', f'Search parameter {name} is not supported'))
+
+    def create(self, resource_type, resource):
+        with self.lock:
+            resource = dict(resource, id=str(next(self.ids)))
+            resource['meta'] = dict(resource.get('meta', {}), versionId='1')
+            self.resources.setdefault(resource_type, {})[resource['id']] = resource
+
+        return resource
+
+    def update(self, resource_type, resource_id, resource):
+        with self.lock:
+            existing = self.resources.setdefault(resource_type, {}).get(resource_id)
+            version = int(existing['meta']['versionId']) + 1 if existing else 1
+            resource = dict(resource, id=resource_id)
+            resource['meta'] = dict(resource.get('meta', {}), versionId=str(version))
+            self.resources[resource_type][resource_id] = resource
+
+        return resource, existing is None
+
+    def delete(self, resource_type, resource_id):
+        with self.lock:
+            return self.resources.get(resource_type, {}).pop(resource_id, None) is not None
+
+    def restore(self, resource_type, resource_id, resource):
+        # puts back the version of a resource before a failed transaction changed it, None removes the resource
+        with self.lock:
+            resources = self.resources.setdefault(resource_type, {})
+            if resource is None:
+                resources.pop(resource_id, None)
+            else:
+                resources[resource_id] = resource
+
+    def read(self, resource_type, resource_id):
+        with self.lock:
+            return self.resources.get(resource_type, {}).get(resource_id)
+
+    def count(self, resource_type=None):
+        with self.lock:
+            if resource_type:
+                return len(self.resources.get(resource_type, {}))
+            return sum(len(resources) for resources in self.resources.values())
+
+
+class StubFhirHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def __send(self, status, body=None, headers=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/fhir+json; fhirVersion=4.0')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def __read_body(self):
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        if not data:
+            return None
+        try:
+            return json.loads(data)
+        except ValueError:
+            raise RequestError(400, _outcome('error', 'structure', 'Request body is not valid JSON'))
+
+    def __handle(self, method):
+        server = self.server.stub
+        try:
+            body = self.__read_body() if method in ('POST', 'PUT') else None
+        except RequestError as e:
+            return self.__send(e.status, e.outcome)
+
+        # injected failures are decided before the request is processed, like an overloaded server would
+        failure = server.failure()
+        server.sleep()
+        if failure == 429:
+            return self.__send(429, _outcome('error', 'throttled', 'Too many requests'),
+                               {'Retry-After': str(server.retry_after)})
+        elif failure == 500:
+            return self.__send(500, _outcome('fatal', 'exception', 'Injected server error'))
+
+        url = urlsplit(self.path)
+        path = url.path[len(BASE_PATH):] if url.path.startswith(BASE_PATH) else url.path
+        parts = [part for part in path.split('/') if part]
+
+        try:
+            status, response_body, headers = server.process(method, parts, body, self.headers)
+        except RequestError as e:
+            return self.__send(e.status, e.outcome)
+
+        server.count_request(method, parts)
+        self.__send(status, response_body, headers)
+
+    def do_GET(self):
+        self.__handle('GET')
+
+    def do_POST(self):
+        self.__handle('POST')
+
+    def do_PUT(self):
+        self.__handle('PUT')
+
+    def do_DELETE(self):
+        self.__handle('DELETE')
+
+
+class StubHttpServer(ThreadingHTTPServer):
+    # load tests open many connections at once, the default backlog of 5 would refuse some of them
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class StubFhirServer:
+    # standard library FHIR server for load and regression tests: POST/PUT/GET of resources, $validate,
+    # conditional create and batch/transaction Bundles. latency_ms is the mean latency added to every request,
+    # error_rate and throttle_rate are the fractions of requests answered with 500 and 429.
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0.0, latency_distribution=LATENCY_FIXED, error_rate=0.0,
+                 throttle_rate=0.0, retry_after=1, seed=None):
+        if latency_distribution not in (LATENCY_FIXED, LATENCY_UNIFORM, LATENCY_EXPONENTIAL, LATENCY_LOGNORMAL):
+            raise ValueError(f'Invalid latency distribution: {latency_distribution}')
+        if not 0 <= error_rate + throttle_rate <= 1:
+            raise ValueError(f'Invalid error/throttle rates: {error_rate}/{throttle_rate}')
+
+        self.latency_ms = latency_ms
+        self.latency_distribution = latency_distribution
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+
+        self.store = ResourceStore()
+        self.request_counts = {}
+        self.counts_lock = threading.Lock()
+
+        self.httpd = StubHttpServer((host, port), StubFhirHandler)
+        self.httpd.stub = self
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}{BASE_PATH}'
+
+    def failure(self):
+        with self.random_lock:
+            draw = self.random.random()
+
+        if draw < self.throttle_rate:
+            return 429
+        elif draw < self.throttle_rate + self.error_rate:
+            return 500
+
+        return None
+
+    def sleep(self):
+        if not self.latency_ms:
+            return
+
+        with self.random_lock:
+            if self.latency_distribution == LATENCY_FIXED:
+                latency = self.latency_ms
+            elif self.latency_distribution == LATENCY_UNIFORM:
+                latency = self.random.uniform(0, 2 * self.latency_ms)
+            elif self.latency_distribution == LATENCY_EXPONENTIAL:
+                latency = self.random.expovariate(1 / self.latency_ms)
+            else:
+                # sigma 0.5 gives a long tail, mu is chosen so that the mean is latency_ms
+                latency = self.random.lognormvariate(0, 0.5) * self.latency_ms / 1.1331
+
+        time.sleep(latency / 1000)
+
+    def count_request(self, method, parts):
+        key = f'{method} {"/".join(parts) or "/"}'
+        with self.counts_lock:
+            self.request_counts[key] = self.request_counts.get(key, 0) + 1
+
+    def process(self, method, parts, body, headers):
+        # returns status, response body and headers
+        if method == 'POST' and not parts:
+            return self.__process_bundle(body)
+        elif method == 'POST' and len(parts) == 2 and parts[1] == '$validate':
+            return 200, _outcome('information', 'informational', 'No issues detected during validation'), {}
+        elif method == 'POST' and len(parts) == 1:
+            status, resource = self.__create(parts[0], body, headers.get('If-None-Exist'))
+            return status, resource, {'Location': self.__location(resource)}
+        elif method == 'PUT' and len(parts) == 2:
+            status, resource = self.__update(parts[0], parts[1], body)
+            return status, resource, {'Location': self.__location(resource)}
+        elif method == 'GET' and len(parts) == 2:
+            resource = self.store.read(parts[0], parts[1])
+            if not resource:
+                raise RequestError(404, _outcome('error', 'not-found', f'{parts[0]}/{parts[1]} not found'))
+            return 200, resource, {}
+        elif method == 'DELETE' and len(parts) == 2:
+            if not self.store.delete(parts[0], parts[1]):
+                raise RequestError(404, _outcome('error', 'not-found', f'{parts[0]}/{parts[1]} not found'))
+            return 200, _outcome('information', 'informational', f'Deleted {parts[0]}/{parts[1]}'), {}
+
+        raise RequestError(400, _outcome('error', 'not-supported', f'{method} /{"/".join(parts)} is not supported'))
+
+    @staticmethod
+    def __location(resource):
+        return f'{resource["resourceType"]}/{resource["id"]}/_history/{resource["meta"]["versionId"]}'
+
+    @staticmethod
+    def __check_type(resource_type, body):
+        if not body or body.get('resourceType') != resource_type:
+            raise RequestError(400, _outcome('error', 'invalid', f'Expected a {resource_type} resource'))
+
+    def __create(self, resource_type, body, if_none_exist=None):
+        self.__check_type(resource_type, body)
+        if if_none_exist:
+            existing = self.store.search(resource_type, if_none_exist)
+            if existing:
+                return 200, existing
+
+        return 201, self.store.create(resource_type, body)
+
+    def __update(self, resource_type, resource_id, body):
+        self.__check_type(resource_type, body)
+        if body.get('id') and body['id'] != resource_id:
+            raise RequestError(400, _outcome('error', 'invalid', 'Resource id does not match the url'))
+
+        resource, created = self.store.update(resource_type, resource_id, body)
+        return 201 if created else 200, resource
+
+    def __process_entry(self, entry, full_url_refs, changes):
+        # changes collects the (type, id, previous version) of every resource the entry created or updated
+        request = entry.get('request', {})
+        resource = _replace_references(entry.get('resource'), full_url_refs)
+        url = urlsplit(request.get('url', ''))
+        parts = [part for part in url.path.split('/') if part]
+
+        if request.get('method') == 'POST' and len(parts) == 1:
+            status, resource = self.__create(parts[0], resource, request.get('ifNoneExist'))
+            if status == 201:
+                changes.append((parts[0], resource['id'], None))
+        elif request.get('method') == 'PUT' and len(parts) == 2:
+            previous = self.store.read(parts[0], parts[1])
+            status, resource = self.__update(parts[0], parts[1], resource)
+            changes.append((parts[0], parts[1], previous))
+        else:
+            raise RequestError(400, _outcome('error', 'not-supported',
+                                             f'Bundle request {request.get("method")} {request.get("url")} '
+                                             f'is not supported'))
+
+        if entry.get('fullUrl', '').startswith(URN_UUID_PREFIX):
+            full_url_refs[entry['fullUrl']] = f'{resource["resourceType"]}/{resource["id"]}'
+
+        return {
+            'response': {
+                'status': '201 Created' if status == 201 else '200 OK',
+                'location': self.__location(resource)
+            }
+        }
+
+    def __process_bundle(self, body):
+        if not body or body.get('resourceType') != 'Bundle' or body.get('type') not in ('batch', 'transaction'):
+            raise RequestError(400, _outcome('error', 'invalid', 'Expected a batch or transaction Bundle'))
+
+        # transaction entries may reference each other by fullUrl, entries are processed in order, so references
+        # have to point to earlier entries
+        full_url_refs = {}
+        response_entries = []
+        changes = []
+        for entry in body.get('entry', []):
+            try:
+                response_entries.append(self.__process_entry(entry, full_url_refs, changes))
+            except RequestError as e:
+                if body['type'] == 'transaction':
+                    # a failed transaction is rolled back. It isn't isolated though, concurrent requests can see
+                    # its resources until then.
+                    for resource_type, resource_id, previous in reversed(changes):
+                        self.store.restore(resource_type, resource_id, previous)
+                    raise
+                response_entries.append({'response': {'status': f'{e.status}', 'outcome': e.outcome}})
+
+        response = {
+            'resourceType': 'Bundle',
+            'id': str(uuid.uuid4()),
+            'type': f'{body["type"]}-response',
+            'entry': response_entries
+        }
+        return 200, response, {}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='stub-fhir-server', daemon=True)
+        self.thread.start()
+        logger.info(f'Stub FHIR server listening on {self.base_url}')
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    parser = argparse.ArgumentParser(description='Stub FHIR server for load and regression tests')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='mean latency added to every request')
+    parser.add_argument('--latency-distribution', default=LATENCY_FIXED,
+                        choices=[LATENCY_FIXED, LATENCY_UNIFORM, LATENCY_EXPONENTIAL, LATENCY_LOGNORMAL])
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of requests answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds of the 429 answers')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    stub = StubFhirServer(args.host, args.port, args.latency_ms, args.latency_distribution, args.error_rate,
+                          args.throttle_rate, args.retry_after, args.seed)
+    print(f'Serving on {stub.base_url}')
+    try:
+        stub.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub.httpd.server_close()
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+from enum import Enum
+
+logger = logging.getLogger(__name__)
+
+# keys whose values differ for every row without changing the structure of a resource
+VOLATILE_KEYS = {'id', 'fullUrl', 'versionId', 'lastUpdated'}
+REFERENCE_KEY = 'reference'
+DATE_REGEX = re.compile(r'^\d{4}-\d{2}-\d{2}([T ][0-9:.+\-Z]*)?$')
+
+
+class ValidationMode(Enum):
+    ALWAYS = 'always'
+    SHAPE = 'shape'
+    SAMPLE = 'sample'
+
+
+def check_outcome(outcome):
+    for issue in outcome['issue']:
+        if issue['severity'] == 'error':
+            response_error = json.dumps(outcome['issue'], indent=4, sort_keys=True)
+            raise Exception(f'Resource not valid:\n {response_error}')
+
+
+def strip_volatile(value):
+    if isinstance(value, dict):
+        stripped = {}
+        for key, item in value.items():
+            if key in VOLATILE_KEYS:
+                continue
+            if key == REFERENCE_KEY and isinstance(item, str):
+                # only the referenced resource type is part of the shape
+                stripped[key] = item.rsplit(':', 1)[0] if item.startswith('urn:') else item.split('/')[0]
+            else:
+                stripped[key] = strip_volatile(item)
+        return stripped
+    elif isinstance(value, list):
+        return [strip_volatile(item) for item in value]
+    elif isinstance(value, str) and DATE_REGEX.match(value):
+        return 'date'
+
+    return value
+
+
+def shape_key(resource_json):
+    stripped = strip_volatile(resource_json)
+    return hashlib.sha1(json.dumps(stripped, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+class ValidationPolicy:
+    # decides which resources are sent to $validate:
+    # ALWAYS validates every resource, SHAPE validates once per structural shape and reuses the OperationOutcome,
+    # SAMPLE validates sample_percent percent of the resources. The policy is shared by the posting threads, $validate
+    # is called outside of the lock, so concurrent resources of a new shape may both be validated
+    def __init__(self, mode: ValidationMode = ValidationMode.ALWAYS, sample_percent=10.0, cache_path=None,
+                 seed=None):
+        if not 0 <= sample_percent <= 100:
+            raise ValueError(f'Invalid sample percentage: {sample_percent}')
+
+        self.mode = mode
+        self.sample_percent = sample_percent
+        self.cache_path = cache_path
+        self.random = random.Random(seed)
+        self.outcomes = {}
+        self.n_validated = 0
+        self.n_skipped = 0
+        self.lock = threading.Lock()
+
+        if self.cache_path and os.path.exists(self.cache_path):
+            self.__load()
+
+    def __getstate__(self):
+        # the policy is pickled to the worker processes of a sharded run, each gets its own lock
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __load(self):
+        # the cache file holds one JSON object per line with the shape key and its OperationOutcome
+        with open(self.cache_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    cached = json.loads(line)
+                except ValueError:
+                    logger.warning(f'Skipping corrupt line in validation cache {self.cache_path}')
+                    continue
+                self.outcomes[cached['key']] = cached['outcome']
+
+        logger.info(f'Loaded {len(self.outcomes)} cached validation outcomes from {self.cache_path}')
+
+    def __store(self, key, outcome):
+        # called with the lock held, so that the lines of the cache file are not interleaved
+        self.outcomes[key] = outcome
+        if not self.cache_path:
+            return
+
+        with open(self.cache_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'key': key, 'outcome': outcome}, separators=(',', ':')) + '\n')
+
+    def validate(self, resource_json, validate_func):
+        # validate_func sends the resource to $validate and returns the OperationOutcome as dict
+        if self.mode == ValidationMode.ALWAYS:
+            outcome = validate_func()
+            with self.lock:
+                self.n_validated += 1
+        elif self.mode == ValidationMode.SHAPE:
+            key = shape_key(resource_json)
+            with self.lock:
+                outcome = self.outcomes.get(key)
+                if outcome is not None:
+                    self.n_skipped += 1
+            if outcome is None:
+                outcome = validate_func()
+                with self.lock:
+                    self.n_validated += 1
+                    if key not in self.outcomes:
+                        self.__store(key, outcome)
+        elif self.mode == ValidationMode.SAMPLE:
+            with self.lock:
+                skip = self.random.uniform(0, 100) >= self.sample_percent
+                if skip:
+                    self.n_skipped += 1
+            if skip:
+                return
+            outcome = validate_func()
+            with self.lock:
+                self.n_validated += 1
+        else:
+            raise ValueError(f'Invalid validation mode: {self.mode}')
+
+        check_outcome(outcome)
@@ -1,115 +1,306 @@
+import argparse
 import json
 import logging
-import tkinter as tk
-from tkinter import simpledialog, messagebox
+import os
+import sys
 
-from fhirclient.models import patient
+# pandas, fhirclient and tkinter are only imported when needed, so that --help and invalid arguments return at once
 
-import medicationgenerator
+ARROW_EXTENSIONS = ('.parquet', '.pq', '.arrow', '.feather', '.ipc')
 
-if __name__ == '__main__':
-    logging.basicConfig(
-        format='%(asctime)s %(levelname)-8s %(message)s',
-        level=logging.DEBUG,
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
+# GeneratorConfig of the example mapping table, a config file can override each of them
+GENERATE_DEFAULTS = {
+    'coding_col_names': ['UNII_Substanz_allg', 'ASK_Substanz_allg', 'CAS_Substanz_allg'],
+    'coding_display_col': 'Substanz_allg_engl_INN_oder_sonst',
+    'extension_url': 'https://www.medizininformatik-initiative.de/fhir/core/modul-medikation/StructureDefinition/wirkstofftyp',
+    'extension_system': 'https://www.medizininformatik-initiative.de/fhir/core/modul-medikation/CodeSystem/wirkstofftyp',
+    'extension_code': 'IN',
+    'extension_display': 'ingredient',
+    'med_profile': 'https://www.medizininformatik-initiative.de/fhir/core/modul-medikation/StructureDefinition/Medication',
+    'med_statement_profile': 'https://www.medizininformatik-initiative.de/fhir/core/modul-medikation/StructureDefinition/MedicationStatement',
+    'med_statement_status': 'completed',
+    'route_system': 'http://standardterms.edqm.eu',
+    'route_code_col': 'Routes and Methods of Administration - Concept Code',
+    'route_display_col': 'Routes and Methods of Administration - Term',
+    'ops_text_col': 'opsText',
+    'low_val_col': 'Einheit_Wert_min',
+    'unit_code_col': 'UCUM-Code',
+    'unit_col': 'UCUM-Description',
+    'unit_system': 'http://unitsofmeasure.org',
+    'high_val_col': 'Einheit_Wert_max',
+    'procedure_profile': 'https://www.medizininformatik-initiative.de/fhir/core/modul-prozedur/StructureDefinition/Procedure',
+    'procedure_status': 'completed',
+    'procedure_category_system': 'http://snomed.info/sct',
+    'procedure_category_code': '182832007',
+    'procedure_category_display': 'Procedure related to management of drug administration (procedure)',
+    'procedure_ops_system': 'http://fhir.de/CodeSystem/dimdi/ops',
+    'procedure_ops_code': 'opsCode',
+    'procedure_ops_version': '2020'
+}
 
-    # User input
-    flag = True
-    while flag:
-        window = tk.Tk()
-        window.withdraw()
-        user_in = simpledialog.askstring(title="FHIR Server", prompt="Enter your server's base URL:")
-
-        if user_in == None:
-            flag = False
-            exit()
-        elif type(user_in) == str and not user_in:
-            warning = messagebox.askyesno(title='Missing entry', message='Program can\'t run without a server URL. Are you sure you want to continue?')
-            if warning:
-                flag = False
-                exit()
-            else:
-                flag = False
-        else:
-            flag = False
+# options of the command line, also valid as top level keys of the config file
+OPTION_DEFAULTS = {
+    'base_url': None,
+    'csv': 'ops_mapping_example.csv',
+    'encoding': 'ISO-8859-1',
+    'reader': 'pandas',
+    'index': None,
+    'str_cols': ['ASK_Substanz_allg'],
+    'patient': 'Patient-example.json',
+    'patients': None,
+    'rows_per_patient': 5,
+    'output_dir': None,
+    'compression': None,
+    'no_verify': False,
+    'bundle_size': None,
+    'bundle_type': 'transaction',
+    'post_workers': None,
+    'fast_json': False,
+    'seed': None,
+    'journal': None,
+    'client_ids': None,
+    'delta': None,
+    'dry_run': False,
+    'metrics': None,
+    'gui': False,
+    'log_level': 'INFO'
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Generates Medication, Procedure and MedicationStatement resources from an OPS mapping table and '
+                    'posts them to a FHIR server or writes them as NDJSON files')
+    parser.add_argument('--config', help='JSON file with options (the names below with _ instead of -) and a '
+                                         '"generate" object overriding the column names and profile urls')
+    parser.add_argument('--base-url', help='base url of the FHIR server')
+    parser.add_argument('--csv', help=f'mapping table, csv, Parquet or Arrow IPC (default: {OPTION_DEFAULTS["csv"]})')
+    parser.add_argument('--encoding', help=f'encoding of the mapping table (default: {OPTION_DEFAULTS["encoding"]})')
+    parser.add_argument('--reader', choices=['pandas', 'arrow'],
+                        help='csv reader, arrow (multithreaded) needs pyarrow and is used for Parquet/Arrow files')
+    parser.add_argument('--index', help='precompiled mapping index, compiled from --csv if missing or out of date')
+    parser.add_argument('--patient', help=f'Patient resource (default: {OPTION_DEFAULTS["patient"]})')
+    parser.add_argument('--patients', type=int,
+                        help='generate this many Patients from --patient, each with a random sample of the rows')
+    parser.add_argument('--rows-per-patient', type=int,
+                        help=f'mean rows per Patient with --patients (default: {OPTION_DEFAULTS["rows_per_patient"]})')
+    parser.add_argument('--output-dir', help='write NDJSON files to this directory instead of posting to a server')
+    parser.add_argument('--compression', choices=['gzip', 'zstd'], help='compression of the NDJSON files')
+    parser.add_argument('--no-verify', action='store_true', default=None, help='skip TLS certificate verification')
+    parser.add_argument('--bundle-size', type=int, help='rows per transaction/batch Bundle')
+    parser.add_argument('--bundle-type', choices=['transaction', 'batch'], help='type of the Bundles')
+    parser.add_argument('--post-workers', type=int, help='threads posting the generated resources')
+    parser.add_argument('--fast-json', action='store_true', default=None,
+                        help='build the JSON without the fhirclient models')
+    parser.add_argument('--seed', type=int, help='seed of the generated dates')
+    parser.add_argument('--journal', help='SQLite journal to resume an interrupted run')
+    parser.add_argument('--client-ids', metavar='RUN_ID',
+                        help='derive the resource ids from this run id and create the resources with PUT in parallel')
+    parser.add_argument('--delta', metavar='STATE',
+                        help='SQLite state of the previous run, only the added, changed and removed rows are loaded')
+    parser.add_argument('--dry-run', action='store_true', default=None,
+                        help='with --delta only count the added, changed and removed rows')
+    parser.add_argument('--metrics', help='export stage timings and counts to this JSON (or .prom) file')
+    parser.add_argument('--gui', action='store_true', default=None, help='ask for the server url in a dialog')
+    parser.add_argument('--log-level', help=f'default: {OPTION_DEFAULTS["log_level"]}')
+    args = parser.parse_args(argv)
+
+    # command line > config file > defaults
+    config = {}
+    if args.config:
+        try:
+            with open(args.config, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            parser.error(f'Could not read config file {args.config}: {e}')
+
+    unknown = set(config) - set(OPTION_DEFAULTS) - {'generate'}
+    if unknown:
+        parser.error(f'Unknown config options: {", ".join(sorted(unknown))}')
+    unknown = set(config.get('generate', {})) - set(GENERATE_DEFAULTS)
+    if unknown:
+        parser.error(f'Unknown generate options: {", ".join(sorted(unknown))}')
 
+    options = {**OPTION_DEFAULTS, **config}
+    options.update({name: value for name, value in vars(args).items() if value is not None and name != 'config'})
+    options['generate'] = {**GENERATE_DEFAULTS, **config.get('generate', {})}
 
+    # the dialog is only a fallback for interactive use, headless runs fail right away
+    if not options['base_url'] and not options['output_dir'] and options['gui']:
+        options['base_url'] = ask_base_url()
+    if not options['base_url'] and not options['output_dir']:
+        parser.error('Either --base-url or --output-dir is required')
+    if options['delta'] and (options['output_dir'] or options['journal'] or options['client_ids']
+                             or options['bundle_size'] or options['post_workers']):
+        parser.error('--delta posts row by row and can not be combined with --output-dir, --journal, --client-ids, '
+                     '--bundle-size or --post-workers')
+    if options['dry_run'] and not options['delta']:
+        parser.error('--dry-run requires --delta')
+    if options['patients'] and (options['delta'] or options['journal']):
+        parser.error('--patients can not be combined with --delta or --journal')
 
+    return options
 
-    # Post example patient and get ID
-    with open('Patient-example.json', 'r') as f:
-        data = json.load(f)
 
-    fhir_pat = patient.Patient(data)
+def ask_base_url():
+    import tkinter as tk
+    from tkinter import simpledialog
 
-    low_val_col = 'Einheit_Wert_min'
-    high_val_col = 'Einheit_Wert_max'
-    numerical_cols = [low_val_col, high_val_col]
-    col_names = ['ASK_Substanz_allg']
-    coding_col_names = ['UNII_Substanz_allg', 'ASK_Substanz_allg', 'CAS_Substanz_allg']
-    coding_display_col = 'Substanz_allg_engl_INN_oder_sonst'
-    route_code_col = 'Routes and Methods of Administration - Concept Code'
-    route_display_col = 'Routes and Methods of Administration - Term'
-    ops_text_col = 'opsText'
-    unit_code_col = 'UCUM-Code'
-    unit_col = 'UCUM-Description'
-    ops_code_col = 'opsCode'
+    window = tk.Tk()
+    window.withdraw()
+    base_url = simpledialog.askstring(title='FHIR Server', prompt='Enter your server\'s base URL:')
+    window.destroy()
 
+    return base_url
+
+
+def read_mapping(options):
+    import medicationgenerator
+
+    generate_options = options['generate']
+    numerical_cols = [generate_options['low_val_col'], generate_options['high_val_col']]
     csv_cols = [
-        coding_display_col,
-        route_code_col,
-        route_display_col,
-        ops_text_col,
-        unit_code_col,
-        unit_col,
-        ops_code_col
+        generate_options['coding_display_col'],
+        generate_options['route_code_col'],
+        generate_options['route_display_col'],
+        generate_options['ops_text_col'],
+        generate_options['unit_code_col'],
+        generate_options['unit_col'],
+        generate_options['procedure_ops_code']
     ]
     csv_cols += numerical_cols
-    csv_cols += coding_col_names
-
-    # read and prepare csv with ops data
-    subset = list(csv_cols)
-    subset.remove(high_val_col)
-    ops_csv = medicationgenerator.OpsCsvReader(
-        file_path='ops_mapping_example.csv',
-        encoding='ISO-8859-1',
-        usecols=csv_cols,
-        subset=subset
-    )
+    csv_cols += generate_options['coding_col_names']
+    subset = [col for col in csv_cols if col != generate_options['high_val_col']]
+
+    if options['index']:
+        return medicationgenerator.MappingIndex.open_or_compile(
+            index_path=options['index'],
+            file_path=options['csv'],
+            encoding=options['encoding'],
+            usecols=csv_cols,
+            subset=subset,
+            ops_code_col=generate_options['procedure_ops_code'],
+            numerical_cols=numerical_cols,
+            str_cols=options['str_cols'],
+            config=medicationgenerator.GeneratorConfig(**generate_options)
+        )
 
+    # Parquet and Arrow files are always read with pyarrow
+    reader = medicationgenerator.OpsCsvReader
+    if options['reader'] == 'arrow' or os.path.splitext(options['csv'])[1].lower() in ARROW_EXTENSIONS:
+        reader = medicationgenerator.OpsArrowReader
+    ops_csv = reader(file_path=options['csv'], encoding=options['encoding'], usecols=csv_cols, subset=subset)
     ops_csv.comma_to_dot(col_names=numerical_cols)
-    ops_csv.as_str(col_names=col_names)
-
-    med_statement_ids = medicationgenerator.generate_and_post(
-        base_url=user_in,
-        verification=True,
-        coding_col_names=coding_col_names,
-        coding_display_col=coding_display_col,
-        extension_url='https://www.medizininformatik-initiative.de/fhir/core/modul-medikation/StructureDefinition/wirkstofftyp',
-        extension_system='https://www.medizininformatik-initiative.de/fhir/core/modul-medikation/CodeSystem/wirkstofftyp',
-        extension_code='IN',
-        extension_display='ingredient',
-        med_profile='https://www.medizininformatik-initiative.de/fhir/core/modul-medikation/StructureDefinition/Medication',
-        ops_df=ops_csv.data,
-        med_statement_profile='https://www.medizininformatik-initiative.de/fhir/core/modul-medikation/StructureDefinition/MedicationStatement',
-        med_statement_status='completed',
-        route_system='http://standardterms.edqm.eu',
-        route_code_col=route_code_col,
-        route_display_col=route_display_col,
-        ops_text_col=ops_text_col,
-        low_val_col=low_val_col,
-        unit_code_col=unit_code_col,
-        unit_col=unit_col,
-        unit_system='http://unitsofmeasure.org',
-        high_val_col=high_val_col,
-        procedure_profile='https://www.medizininformatik-initiative.de/fhir/core/modul-prozedur/StructureDefinition/Procedure',
-        procedure_status='completed',
-        procedure_category_system='http://snomed.info/sct',
-        procedure_category_code='182832007',
-        procedure_category_display='Procedure related to management of drug administration (procedure)',
-        procedure_ops_system='http://fhir.de/CodeSystem/dimdi/ops',
-        procedure_ops_code=ops_code_col,
-        procedure_ops_version='2020',
-        fhir_pat=fhir_pat
+    ops_csv.as_str(col_names=options['str_cols'])
+    return ops_csv.data
+
+
+def run(options):
+    from fhirclient.models import patient
+
+    import medicationgenerator
+
+    with open(options['patient'], 'r') as f:
+        pat_json = json.load(f)
+    fhir_pat = patient.Patient(pat_json)
+
+    sink = None
+    if options['output_dir']:
+        sink = medicationgenerator.NdjsonSink(options['output_dir'], compression=options['compression'],
+                                              base_url=options['base_url'])
+
+    journal = medicationgenerator.Journal(options['journal']) if options['journal'] else None
+    metrics = medicationgenerator.Metrics(export_path=options['metrics']) if options['metrics'] else None
+    if metrics:
+        metrics.start()
+
+    if options['delta']:
+        return run_delta(options, fhir_pat, metrics)
+
+    run_options = medicationgenerator.RunOptions(
+        bundle_size=options['bundle_size'],
+        bundle_type=options['bundle_type'],
+        post_workers=options['post_workers'],
+        client_ids=options['client_ids'],
+        sink=sink,
+        journal=journal,
+        fast_json=options['fast_json'],
+        seed=options['seed'],
+        metrics=metrics
+    )
+    try:
+        if options['patients']:
+            # the Patients and their rows are reproducible from --seed
+            ops_df = read_mapping(options)
+            population = medicationgenerator.PopulationGenerator(
+                # the population samples from all rows, so a mapping index is converted to one DataFrame
+                ops_df=ops_df.data if isinstance(ops_df, medicationgenerator.MappingIndex) else ops_df,
+                patient_template=pat_json,
+                n_patients=options['patients'],
+                rows_per_patient=options['rows_per_patient'],
+                seed=options['seed']
+            )
+            med_statement_ids = medicationgenerator.generate_and_post_population(
+                base_url=options['base_url'],
+                verification=not options['no_verify'],
+                population=population,
+                config=medicationgenerator.GeneratorConfig(**options['generate']),
+                options=run_options
+            )
+        else:
+            med_statement_ids = medicationgenerator.generate_and_post(
+                base_url=options['base_url'],
+                verification=not options['no_verify'],
+                ops_df=read_mapping(options),
+                fhir_pat=fhir_pat,
+                config=medicationgenerator.GeneratorConfig(**options['generate']),
+                options=run_options
+            )
+    finally:
+        if sink:
+            sink.close()
+        if journal:
+            journal.close()
+        if metrics:
+            metrics.stop()
+
+    return med_statement_ids
+
+
+def run_delta(options, fhir_pat, metrics):
+    import medicationgenerator
+
+    delta_state = medicationgenerator.DeltaState(options['delta'])
+    try:
+        result = medicationgenerator.generate_and_post_delta(
+            base_url=options['base_url'],
+            verification=not options['no_verify'],
+            ops_df=read_mapping(options),
+            fhir_pat=fhir_pat,
+            delta_state=delta_state,
+            config=medicationgenerator.GeneratorConfig(**options['generate']),
+            dry_run=options['dry_run'],
+            options=medicationgenerator.RunOptions(fast_json=options['fast_json'], seed=options['seed'],
+                                                   metrics=metrics)
+        )
+    finally:
+        delta_state.close()
+        if metrics:
+            metrics.stop()
+
+    return result.med_stat_ids
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=options['log_level'].upper(),
+        datefmt='%Y-%m-%d %H:%M:%S'
     )
+
+    try:
+        run(options)
+    except Exception as e:
+        logging.error(e)
+        sys.exit(1)
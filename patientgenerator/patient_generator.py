@@ -0,0 +1,60 @@
+import copy
+import datetime
+import random
+
+from fhirclient.models import patient
+
+FAMILY_NAMES = ['Müller', 'Schmidt', 'Schneider', 'Fischer', 'Weber', 'Meyer', 'Wagner', 'Becker', 'Schulz',
+                'Hoffmann', 'Koch', 'Richter', 'Klein', 'Wolf', 'Neumann', 'Schwarz', 'Braun', 'Zimmermann']
+GIVEN_NAMES = ['Maja', 'Julia', 'Anna', 'Lena', 'Sophie', 'Marie', 'Emma', 'Hanna', 'Paul', 'Lukas', 'Felix',
+               'Jonas', 'Leon', 'Max', 'Elias', 'Noah', 'Ben', 'Finn']
+GENDERS = ['male', 'female', 'other', 'unknown']
+# the German gender extension is only allowed for gender 'other'
+GENDER_EXTENSION_KEY = '_gender'
+GENDER_OTHER = 'other'
+
+
+class PatientGenerator:
+    # creates synthetic Patients from a template resource (e.g. Patient-example.json), identifier values, name,
+    # gender and birth date are drawn from a seeded random generator, everything else is copied from the template
+    def __init__(self, template_json, seed=None, birth_years=(1915, 2019), family_names=None, given_names=None,
+                 genders=None):
+        self.template_json = copy.deepcopy(template_json)
+        self.template_json.pop('id', None)
+        self.random = random.Random(seed)
+        self.birth_years = birth_years
+        self.family_names = family_names or FAMILY_NAMES
+        self.given_names = given_names or GIVEN_NAMES
+        self.genders = genders or GENDERS
+
+    def __random_value(self, value):
+        # keeps the format of the template value, digits are replaced by digits and letters by letters
+        return ''.join(str(self.random.randint(0, 9)) if char.isdigit()
+                       else chr(self.random.randint(65, 90)) if char.isalpha()
+                       else char
+                       for char in value)
+
+    def __birth_date(self):
+        start = datetime.date(self.birth_years[0], 1, 1)
+        end = datetime.date(self.birth_years[1], 12, 31)
+        return start + datetime.timedelta(days=self.random.randint(0, (end - start).days))
+
+    def generate(self) -> patient.Patient:
+        pat_json = copy.deepcopy(self.template_json)
+
+        for identifier in pat_json.get('identifier', []):
+            if 'value' in identifier:
+                identifier['value'] = self.__random_value(identifier['value'])
+
+        for name in pat_json.get('name', []):
+            name['family'] = self.random.choice(self.family_names)
+            name['given'] = [self.random.choice(self.given_names) for _ in name.get('given', [None])]
+
+        gender = self.random.choice(self.genders)
+        pat_json['gender'] = gender
+        if gender != GENDER_OTHER:
+            pat_json.pop(GENDER_EXTENSION_KEY, None)
+
+        pat_json['birthDate'] = self.__birth_date().isoformat()
+
+        return patient.Patient(pat_json)
@@ -6,16 +6,21 @@ from fhirclient.models import (
     meta,
     codeableconcept,
     period,
-    fhirdate,
-    extension,
-    fhirreference
+    extension
 )
 from medicationgenerator import client, generator_helpers
+from medicationgenerator.generator_helpers import json_object, date_json, fhir_datetime, Reference, FragmentCache, \
+    SharedFragment, FRAGMENT_CACHE_SIZE
 
 logger = logging.getLogger(__name__)
 
+# stream of the seed used for the performed dates, the MedicationStatement dates use another one
+DATE_STREAM = 0
+
 
 class CategoryCoding:
+    __slots__ = ('system', 'code', 'display')
+
     def __init__(self, system, code, display):
         self.system = system
         self.code = code
@@ -29,8 +34,13 @@ class CategoryCoding:
 
         return fhir_coding
 
+    def to_json(self):
+        return json_object(code=self.code, display=self.display, system=self.system)
+
 
 class Category:
+    __slots__ = ('category_coding',)
+
     def __init__(self, category_coding):
         self.category_coding = category_coding
 
@@ -40,8 +50,13 @@ class Category:
 
         return fhir_category
 
+    def to_json(self):
+        return json_object(coding=[self.category_coding.to_json()])
+
 
 class ProcedureCodeableConcept:
+    __slots__ = ('procedure_coding',)
+
     def __init__(self, procedure_coding):
         self.procedure_coding = procedure_coding
 
@@ -51,8 +66,13 @@ class ProcedureCodeableConcept:
 
         return procedure_code
 
+    def to_json(self):
+        return json_object(coding=[self.procedure_coding.to_json()])
+
 
 class ProcedureCoding:
+    __slots__ = ('system', 'code', 'version', 'display')
+
     def __init__(self, system, code, version, display):
         self.system = system
         self.code = code
@@ -68,8 +88,13 @@ class ProcedureCoding:
 
         return fhir_coding
 
+    def to_json(self):
+        return json_object(code=self.code, display=self.display, system=self.system, version=self.version)
+
 
 class FhirPeriod:
+    __slots__ = ('start', 'end')
+
     def __init__(self, start, end):
         self.start = start
         self.end = end
@@ -81,20 +106,27 @@ class FhirPeriod:
 
         return fhir_period
 
+    def to_json(self):
+        return json_object(end=self.end.to_json(), start=self.start.to_json())
+
 
 class FhirDatetime:
+    __slots__ = ('date_time',)
+
     def __init__(self, date_time):
         self.date_time = date_time
 
-    def to_fhir(self) -> fhirdate.FHIRDate:
-        fhir_date = fhirdate.FHIRDate()
-        fhir_date.date = self.date_time
+    def to_fhir(self):
+        return fhir_datetime(self.date_time)
 
-        return fhir_date
+    def to_json(self):
+        return date_json(self.date_time)
 
 
 # optional extension
 class RecordedDate:
+    __slots__ = ('recorded_datetime', 'extention_url')
+
     def __init__(self, recorded_datetime, extention_url):
         self.recorded_datetime = recorded_datetime
         self.extention_url = extention_url
@@ -106,9 +138,14 @@ class RecordedDate:
 
         return fhir_extension
 
+    def to_json(self):
+        return json_object(url=self.extention_url, valueDateTime=self.recorded_datetime.to_json())
+
 
 # optional extension
 class ProcedureIntention:
+    __slots__ = ('system', 'code', 'display', 'extension_url')
+
     def __init__(self, system, code, display, extension_url):
         self.system = system
         self.code = code
@@ -127,20 +164,16 @@ class ProcedureIntention:
 
         return fhir_extension
 
-
-class Reference:
-    def __init__(self, id, resource_type: client.ResourceEnum):
-        self.id = id
-        self.resource_type = resource_type
-
-    def to_fhir(self):
-        fhir_reference = fhirreference.FHIRReference()
-        fhir_reference.reference = f'{self.resource_type.value}/{self.id}'
-
-        return fhir_reference
+    def to_json(self):
+        return json_object(
+            url=self.extension_url,
+            valueCoding=json_object(code=self.code, display=self.display, system=self.system)
+        )
 
 
 class Procedure:
+    __slots__ = ('profile_url', 'status', 'category', 'procedure_code', 'pat_reference', 'performed')
+
     def __init__(self, profile_url, status, category, procedure_code, pat_reference, performed):
         self.profile_url = profile_url
         self.status = status
@@ -168,11 +201,28 @@ class Procedure:
 
         return fhir_procedure
 
-# TODO: Add recorded date and intention extensions
+    def to_json(self):
+        # same dict as to_fhir().as_json() without building the fhirclient models
+        performed_date_time = self.performed.to_json() if type(self.performed) == FhirDatetime else None
+        performed_period = self.performed.to_json() if type(self.performed) == FhirPeriod else None
+
+        return json_object(
+            meta=json_object(profile=[self.profile_url]),
+            category=self.category.to_json(),
+            code=self.procedure_code.to_json(),
+            performedDateTime=performed_date_time,
+            performedPeriod=performed_period,
+            status=self.status,
+            subject=self.pat_reference.to_json(),
+            resourceType='Procedure'
+        )
+
+
 class ProcedureGenerator:
     def __init__(self, profile_url, status, category_system, category_code, category_display, ops_system, ops_code_col,
                  ops_display_col, recorded_date_extension=None, intention_extension=None, performed_start_col=None,
-                 performed_end_col=None, ops_version_col=None, ops_version=None):
+                 performed_end_col=None, ops_version_col=None, ops_version=None, seed=None, shard=0,
+                 fragment_cache_size=FRAGMENT_CACHE_SIZE):
         self.profile_url = profile_url
         self.status = status
         self.category_system = category_system
@@ -188,21 +238,64 @@ class ProcedureGenerator:
         self.recorded_date_extension = recorded_date_extension
         self.intention_extension = intention_extension
 
+        self.date_generator = generator_helpers.DateGenerator(seed, shard=shard, stream=DATE_STREAM)
+
+        # the category is the same for all Procedures, the code is cached per OPS code
+        self.category = SharedFragment(self.__generate_category(
+            system=category_system,
+            code=category_code,
+            display=category_display
+        ))
+        self.fragment_cache = FragmentCache(fragment_cache_size)
+
     def generate(self, row, pat_id) -> Procedure:
-        category = self.__generate_category(
-            system=self.category_system,
-            code=self.category_code,
-            display=self.category_display
+        return self.__generate(
+            code=row[self.ops_code_col],
+            row_version=row[self.ops_version_col] if self.ops_version_col and not self.ops_version else None,
+            display=row[self.ops_display_col] if type(self.ops_display_col) == str else None,
+            start=row[self.performed_start_col] if self.performed_start_col else None,
+            end=row[self.performed_end_col] if self.performed_end_col else None,
+            pat_id=pat_id
         )
 
-        procedure_code = self.__generate_procedure_code(
-            row=row,
+    def generate_batch(self, df, pat_id):
+        # column positions are resolved once and the rows are iterated as plain tuples instead of Series,
+        # yields one Procedure per row or None if it could not be generated
+        def position(col, use_col=True):
+            return df.columns.get_loc(col) if col and use_col else None
+
+        positions = [
+            position(self.ops_code_col),
+            position(self.ops_version_col, not self.ops_version),
+            position(self.ops_display_col, type(self.ops_display_col) == str),
+            position(self.performed_start_col),
+            position(self.performed_end_col)
+        ]
+
+        # the random performed dates of the whole batch are drawn at once
+        if not self.performed_start_col and not self.performed_end_col:
+            random_dates = self.date_generator.dates(len(df))
+        else:
+            random_dates = [None] * len(df)
+
+        for values, random_date in zip(df.itertuples(index=False, name=None), random_dates):
+            code, row_version, display, start, end = [None if pos is None else values[pos] for pos in positions]
+            try:
+                yield self.__generate(code, row_version, display, start, end, pat_id, random_date)
+            except Exception as e:
+                logger.warning(f'Failed to generate Procedure: {e}')
+                yield None
+
+    def __generate(self, code, row_version, display, start, end, pat_id, random_date=None) -> Procedure:
+        procedure_code = self.fragment_cache.get((code, row_version, display), lambda: self.__generate_procedure_code(
             system=self.ops_system,
-            code_col=self.ops_code_col,
-            version_col=self.ops_version_col,
+            code=code,
             version=self.ops_version,
-            display_col=self.ops_display_col
-        )
+            version_col=self.ops_version_col,
+            row_version=row_version,
+            display_col=self.ops_display_col,
+            display=display
+        ))
 
         subject = Reference(
             id=pat_id,
@@ -210,15 +303,17 @@ class ProcedureGenerator:
         )
 
         performed = self.__generate_performed(
-            row=row,
+            start=start,
+            end=end,
             start_col=self.performed_start_col,
-            end_col=self.performed_end_col
+            end_col=self.performed_end_col,
+            random_date=random_date
         )
 
         generated_procedure = Procedure(
             profile_url=self.profile_url,
             status=self.status,
-            category=category,
+            category=self.category,
             procedure_code=procedure_code,
             pat_reference=subject,
             performed=performed
@@ -239,7 +334,7 @@ class ProcedureGenerator:
 
         return category
 
-    def __generate_procedure_code(self, row, system, code_col, version, version_col, display_col):
+    def __generate_procedure_code(self, system, code, version, version_col, row_version, display_col, display):
         # the version can either be a string with the OPS version or the name of the column where the version is stored
         if version:
             if version_col:
@@ -249,22 +344,22 @@ class ProcedureGenerator:
                 code_version = version
         else:
             if version_col:
-                code_version = row[version_col]
+                code_version = row_version
             else:
                 raise Exception('Missing argument for OPS version')
 
         if not (display_col):
             procedure_coding = ProcedureCoding(
                 system=system,
-                code=row[code_col],
+                code=code,
                 version=code_version
             )
         elif type(display_col) == str:
             procedure_coding = ProcedureCoding(
                 system=system,
-                code=row[code_col],
+                code=code,
                 version=code_version,
-                display=row[display_col]
+                display=display
             )
 
         procedure_code = ProcedureCodeableConcept(
@@ -273,19 +368,18 @@ class ProcedureGenerator:
 
         return procedure_code
 
-    def __generate_performed(self, row, start_col, end_col):
+    def __generate_performed(self, start, end, start_col, end_col, random_date=None):
         if not (start_col) and not (end_col):
             # generate one random datetime
-            datetime_generator = generator_helpers.RandomDates()
             performed = FhirDatetime(
-                date_time=datetime_generator.next()
+                date_time=random_date if random_date else self.date_generator.next()
             )
         else:
             start_datetime = FhirDatetime(
-                date_time=row[start_col]
+                date_time=start
             )
             end_datetime = FhirDatetime(
-                date_time=row[end_col]
+                date_time=end
             )
             performed = FhirPeriod(
                 start=start_datetime,
@@ -0,0 +1,32 @@
+import json
+import os
+
+import pytest
+from fhirclient.models import patient
+
+import ops2fhir
+from medicationgenerator import generator_helpers, options
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLE_CSV = os.path.join(ROOT, 'ops_mapping_example.csv')
+EXAMPLE_PATIENT = os.path.join(ROOT, 'Patient-example.json')
+
+
+@pytest.fixture
+def ops_df():
+    # the example mapping table, read like ops2fhir.py does
+    ops_csv = generator_helpers.OpsCsvReader(EXAMPLE_CSV, 'ISO-8859-1', None, ['opsCode'])
+    ops_csv.comma_to_dot(['Einheit_Wert_min', 'Einheit_Wert_max'])
+    ops_csv.as_str(['ASK_Substanz_allg'])
+    return ops_csv.data
+
+
+@pytest.fixture
+def config():
+    return options.GeneratorConfig(**ops2fhir.GENERATE_DEFAULTS)
+
+
+@pytest.fixture
+def fhir_pat():
+    with open(EXAMPLE_PATIENT, 'r', encoding='utf-8') as f:
+        return patient.Patient(json.load(f))
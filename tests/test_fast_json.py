@@ -0,0 +1,24 @@
+import json
+
+import pytest
+
+from medicationgenerator import generate
+
+
+@pytest.fixture
+def resources(ops_df, config):
+    med_generator, proc_generator, med_statement_generator = generate._create_generators(config, seed=1)
+    assert ops_df[config.high_val_col].isna().any()
+
+    meds = list(med_generator.generate_batch(ops_df))
+    procs = list(proc_generator.generate_batch(ops_df, 'pat-1'))
+    med_stats = list(med_statement_generator.generate_batch(ops_df, med_ids=['med-1'] * len(ops_df), pat_id='pat-1',
+                                                           proc_ids=['proc-1'] * len(ops_df)))
+    return {'Medication': meds, 'Procedure': procs, 'MedicationStatement': med_stats}
+
+
+@pytest.mark.parametrize('resource_type', ['Medication', 'Procedure', 'MedicationStatement'])
+def test_to_json_equals_as_json(resources, resource_type):
+    for resource in resources[resource_type]:
+        assert resource is not None
+        assert json.dumps(resource.to_json()) == json.dumps(resource.to_fhir().as_json())
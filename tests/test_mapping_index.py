@@ -0,0 +1,46 @@
+import pickle
+
+import pytest
+
+import ops2fhir
+from medicationgenerator import mapping_index
+
+from conftest import EXAMPLE_CSV
+
+
+def compile_index(index_path, config):
+    # the columns ops2fhir.py reads from the example mapping table
+    generate_options = ops2fhir.GENERATE_DEFAULTS
+    numerical_cols = [generate_options['low_val_col'], generate_options['high_val_col']]
+    usecols = [generate_options['coding_display_col'], generate_options['route_code_col'],
+               generate_options['route_display_col'], generate_options['ops_text_col'],
+               generate_options['unit_code_col'], generate_options['unit_col'], generate_options['procedure_ops_code'],
+               *numerical_cols, *generate_options['coding_col_names']]
+    subset = [col for col in usecols if col != generate_options['high_val_col']]
+
+    return mapping_index.MappingIndex.compile(EXAMPLE_CSV, 'ISO-8859-1', usecols, subset,
+                                              generate_options['procedure_ops_code'], numerical_cols,
+                                              ['ASK_Substanz_allg'], index_path=index_path, config=config)
+
+
+def test_open_returns_the_compiled_records(tmp_path, config):
+    index_path = str(tmp_path / 'ops.index')
+    compiled = compile_index(index_path, config)
+    opened = mapping_index.MappingIndex.open(index_path)
+
+    assert opened.n_rows == compiled.n_rows
+    assert set(opened.positions) == set(compiled.positions)
+    for ops_code in compiled.positions:
+        assert [record.to_json() for record in opened.lookup(ops_code)] == \
+               [record.to_json() for record in compiled.lookup(ops_code)]
+        assert len(opened.rows(ops_code)) == len(compiled.lookup(ops_code))
+    assert sum(len(chunk) for chunk in opened) == compiled.n_rows
+
+
+def test_open_rejects_files_that_are_not_an_index(tmp_path):
+    index_path = str(tmp_path / 'ops.index')
+    with open(index_path, 'wb') as f:
+        pickle.dump({'positions': {}}, f)
+
+    with pytest.raises(ValueError):
+        mapping_index.MappingIndex.open(index_path)
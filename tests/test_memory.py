@@ -0,0 +1,25 @@
+import gc
+import tracemalloc
+
+from benchmarks import benchmark
+
+N_ROWS = 5000
+
+
+def test_resources_retained_per_row(tmp_path):
+    # the same measurement as the resources_retained benchmark: distinct rows without fragment cache, so that the
+    # size of the resources is measured and not the sharing of cached fragments
+    df = benchmark.distinct_rows(benchmark.read_csv(benchmark.scaled_csv(N_ROWS, tmp_path)))
+    generators = benchmark.create_generators(df, fragment_cache_size=0)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        resources = benchmark.retain_resources(df, generators)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert [len(generated) for generated in resources] == [N_ROWS] * 3
+    assert all(resource is not None for generated in resources for resource in generated)
+    assert peak / N_ROWS <= benchmark.MEMORY_LIMITS['resources_retained']
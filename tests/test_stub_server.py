@@ -0,0 +1,49 @@
+import pandas as pd
+import pytest
+import requests
+
+from medicationgenerator import generate, options, stub_server
+
+N_COPIES = 3
+
+
+@pytest.mark.parametrize('run_options', [
+    options.RunOptions(),
+    options.RunOptions(bundle_size=4),
+    options.RunOptions(post_workers=4)
+], ids=['sequential', 'bundle', 'pipelined'])
+def test_generate_and_post_creates_the_resources_of_every_row(ops_df, config, fhir_pat, run_options):
+    ops_df = pd.concat([ops_df] * N_COPIES, ignore_index=True)
+
+    with stub_server.StubFhirServer() as stub:
+        med_stat_ids = generate.generate_and_post(stub.base_url, False, ops_df, fhir_pat, config, options=run_options)
+
+        assert len(med_stat_ids) == len(ops_df)
+        assert stub.store.count('Patient') == 1
+        assert stub.store.count('Procedure') == len(ops_df)
+        assert stub.store.count('MedicationStatement') == len(ops_df)
+        # the Medications are cached, the copies of the rows don't create them again
+        assert stub.store.count('Medication') == len(ops_df) // N_COPIES
+
+
+def test_failed_transaction_is_rolled_back():
+    medication = {'resourceType': 'Medication', 'status': 'active'}
+    with stub_server.StubFhirServer() as stub:
+        response = requests.put(f'{stub.base_url}/Medication/med-1', json=medication)
+        assert response.status_code == 201
+
+        bundle = {
+            'resourceType': 'Bundle',
+            'type': 'transaction',
+            'entry': [
+                {'resource': medication, 'request': {'method': 'POST', 'url': 'Medication'}},
+                {'resource': dict(medication, status='inactive'),
+                 'request': {'method': 'PUT', 'url': 'Medication/med-1'}},
+                {'resource': medication, 'request': {'method': 'POST', 'url': 'Procedure'}}
+            ]
+        }
+        response = requests.post(stub.base_url, json=bundle)
+
+        assert response.status_code == 400
+        assert stub.store.count('Medication') == 1
+        assert stub.store.read('Medication', 'med-1')['status'] == 'active'
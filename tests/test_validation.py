@@ -0,0 +1,29 @@
+import pandas as pd
+
+from medicationgenerator import generate, options, stub_server, validation
+
+
+def validate_requests(stub):
+    return sum(count for key, count in stub.request_counts.items() if key.endswith('/$validate'))
+
+
+def test_shape_mode_validates_each_shape_once(tmp_path, ops_df, config, fhir_pat):
+    # the rows repeat, so that every shape occurs several times per run
+    ops_df = pd.concat([ops_df] * 5, ignore_index=True)
+    cache_path = str(tmp_path / 'validation.jsonl')
+
+    with stub_server.StubFhirServer() as stub:
+        policy = validation.ValidationPolicy(validation.ValidationMode.SHAPE, cache_path=cache_path)
+        generate.generate_and_post(stub.base_url, False, ops_df, fhir_pat, config,
+                                   options=options.RunOptions(validation_policy=policy))
+        n_shapes = len(policy.outcomes)
+        assert validate_requests(stub) == policy.n_validated == n_shapes
+        assert policy.n_skipped > 0
+
+        # the second run reads the outcomes of the first one from the cache file and posts from several threads
+        policy = validation.ValidationPolicy(validation.ValidationMode.SHAPE, cache_path=cache_path)
+        generate.generate_and_post(stub.base_url, False, ops_df, fhir_pat, config,
+                                   options=options.RunOptions(validation_policy=policy, post_workers=4))
+        assert validate_requests(stub) == n_shapes
+        assert policy.n_validated == 0
+        assert len(policy.outcomes) == n_shapes